@@ -5,8 +5,26 @@ from django.contrib.auth.models import User
 from django.contrib.auth.admin import UserAdmin as DjangoUserAdmin
 from django.db.models import Q
 from django import forms
+from django.http import HttpResponseRedirect
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.html import format_html
 
-from PostsApp.models import Profile, Post, LikeException
+from PostsApp.app_utils.admin_utils import EstimatedCountPaginator
+from PostsApp.models import Profile, Post, PostLike
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """Changelist without exact COUNT(*) queries, for tables with millions of rows"""
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
+class SoftDeleteAdmin(admin.ModelAdmin):
+    """Deleting only marks the rows: they and the rows depending on them are removed by the purge_deleted command"""
+    def get_deleted_objects(self, objs, request):
+        # Nothing cascades now, so the confirmation page does not collect the related rows
+        return [str(obj) for obj in objs], {self.model._meta.verbose_name_plural: len(objs)}, set(), []
 
 
 class ProfileFollowingForm(forms.ModelForm):
@@ -24,34 +42,102 @@ class ProfileInline(admin.StackedInline):
     model = Profile
     fields = ['following']
     form = ProfileFollowingForm
+    # Only the followed users are rendered, candidates are searched on demand
+    autocomplete_fields = ['following']
 
 
 admin.site.unregister(User)
 
 
 @admin.register(User)
-class UserAdmin(DjangoUserAdmin):
+class UserAdmin(SoftDeleteAdmin, LargeTableAdmin, DjangoUserAdmin):
     list_display = ('username', 'email', 'first_name', 'last_name', 'is_staff')
     list_select_related = True
+    # Prefix search, also used by the autocomplete widgets of users
+    search_fields = ('^username', '=email')
     inlines = (ProfileInline,)
     list_filter = ('is_staff', 'is_superuser', 'is_active', 'groups')
     readonly_fields = ('date_joined', 'last_login')
     ordering = ('username',)
 
+    def delete_model(self, request, obj: User):
+        Profile.objects.get_or_create(user=obj)[0].soft_delete()
+
+    def delete_queryset(self, request, queryset):
+        for user in queryset:
+            self.delete_model(request, user)
+
 
 @admin.register(Post)
-class PostAdmin(admin.ModelAdmin):
-    list_display = ('post_ref', 'author', 'caption', 'created',)
-    list_filter = ('author',)
-    readonly_fields = ('post_ref', 'created',)
+class PostAdmin(SoftDeleteAdmin, LargeTableAdmin):
+    list_display = ('post_ref', 'author', 'caption', 'created', 'deleted',)
+    list_select_related = ('author',)
+    search_fields = ('=post_ref', '=author__username')
+    autocomplete_fields = ('author',)
+    readonly_fields = ('post_ref', 'created', 'likes', 'width', 'height', 'format', 'bytes', 'phash', 'deleted',)
     ordering = ('-created',)
+    actions = ('find_near_duplicates',)
+
+    def get_queryset(self, request):
+        # Deleted posts are listed until they are purged
+        queryset = Post.all_objects.get_queryset()
+        ordering = self.get_ordering(request)
+        return queryset.order_by(*ordering) if ordering else queryset
+
+    def likes(self, obj: Post):
+        """Link to the likes of the Post, they are not listed in the Post page"""
+        if obj.pk is None:
+            return '-'
+        url = reverse('admin:PostsApp_postlike_changelist')
+        return format_html('<a href="{}?post__id__exact={}">See likes</a>', url, obj.pk)
 
     def save_model(self, request, obj: Post, form, change: bool):
-        liked = form.cleaned_data['liked']
-        author = form.cleaned_data['author']
-        if author in liked:
-            form.cleaned_data['liked'] = liked.exclude(id=author.id)
+        super().save_model(request, obj, form, change)
+        # The new author may have liked the Post: a single indexed delete instead of loading every like
+        removed, _ = PostLike.objects.filter(post=obj, user_id=obj.author_id).delete()
+        if removed:
             messages.set_level(request, messages.ERROR)
             messages.error(request, "Author of the post can not be in 'Liked' list")
-        super().save_model(request, obj, form, change)
 
+    def delete_model(self, request, obj: Post):
+        obj.soft_delete()
+
+    def delete_queryset(self, request, queryset):
+        queryset.update(deleted=timezone.now())
+
+    def find_near_duplicates(self, request, queryset):
+        """Shows the selected posts together with the posts whose image is a near duplicate of theirs"""
+        from PostsApp.app_utils.phash_utils import near_duplicates
+        duplicates = {duplicate.pk for post in queryset for duplicate in near_duplicates(post)}
+        if not duplicates:
+            self.message_user(request, 'No near duplicate images found', messages.INFO)
+            return None
+        post_ids = sorted(duplicates.union(queryset.values_list('pk', flat=True)))
+        url = reverse('admin:PostsApp_post_changelist')
+        return HttpResponseRedirect(f'{url}?id__in={",".join(map(str, post_ids))}')
+    find_near_duplicates.short_description = 'Find near duplicate images'
+
+
+class PostLikeForm(forms.ModelForm):
+    class Meta:
+        model = PostLike
+        fields = ['post', 'user']
+
+    def clean(self):
+        cleaned_data = super().clean()
+        post, user = cleaned_data.get('post'), cleaned_data.get('user')
+        # Likes saved here do not go through Post.liked, so its m2m_changed check does not apply
+        if post is not None and user is not None and post.author_id == user.pk:
+            raise forms.ValidationError("Author of the post can not be in 'Liked' list")
+        return cleaned_data
+
+
+@admin.register(PostLike)
+class PostLikeAdmin(LargeTableAdmin):
+    form = PostLikeForm
+    list_display = ('post', 'user', 'created')
+    list_select_related = ('post__author', 'user')
+    search_fields = ('=post__post_ref', '=user__username')
+    autocomplete_fields = ('post', 'user')
+    readonly_fields = ('created',)
+    ordering = ('-created',)
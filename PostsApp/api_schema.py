@@ -0,0 +1,129 @@
+"""
+OpenAPI documentation of the API.
+
+The schema is generated at build time by the build_api_schema command into API_SCHEMA_DIR and served from there
+with an ETag and long-lived caching, instead of drf_yasg walking every view on each request. drf_yasg is only
+imported to generate the schema (the command, or the first request when the artifact was not built), not when a
+worker boots: the views are annotated with PostsApp.app_utils.schema_utils.lazy_swagger_auto_schema.
+"""
+import hashlib
+import json
+import threading
+from importlib import import_module
+from pathlib import Path
+from typing import Dict, NamedTuple, Optional
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.shortcuts import render
+from django.urls import reverse
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition, require_safe
+
+from PostsApp.app_utils.schema_utils import apply_swagger_annotations
+
+API_INFO = {
+    'title': 'Hedgehog Lab Test API',
+    'default_version': 'v1',
+    'description': 'API documentation',
+}
+CONTENT_TYPES = {
+    'json': 'application/json',
+    'yaml': 'application/yaml',
+}
+
+
+class SchemaArtifact(NamedTuple):
+    content: bytes
+    version: str
+
+
+def generate_schema(url: Optional[str] = None) -> Dict[str, bytes]:
+    """
+    Generates the OpenAPI schema of the API.
+
+    :param url: base URL of the API (scheme and host), if the schema has to contain it
+    :return: the schema encoded in every format of CONTENT_TYPES
+    """
+    from drf_yasg import openapi
+    from drf_yasg.codecs import OpenAPICodecJson, OpenAPICodecYaml
+    from drf_yasg.generators import OpenAPISchemaGenerator
+
+    # The URLconf imports the views, which record their annotations
+    import_module(settings.ROOT_URLCONF)
+    apply_swagger_annotations()
+    generator = OpenAPISchemaGenerator(openapi.Info(**API_INFO), url=url)
+    schema = generator.get_schema(request=None, public=True)
+    return {
+        'json': OpenAPICodecJson(validators=[]).encode(schema),
+        'yaml': OpenAPICodecYaml(validators=[]).encode(schema),
+    }
+
+
+def write_schema(schema: Dict[str, bytes], directory: Path) -> str:
+    """Writes the schema artifacts and returns their version"""
+    directory.mkdir(parents=True, exist_ok=True)
+    for schema_format, content in schema.items():
+        (directory / f'swagger.{schema_format}').write_bytes(content)
+    version = hashlib.sha256(schema['json']).hexdigest()[:12]
+    (directory / 'VERSION').write_text(version)
+    return version
+
+
+_artifacts: Dict[str, SchemaArtifact] = {}
+_artifacts_lock = threading.Lock()
+
+
+def get_schema_artifact(schema_format: str) -> SchemaArtifact:
+    """Prebuilt schema, read once per process. Without a build (e.g. development) it is generated once instead"""
+    with _artifacts_lock:
+        if schema_format not in _artifacts:
+            directory = Path(settings.API_SCHEMA_DIR)
+            try:
+                version = (directory / 'VERSION').read_text().strip()
+                schema = {name: (directory / f'swagger.{name}').read_bytes() for name in CONTENT_TYPES}
+            except FileNotFoundError:
+                schema = generate_schema()
+                version = hashlib.sha256(schema['json']).hexdigest()[:12]
+            _artifacts.update({name: SchemaArtifact(content, version) for name, content in schema.items()})
+        return _artifacts[schema_format]
+
+
+def reset_schema_artifacts() -> None:
+    with _artifacts_lock:
+        _artifacts.clear()
+
+
+def _cached(response: HttpResponse) -> HttpResponse:
+    patch_cache_control(response, public=True, max_age=settings.API_SCHEMA_CACHE_TIMEOUT)
+    return response
+
+
+def _spec_url() -> str:
+    return f"{reverse('schema-json', args=['.json'])}?v={get_schema_artifact('json').version}"
+
+
+@require_safe
+@condition(etag_func=lambda request, format: get_schema_artifact(format.lstrip('.')).version)
+def schema_view(request, format: str):
+    schema_format = format.lstrip('.')
+    return _cached(HttpResponse(get_schema_artifact(schema_format).content,
+                                content_type=CONTENT_TYPES[schema_format]))
+
+
+@require_safe
+def swagger_ui_view(request):
+    return _cached(render(request, 'drf-yasg/swagger-ui.html', {
+        'title': API_INFO['title'],
+        'swagger_settings': json.dumps({'url': _spec_url()}),
+        'oauth2_config': '{}',
+        'USE_SESSION_AUTH': False,
+    }))
+
+
+@require_safe
+def redoc_view(request):
+    return _cached(render(request, 'drf-yasg/redoc.html', {
+        'title': API_INFO['title'],
+        'redoc_settings': json.dumps({'url': _spec_url()}),
+    }))
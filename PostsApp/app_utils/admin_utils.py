@@ -0,0 +1,40 @@
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import QuerySet
+from django.utils.functional import cached_property
+
+# Below this number of rows an exact COUNT(*) is cheap enough
+EXACT_COUNT_LIMIT = 10000
+
+
+def estimated_count(queryset: QuerySet) -> int:
+    """Approximate number of rows of the table of queryset, read from the database statistics instead of counting"""
+    connection = connections[queryset.db]
+    table = queryset.model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE relname = %s', [table])
+            row = cursor.fetchone()
+            if row is not None and row[0] >= 0:
+                return row[0]
+        elif connection.vendor == 'sqlite':
+            # sqlite_stat1 only exists once ANALYZE has run, the first number of its stat column is the row count
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'")
+            if cursor.fetchone() is not None:
+                cursor.execute('SELECT stat FROM sqlite_stat1 WHERE tbl = %s LIMIT 1', [table])
+                row = cursor.fetchone()
+                if row is not None:
+                    return int(row[0].split()[0])
+    # Without statistics (e.g. never analyzed) the rows are counted
+    return queryset.count()
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator for admin changelists of big tables: unfiltered lists use an estimated count"""
+    @cached_property
+    def count(self) -> int:
+        if isinstance(self.object_list, QuerySet) and not self.object_list.query.where:
+            estimate = estimated_count(self.object_list)
+            if estimate > EXACT_COUNT_LIMIT:
+                return estimate
+        return super().count
@@ -0,0 +1,51 @@
+"""
+Concurrent sections of the composite bootstrap endpoint (PostsApp.views.BootstrapAPI).
+
+Every section is a callable run on a shared thread pool, so the response takes as long as the slowest section and
+not the sum of them. Each thread has its own database connection, closed when the section ends.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from django.conf import settings
+from django.db import connections
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.POSTS_BOOTSTRAP_WORKERS,
+                                           thread_name_prefix='bootstrap')
+        return _executor
+
+
+def _timed(section: Callable[[], Any]) -> Tuple[Any, float]:
+    start = time.perf_counter()
+    try:
+        return section(), (time.perf_counter() - start) * 1000
+    finally:
+        connections.close_all()
+
+
+def run_sections(sections: Dict[str, Callable[[], Any]]) -> Tuple[Dict[str, Any], Dict[str, float]]:
+    """
+    Runs the sections concurrently.
+
+    :return: result and duration (milliseconds) of every section
+    """
+    futures = {name: get_executor().submit(_timed, section) for name, section in sections.items()}
+    results, timings = {}, {}
+    for name, future in futures.items():
+        results[name], timings[name] = future.result()
+    return results, timings
+
+
+def server_timing(timings: Dict[str, float]) -> str:
+    """Value of the Server-Timing header with the duration of every section"""
+    return ', '.join(f'{name};dur={duration:.1f}' for name, duration in timings.items())
@@ -0,0 +1,197 @@
+"""
+Publish/subscribe of the realtime events streamed to clients (see PostsApp.sse).
+
+Events are published from the model signal receivers and fanned out by the backend configured in
+POSTS_EVENTS_BACKEND:
+  - LocalEventBackend: in-process, for a single ASGI process
+  - SQLiteEventBackend: events go through a shared SQLite file that every process polls. It stands in for a
+    real broker (e.g. Redis) when several processes (WSGI workers publishing, ASGI workers streaming) run locally
+
+Both backends keep the last POSTS_EVENTS_BUFFER events, so a client reconnecting with Last-Event-ID gets what it
+missed. Every subscriber has a bounded queue: a subscriber that falls behind is dropped (its stream is closed)
+instead of buffering without limit, and its client resumes from the buffer when it reconnects.
+"""
+import asyncio
+import itertools
+import json
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Set
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+# Event types
+POST_CREATED = 'post'
+LIKES_CHANGED = 'likes'
+# Internal event, not sent to clients: the users followed by data['user'] changed
+FOLLOWING_CHANGED = 'following'
+
+
+class Event(NamedTuple):
+    id: int
+    type: str
+    data: Dict[str, Any]
+
+
+class Subscriber:
+    """Bounded queue of events for one stream, that can be fed from any thread"""
+    def __init__(self, loop: asyncio.AbstractEventLoop, max_size: int):
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_size)
+        self.overflowed = False
+
+    def deliver(self, event: Event) -> None:
+        try:
+            self.loop.call_soon_threadsafe(self._put, event)
+        except RuntimeError:
+            # The loop of the stream is already closed
+            pass
+
+    def _put(self, event: Event) -> None:
+        if self.overflowed:
+            return
+        if self.queue.full():
+            # Too slow: drop what is pending and tell the stream to close with None
+            self.overflowed = True
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(None)
+            return
+        self.queue.put_nowait(event)
+
+
+class EventBackend(ABC):
+    def __init__(self):
+        self._subscribers: Set[Subscriber] = set()
+        self._lock = threading.Lock()
+
+    @abstractmethod
+    def publish(self, event_type: str, data: Dict[str, Any]) -> None:
+        """Buffers a new event and delivers it to the subscribers of every process"""
+
+    @abstractmethod
+    def events_since(self, event_id: int) -> List[Event]:
+        """Buffered events newer than event_id, oldest first"""
+
+    def subscribe(self, subscriber: Subscriber) -> None:
+        with self._lock:
+            self._subscribers.add(subscriber)
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def _dispatch(self, event: Event) -> None:
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            subscriber.deliver(event)
+
+
+class LocalEventBackend(EventBackend):
+    def __init__(self):
+        super().__init__()
+        # Ids go on from those of the previous runs of the process: microseconds since the epoch at startup, a
+        # client reconnecting after a restart with Last-Event-ID would otherwise skip that many new events
+        self._ids = itertools.count(time.time_ns() // 1000)
+        self._buffer = deque(maxlen=settings.POSTS_EVENTS_BUFFER)
+
+    def publish(self, event_type: str, data: Dict[str, Any]) -> None:
+        with self._lock:
+            event = Event(next(self._ids), event_type, data)
+            self._buffer.append(event)
+        self._dispatch(event)
+
+    def events_since(self, event_id: int) -> List[Event]:
+        with self._lock:
+            return [event for event in self._buffer if event.id > event_id]
+
+
+class SQLiteEventBackend(EventBackend):
+    POLL_INTERVAL = 0.2
+
+    def __init__(self, path: Optional[str] = None):
+        super().__init__()
+        self.path = str(path or settings.POSTS_EVENTS_SQLITE_PATH)
+        self._last_id: Optional[int] = None
+        self._poller: Optional[threading.Thread] = None
+        with self._connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS events '
+                               '(id INTEGER PRIMARY KEY AUTOINCREMENT, type TEXT NOT NULL, data TEXT NOT NULL)')
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # sqlite3 connections can not be shared between threads, they are cheap enough to open per call
+        connection = sqlite3.connect(self.path, timeout=5)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def publish(self, event_type: str, data: Dict[str, Any]) -> None:
+        with self._connect() as connection:
+            cursor = connection.execute('INSERT INTO events (type, data) VALUES (?, ?)',
+                                        (event_type, json.dumps(data)))
+            connection.execute('DELETE FROM events WHERE id <= ?',
+                               (cursor.lastrowid - settings.POSTS_EVENTS_BUFFER,))
+
+    def events_since(self, event_id: int) -> List[Event]:
+        with self._connect() as connection:
+            rows = connection.execute('SELECT id, type, data FROM events WHERE id > ? ORDER BY id',
+                                      (event_id,)).fetchall()
+        return [Event(row_id, event_type, json.loads(data)) for row_id, event_type, data in rows]
+
+    def subscribe(self, subscriber: Subscriber) -> None:
+        super().subscribe(subscriber)
+        with self._lock:
+            if self._poller is None:
+                self._last_id = self._max_id()
+                self._poller = threading.Thread(target=self._poll, name='sqlite-events-poller', daemon=True)
+                self._poller.start()
+
+    def poll_once(self) -> None:
+        for event in self.events_since(self._last_id):
+            self._last_id = event.id
+            self._dispatch(event)
+
+    def _poll(self) -> None:
+        while True:
+            time.sleep(self.POLL_INTERVAL)
+            try:
+                self.poll_once()
+            except sqlite3.Error:
+                # e.g. database locked for longer than the timeout, retried on the next poll
+                pass
+
+    def _max_id(self) -> int:
+        with self._connect() as connection:
+            return connection.execute('SELECT COALESCE(MAX(id), 0) FROM events').fetchone()[0]
+
+
+_backend: Optional[EventBackend] = None
+_backend_lock = threading.Lock()
+
+
+def get_event_backend() -> EventBackend:
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = import_string(settings.POSTS_EVENTS_BACKEND)()
+        return _backend
+
+
+def reset_event_backend() -> None:
+    global _backend
+    with _backend_lock:
+        _backend = None
+
+
+def publish_event(event_type: str, data: Dict[str, Any]) -> None:
+    get_event_backend().publish(event_type, data)
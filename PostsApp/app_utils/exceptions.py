@@ -9,3 +9,7 @@ class FollowException(Exception):
 
 class LikeException(Exception):
     pass
+
+
+class ImageIngestException(Exception):
+    pass
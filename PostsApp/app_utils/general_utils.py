@@ -1,10 +1,14 @@
 from datetime import datetime
 import time
 from functools import wraps
+from itertools import islice
+from typing import Iterable, Iterator, List, TypeVar
 
 import pytz
 from django.conf import settings
 
+T = TypeVar('T')
+
 
 def unix_timestamp(dt: datetime) -> int:
     """Turn datetime into Unix timestamp integer"""
@@ -23,4 +27,14 @@ def disable_for_loaddata(signal_handler):
         if kwargs['raw']:
             return
         signal_handler(*args, **kwargs)
-    return wrapper
\ No newline at end of file
+    return wrapper
+
+
+def chunked(iterable: Iterable[T], size: int) -> Iterator[List[T]]:
+    """Splits an iterable in lists of at most size elements, without materializing it"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
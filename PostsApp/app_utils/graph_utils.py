@@ -0,0 +1,289 @@
+"""
+Streaming export and import of the social graph as NDJSON, for backups, migrations between databases and seeding.
+
+Every table is a file of the directory (users.ndjson, tokens.ndjson, profiles.ndjson, follows.ndjson, posts.ndjson,
+likes.ndjson) with one JSON object per row, keyed by column. Memory stays constant whatever the size of the graph:
+rows are read with .iterator() in order of their key and written as they come, and files are read line by line and
+inserted in chunks, one transaction per chunk. Inserts skip the signals like loaddata, so the search index is rebuilt
+after importing posts.
+
+Tables run in parallel, one worker per table: they are all exported at once, and every table is imported as soon as
+the tables it references are. Writers of one SQLite database take turns, it has a single write lock.
+
+The export is not a snapshot: rows deleted while it runs can still be referenced by rows of tables exported later
+(e.g. the likes of a purged post). Such dangling rows are skipped by the import and reported (dangling).
+
+An interrupted run can be resumed:
+  - export: every file continues after the key of its last complete row (a partially written row is dropped)
+  - import: the first rows of a table, those already imported, are skipped (offset)
+
+Image files are not included, MEDIA_ROOT has to be copied separately.
+"""
+import datetime
+import itertools
+import json
+import os
+import threading
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import ExitStack, nullcontext
+from pathlib import Path
+from typing import Any, Callable, ContextManager, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple, Type
+
+from django.contrib.auth.models import User
+from django.core.management.color import no_style
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DEFAULT_DB_ALIAS, connections, models, transaction
+from django.db.models import Q
+from rest_framework.authtoken.models import Token
+
+from PostsApp.app_utils.general_utils import chunked
+from PostsApp.app_utils.shard_utils import get_shards, shard_for_author, shard_for_post_id
+from PostsApp.models import Post, PostLike, Profile
+
+GRAPH_CHUNK_SIZE = 1000
+# Bytes read at a time when looking for the last row of a file
+TAIL_BLOCK_SIZE = 64 * 1024
+
+
+class GraphJSONEncoder(DjangoJSONEncoder):
+    """Keeps the microseconds of times, which DjangoJSONEncoder cuts to milliseconds"""
+    def default(self, o):
+        if isinstance(o, (datetime.datetime, datetime.time)):
+            return o.isoformat()
+        return super().default(o)
+
+
+class GraphTable(NamedTuple):
+    name: str
+    model: Type[models.Model]
+    # Tables referenced by the rows of this one, imported first
+    depends_on: Tuple[str, ...] = ()
+    # Columns the rows are sorted by, unique (default: the primary key)
+    key: Optional[Tuple[str, ...]] = None
+    # Columns left out, e.g. ids that are not unique across shards
+    exclude: Tuple[str, ...] = ()
+    # Shard of a row of a sharded model, None for the tables of 'default'
+    shard: Optional[Callable[[models.Model], str]] = None
+
+    @property
+    def file_name(self) -> str:
+        return f'{self.name}.ndjson'
+
+    @property
+    def columns(self) -> List[str]:
+        return [field.attname for field in self.model._meta.concrete_fields if field.attname not in self.exclude]
+
+    @property
+    def key_columns(self) -> Tuple[str, ...]:
+        return self.key or (self.model._meta.pk.attname,)
+
+    def databases(self) -> List[str]:
+        # Shards are listed in order of their range of post ids, so every key comes after those of the shards before
+        return get_shards() if self.shard else [DEFAULT_DB_ALIAS]
+
+
+TABLES = (
+    GraphTable('users', User),
+    GraphTable('tokens', Token, depends_on=('users',)),
+    GraphTable('profiles', Profile, depends_on=('users',)),
+    GraphTable('follows', Profile.following.through, depends_on=('profiles',)),
+    GraphTable('posts', Post, depends_on=('users',), shard=lambda post: shard_for_author(post.author_id)),
+    # Like ids are only unique in their shard, likes get a new one when imported
+    GraphTable('likes', PostLike, depends_on=('posts',), key=('post_id', 'user_id'), exclude=('id',),
+               shard=lambda like: shard_for_post_id(like.post_id)),
+)
+TABLE_NAMES = tuple(table.name for table in TABLES)
+
+
+def _after(columns: Sequence[str], values: Sequence[Any]) -> Q:
+    """Rows whose columns come after values, in lexicographic order"""
+    condition = Q()
+    for i, column in enumerate(columns):
+        condition |= Q(**dict(zip(columns[:i], values[:i])), **{f'{column}__gt': values[i]})
+    return condition
+
+
+def _line_start(file, end: int) -> int:
+    """Position after the last line break before end, 0 if there is none"""
+    position = end
+    while position > 0:
+        start = max(position - TAIL_BLOCK_SIZE, 0)
+        file.seek(start)
+        index = file.read(position - start).rfind(b'\n')
+        if index >= 0:
+            return start + index + 1
+        position = start
+    return 0
+
+
+def _resume_point(path: Path) -> Optional[Dict[str, Any]]:
+    """Last complete row of an export file, which is truncated right after it"""
+    with open(path, 'rb+') as file:
+        end = _line_start(file, file.seek(0, os.SEEK_END))
+        file.truncate(end)
+        if not end:
+            return None
+        start = _line_start(file, end - 1)
+        file.seek(start)
+        return json.loads(file.read(end - start))
+
+
+def export_table(table: GraphTable, directory: Path, resume: bool = False,
+                 chunk_size: int = GRAPH_CHUNK_SIZE) -> int:
+    """Writes the rows of table to its file in directory, returns the number of written rows"""
+    path = directory / table.file_name
+    last_row = _resume_point(path) if resume and path.exists() else None
+    columns, key_columns = table.columns, table.key_columns
+    encoder = GraphJSONEncoder()
+    exported = 0
+    with open(path, 'ab' if last_row else 'wb') as file:
+        for alias in table.databases():
+            # The base manager also returns the soft-deleted rows
+            rows = table.model._base_manager.using(alias).order_by(*key_columns)
+            if last_row:
+                rows = rows.filter(_after(key_columns, [last_row[column] for column in key_columns]))
+            for row in rows.values_list(*columns).iterator(chunk_size=chunk_size):
+                file.write(encoder.encode(dict(zip(columns, row))).encode() + b'\n')
+                exported += 1
+    return exported
+
+
+_write_locks: Dict[str, threading.Lock] = defaultdict(threading.Lock)
+
+
+def _write_lock(alias: str) -> ContextManager:
+    """Serializes the writers of a SQLite database, they would otherwise wait for its lock and time out"""
+    return _write_locks[alias] if connections[alias].vendor == 'sqlite' else nullcontext()
+
+
+def _references(table: GraphTable) -> List[Tuple[str, GraphTable, str]]:
+    """(column, referenced table, referenced column) of the foreign keys of table to the other tables"""
+    tables_by_model = {graph_table.model: graph_table for graph_table in TABLES}
+    return [(field.attname, tables_by_model[field.related_model], field.target_field.attname)
+            for field in table.model._meta.concrete_fields
+            if field.is_relation and field.attname in table.columns and field.related_model in tables_by_model]
+
+
+def _existing(objs: List[models.Model], alias: str,
+              references: List[Tuple[str, GraphTable, str]]) -> List[models.Model]:
+    """objs whose foreign keys reference existing rows, a sharded table is looked up in the database of objs"""
+    for column, referenced, target in references:
+        values = {getattr(obj, column) for obj in objs}
+        existing = set(referenced.model._base_manager.using(alias if referenced.shard else DEFAULT_DB_ALIAS)
+                       .filter(**{f'{target}__in': values}).values_list(target, flat=True))
+        objs = [obj for obj in objs if getattr(obj, column) in existing]
+    return objs
+
+
+def _insert(model: Type[models.Model], fields: List[models.Field], objs: List[models.Model], alias: str) -> None:
+    # Inserted raw like loaddata: bulk_create would run pre_save, which overwrites e.g. the auto_now Post.created
+    batch_size = max(connections[alias].ops.bulk_batch_size(fields, objs), 1)
+    for batch in chunked(objs, batch_size):
+        model._base_manager._insert(batch, fields=fields, using=alias, raw=True)
+
+
+def import_table(table: GraphTable, directory: Path, offset: int = 0, chunk_size: int = GRAPH_CHUNK_SIZE,
+                 progress: Optional[Callable[[str, int], None]] = None,
+                 dangling: Optional[Callable[[str, int], None]] = None) -> int:
+    """
+    Inserts the rows of the file of table in directory, returns the number of inserted rows.
+
+    :param offset: number of rows at the start of the file to skip, e.g. already imported by an interrupted run
+    :param progress: called with the table name and the number of rows of the file imported so far (skipped ones
+                     included), after every committed chunk
+    :param dangling: called with the table name and the number of rows skipped so far because they reference rows
+                     that were not exported, after every chunk with such rows
+    """
+    model = table.model
+    fields = [model._meta.get_field(column) for column in table.columns]
+    fields_by_column = {field.attname: field for field in fields}
+    references = _references(table)
+    read, imported = 0, 0
+    with open(directory / table.file_name, 'rb') as file:
+        rows = (json.loads(line) for line in itertools.islice(file, offset, None) if line.strip())
+        for chunk in chunked(rows, chunk_size):
+            by_database: Dict[str, List[models.Model]] = {}
+            for row in chunk:
+                obj = model(**{column: fields_by_column[column].to_python(value) for column, value in row.items()})
+                by_database.setdefault(table.shard(obj) if table.shard else DEFAULT_DB_ALIAS, []).append(obj)
+            # Locks in a fixed order, chunks of sharded tables write to several databases
+            aliases = sorted(by_database)
+            with ExitStack() as stack:
+                for alias in aliases:
+                    stack.enter_context(_write_lock(alias))
+                    stack.enter_context(transaction.atomic(using=alias))
+                for alias in aliases:
+                    objs = _existing(by_database[alias], alias, references)
+                    _insert(model, fields, objs, alias)
+                    imported += len(objs)
+            read += len(chunk)
+            if dangling and imported < read:
+                dangling(table.name, read - imported)
+            if progress:
+                progress(table.name, offset + read)
+    for alias in table.databases():
+        # Sequences do not follow explicit ids in every database (e.g. PostgreSQL)
+        statements = connections[alias].ops.sequence_reset_sql(no_style(), [model])
+        with connections[alias].cursor() as cursor:
+            for statement in statements:
+                cursor.execute(statement)
+    return imported
+
+
+def _in_worker(work: Callable[[GraphTable], int], table: GraphTable) -> int:
+    try:
+        return work(table)
+    finally:
+        for alias in table.databases():
+            connections[alias].close()
+
+
+def _run_tables(tables: Iterable[GraphTable], work: Callable[[GraphTable], int], workers: Optional[int],
+                ordered: bool) -> Dict[str, int]:
+    """Runs work(table) for every table, at most workers at once, after the tables it depends on if ordered"""
+    pending = list(tables)
+    names = {table.name for table in pending}
+    results: Dict[str, int] = {}
+    with ThreadPoolExecutor(max_workers=workers or len(pending), thread_name_prefix='graph') as executor:
+        running = {}
+        while pending or running:
+            for table in list(pending):
+                if not ordered or all(name in results or name not in names for name in table.depends_on):
+                    pending.remove(table)
+                    running[executor.submit(_in_worker, work, table)] = table
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                results[running.pop(future).name] = future.result()
+    return results
+
+
+def _selected(names: Optional[Iterable[str]]) -> List[GraphTable]:
+    names = set(TABLE_NAMES if names is None else names)
+    return [table for table in TABLES if table.name in names]
+
+
+def export_graph(directory: Path, tables: Optional[Iterable[str]] = None, resume: bool = False,
+                 workers: Optional[int] = None, chunk_size: int = GRAPH_CHUNK_SIZE) -> Dict[str, int]:
+    """Exports the tables (every one by default) to directory, returns the number of exported rows per table"""
+    directory.mkdir(parents=True, exist_ok=True)
+    return _run_tables(_selected(tables), lambda table: export_table(table, directory, resume, chunk_size),
+                       workers, ordered=False)
+
+
+def import_graph(directory: Path, tables: Optional[Iterable[str]] = None, offsets: Optional[Dict[str, int]] = None,
+                 workers: Optional[int] = None, chunk_size: int = GRAPH_CHUNK_SIZE,
+                 progress: Optional[Callable[[str, int], None]] = None,
+                 dangling: Optional[Callable[[str, int], None]] = None) -> Dict[str, int]:
+    """
+    Imports the tables (every one by default) from directory, returns the number of imported rows per table.
+
+    :param offsets: rows to skip at the start of the file of a table, by table name
+    :param progress: see import_table
+    :param dangling: see import_table
+    """
+    offsets = offsets or {}
+    return _run_tables(
+        _selected(tables),
+        lambda table: import_table(table, directory, offsets.get(table.name, 0), chunk_size, progress, dangling),
+        workers, ordered=True)
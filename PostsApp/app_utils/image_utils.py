@@ -0,0 +1,131 @@
+"""
+Ingest stage for uploaded images: limits checked on the header, EXIF orientation and downscaling
+"""
+import io
+import math
+import os
+from typing import NamedTuple, Tuple
+
+import numpy as np
+from PIL import Image
+from django.conf import settings
+from django.core.files import File
+from django.core.files.base import ContentFile
+
+from PostsApp.app_utils.exceptions import ImageIngestException
+
+JPEG_QUALITY = 90
+# dHash compares horizontally adjacent pixels of a (DHASH_SIZE + 1) x DHASH_SIZE grayscale thumbnail
+DHASH_SIZE = 8
+EXIF_ORIENTATION_TAG = 0x0112
+
+# Same mapping used by PIL.ImageOps.exif_transpose
+ORIENTATION_TRANSPOSE = {
+    2: Image.FLIP_LEFT_RIGHT,
+    3: Image.ROTATE_180,
+    4: Image.FLIP_TOP_BOTTOM,
+    5: Image.TRANSPOSE,
+    6: Image.ROTATE_270,
+    7: Image.TRANSVERSE,
+    8: Image.ROTATE_90,
+}
+
+
+class IngestedImage(NamedTuple):
+    file: File
+    width: int
+    height: int
+    format: str
+    bytes: int
+    phash: int
+
+
+def ingest_image(file: File) -> IngestedImage:
+    """
+    Validates an uploaded image reading only its header and, when needed, normalizes it.
+
+    Images that are already upright and within POSTS_IMAGE_MAX_EDGE are kept untouched. Otherwise the image is
+    decoded at reduced scale (JPEG draft mode + reduce), rotated according to its EXIF orientation and re-encoded.
+
+    :raise: ImageIngestException if the image is unreadable or exceeds the byte or pixel limits
+    """
+    if file.size > settings.POSTS_IMAGE_MAX_BYTES:
+        raise ImageIngestException(f'Image exceeds {settings.POSTS_IMAGE_MAX_BYTES} bytes')
+
+    file.seek(0)
+    try:
+        # Image.open only parses the header, pixel data is decoded lazily
+        image = Image.open(file)
+    except (OSError, Image.DecompressionBombError) as e:
+        raise ImageIngestException('Invalid image') from e
+
+    width, height = image.size
+    if width * height > settings.POSTS_IMAGE_MAX_PIXELS:
+        raise ImageIngestException(f'Image exceeds {settings.POSTS_IMAGE_MAX_PIXELS} pixels')
+
+    image_format = image.format
+    orientation = image.getexif().get(EXIF_ORIENTATION_TAG, 1)
+    max_edge = settings.POSTS_IMAGE_MAX_EDGE
+    if orientation not in ORIENTATION_TRANSPOSE and max(width, height) <= max_edge:
+        # The hash does not need full resolution, JPEG can be decoded at 1/8 scale
+        image.draft('L', (DHASH_SIZE * 8, DHASH_SIZE * 8))
+        try:
+            phash = dhash(image)
+        except (OSError, ValueError) as e:
+            raise ImageIngestException('Invalid image') from e
+        file.seek(0)
+        return IngestedImage(file, width, height, image_format, file.size, phash)
+
+    try:
+        image = _downscale(image, max_edge)
+        if orientation in ORIENTATION_TRANSPOSE:
+            image = image.transpose(ORIENTATION_TRANSPOSE[orientation])
+        content, encoded_format = _encode(image, image_format)
+        phash = dhash(image)
+    except (OSError, ValueError) as e:
+        raise ImageIngestException('Invalid image') from e
+
+    name = file.name
+    if encoded_format != image_format:
+        # Formats Pillow cannot save are re-encoded as PNG, the extension must match the content
+        name = f'{os.path.splitext(name)[0]}.png'
+    width, height = image.size
+    return IngestedImage(ContentFile(content, name=name), width, height, encoded_format, len(content), phash)
+
+
+def dhash(image: Image.Image) -> int:
+    """
+    Difference hash of an image: 64 bits that barely change when the image is resized or re-encoded.
+
+    :return: hash as a signed 64 bit integer, so it can be stored in a BigIntegerField
+    """
+    thumbnail = image.convert('L').resize((DHASH_SIZE + 1, DHASH_SIZE), Image.LANCZOS)
+    pixels = np.asarray(thumbnail, dtype=np.int16)
+    bits = np.packbits(pixels[:, 1:] > pixels[:, :-1])
+    return int(bits.view('>u8').astype(np.uint64).view(np.int64)[0])
+
+
+def _downscale(image: Image.Image, max_edge: int) -> Image.Image:
+    scale = max_edge / max(image.size)
+    if scale >= 1:
+        return image
+    # Only JPEG supports draft mode: the decoder itself skips to the nearest 1/2, 1/4 or 1/8 scale
+    image.draft(image.mode, (math.ceil(image.width * scale), math.ceil(image.height * scale)))
+    factor = max(image.size) // max_edge
+    if factor > 1 and image.mode in ('P', '1'):
+        # reduce does not average palette indices or single bits, it rejects these modes
+        image = image.convert('L' if image.mode == '1' else 'RGBA' if 'transparency' in image.info else 'RGB')
+    if factor > 1:
+        image = image.reduce(factor)
+    if max(image.size) > max_edge:
+        image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+    return image
+
+
+def _encode(image: Image.Image, image_format: str) -> Tuple[bytes, str]:
+    output = io.BytesIO()
+    if image_format not in Image.SAVE:
+        image_format = 'PNG'
+    options = {'quality': JPEG_QUALITY} if image_format == 'JPEG' else {}
+    image.save(output, image_format, **options)
+    return output.getvalue(), image_format
@@ -0,0 +1,116 @@
+"""
+In-memory index of the perceptual hashes (dHash) of every Post, to find near duplicate images.
+
+Hashes are kept as a packed uint64 array and searched with a vectorized XOR + popcount, which scans millions of
+hashes in a few milliseconds. The index is loaded lazily per process, follows the posts created or deleted in the
+same process, and is reloaded from the database every POSTS_PHASH_INDEX_TTL seconds to pick up the rest.
+"""
+import threading
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+from django.conf import settings
+
+from PostsApp.models import Post
+
+# Number of set bits of every byte, used when numpy has no bitwise_count (numpy < 2.0)
+_POPCOUNT_TABLE = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.uint8)
+
+
+def hamming_distances(hashes: np.ndarray, target: int) -> np.ndarray:
+    """Number of different bits between target and each one of hashes (uint64 array)"""
+    xor = np.bitwise_xor(hashes, np.int64(target).astype(np.uint64))
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(xor)
+    return _POPCOUNT_TABLE[xor.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.uint8)
+
+
+class PhashIndex:
+    def __init__(self, post_ids: np.ndarray, hashes: np.ndarray):
+        self._lock = threading.Lock()
+        self._post_ids = post_ids.astype(np.int64)
+        self._hashes = hashes.astype(np.int64).view(np.uint64)
+        self._pending: List[Tuple[int, int]] = []
+        self.loaded = time.monotonic()
+
+    @classmethod
+    def from_db(cls) -> 'PhashIndex':
+        rows = Post.objects.exclude(phash=None).values_list('pk', 'phash').order_by()
+        pairs = np.fromiter((value for row in rows.iterator() for value in row), dtype=np.int64)
+        return cls(pairs[0::2], pairs[1::2])
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._post_ids) + len(self._pending)
+
+    def add(self, post_id: int, phash: int) -> None:
+        # Appending to the arrays copies them, new hashes are buffered and merged on the next search
+        with self._lock:
+            self._pending.append((post_id, phash))
+
+    def discard(self, post_id: int) -> None:
+        with self._lock:
+            self._merge_pending()
+            keep = self._post_ids != post_id
+            self._post_ids, self._hashes = self._post_ids[keep], self._hashes[keep]
+
+    def search(self, phash: int, max_distance: int, exclude: Optional[int] = None) -> List[Tuple[int, int]]:
+        """
+        :return: (post id, distance) of the hashes at most max_distance bits away from phash, closest first
+        """
+        with self._lock:
+            self._merge_pending()
+            post_ids, hashes = self._post_ids, self._hashes
+        distances = hamming_distances(hashes, phash)
+        matches = np.flatnonzero(distances <= max_distance)
+        matches = matches[np.argsort(distances[matches], kind='stable')]
+        return [(int(post_ids[i]), int(distances[i])) for i in matches if post_ids[i] != exclude]
+
+    def _merge_pending(self) -> None:
+        if not self._pending:
+            return
+        post_ids, hashes = zip(*self._pending)
+        self._pending = []
+        self._post_ids = np.concatenate([self._post_ids, np.array(post_ids, dtype=np.int64)])
+        self._hashes = np.concatenate([self._hashes, np.array(hashes, dtype=np.int64).view(np.uint64)])
+
+
+_index: Optional[PhashIndex] = None
+_index_lock = threading.Lock()
+
+
+def get_phash_index() -> PhashIndex:
+    global _index
+    with _index_lock:
+        if _index is None or time.monotonic() - _index.loaded > settings.POSTS_PHASH_INDEX_TTL:
+            _index = PhashIndex.from_db()
+        return _index
+
+
+def reset_phash_index() -> None:
+    global _index
+    with _index_lock:
+        _index = None
+
+
+def index_post_phash(post: Post) -> None:
+    """Adds the hash of a Post to the index, if the index is already loaded in this process"""
+    if _index is not None and post.phash is not None:
+        _index.add(post.pk, post.phash)
+
+
+def unindex_post_phash(post: Post) -> None:
+    if _index is not None:
+        _index.discard(post.pk)
+
+
+def near_duplicates(post: Post, max_distance: Optional[int] = None) -> List[Post]:
+    """Posts whose image is a near duplicate of the image of post, closest first"""
+    if post.phash is None:
+        return []
+    if max_distance is None:
+        max_distance = settings.POSTS_PHASH_MAX_DISTANCE
+    matches = get_phash_index().search(post.phash, max_distance, exclude=post.pk)
+    posts = Post.objects.in_bulk([post_id for post_id, _ in matches])
+    return [posts[post_id] for post_id, _ in matches if post_id in posts]
@@ -0,0 +1,217 @@
+"""
+Bulk provisioning of users, for onboarding whole organizations.
+
+Creating users one by one costs a password hash on the request thread and, through the post_save signals, separate
+inserts of their Profile and Token. Here rows are read as a stream (NDJSON or CSV), passwords are hashed in parallel
+in a process pool, and every chunk of users is inserted with bulk_create of User, Profile and Token in a single
+transaction, which does not send the per-row signals. Invalid rows (e.g. duplicated usernames) are reported and
+skipped, the rest are still created.
+"""
+import codecs
+import csv
+import itertools
+import json
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from typing import Any, Dict, IO, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+import django
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from rest_framework.authtoken.models import Token
+
+from PostsApp.app_utils.general_utils import chunked
+from PostsApp.models import Profile
+
+NDJSON = 'ndjson'
+CSV = 'csv'
+USER_FIELDS = ('username', 'password', 'email', 'first_name', 'last_name')
+BOM = codecs.BOM_UTF8.decode()
+
+# Row number and fields, or why the row could not be read
+Row = Tuple[int, Union[Dict[str, Any], str, None]]
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+class RowError(NamedTuple):
+    row: int
+    username: str
+    error: str
+
+
+class ProvisioningResult(NamedTuple):
+    created: int
+    errors: List[RowError]
+
+
+def _decode(stream: IO[bytes]) -> Iterator[str]:
+    """Lines of stream, invalid UTF-8 kept as surrogates so the rows holding it are reported, not the whole stream"""
+    for number, line in enumerate(stream):
+        line = line.decode('utf-8', 'surrogateescape')
+        yield line.lstrip(BOM) if number == 0 else line
+
+
+def _checked(fields: Dict[str, Any]) -> Union[Dict[str, Any], str]:
+    for value in fields.values():
+        if isinstance(value, str):
+            try:
+                value.encode('utf-8')
+            except UnicodeEncodeError:
+                return 'row is not valid UTF-8'
+    return fields
+
+
+def read_rows(stream: IO[bytes], data_format: str) -> Iterator[Row]:
+    """Yields (row number, fields) of an NDJSON or CSV (with a header) stream, without reading it whole"""
+    lines = _decode(stream)
+    if data_format == CSV:
+        reader = csv.DictReader(lines)
+        for number in itertools.count(1):
+            try:
+                fields = next(reader)
+            except StopIteration:
+                return
+            except csv.Error as e:
+                # The reader goes on with the next line
+                yield number, f'row is not valid CSV: {e}'
+                continue
+            yield number, _checked(fields)
+    for number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            fields = json.loads(line)
+        except ValueError:
+            fields = None
+        yield number, _checked(fields) if isinstance(fields, dict) else None
+
+
+def _validate(fields: Union[Dict[str, Any], str, None]) -> Optional[str]:
+    if fields is None:
+        return 'row is not a JSON object'
+    if isinstance(fields, str):
+        return fields
+    username, password = fields.get('username'), fields.get('password')
+    if not isinstance(username, str) or not username:
+        return 'username is required'
+    if not isinstance(password, str) or not password:
+        return 'password is required'
+    try:
+        User.username_validator(username)
+    except ValidationError as e:
+        return e.messages[0]
+    if len(username) > User._meta.get_field('username').max_length:
+        return 'username is too long'
+    return None
+
+
+def _init_worker() -> None:
+    # Workers started with spawn (e.g. macOS) import Django again
+    if not apps.ready:
+        django.setup()
+
+
+def _insert(users: List[User]) -> None:
+    with transaction.atomic():
+        User.objects.bulk_create(users)
+        # SQLite does not return the ids of bulk inserted rows
+        ids = dict(User.objects.filter(username__in=[user.username for user in users])
+                   .values_list('username', 'pk'))
+        Profile.objects.bulk_create([Profile(user_id=ids[user.username]) for user in users])
+        tokens = [Token(user_id=ids[user.username]) for user in users]
+        for token in tokens:
+            # Token.save() generates the key, bulk_create does not call it
+            token.key = token.generate_key()
+        Token.objects.bulk_create(tokens)
+
+
+def _provision_chunk(chunk: List[Row], seen: set, pool: Optional[ProcessPoolExecutor]) -> ProvisioningResult:
+    errors, valid = [], []
+    for number, fields in chunk:
+        username = (fields.get('username') if isinstance(fields, dict) else None) or ''
+        error = _validate(fields)
+        if error is None and username in seen:
+            error = 'username is repeated in the file'
+        if error is not None:
+            errors.append(RowError(number, str(username), error))
+            continue
+        seen.add(username)
+        valid.append((number, fields))
+    existing = set(User.objects.filter(username__in=[fields['username'] for _, fields in valid])
+                   .values_list('username', flat=True))
+    errors.extend(RowError(number, fields['username'], 'username already exists')
+                  for number, fields in valid if fields['username'] in existing)
+    valid = [(number, fields) for number, fields in valid if fields['username'] not in existing]
+
+    passwords = [fields['password'] for _, fields in valid]
+    hashes = pool.map(make_password, passwords, chunksize=max(1, len(passwords) // 64)) if pool else \
+        map(make_password, passwords)
+    users = [User(password=password_hash, **{name: fields.get(name) or '' for name in USER_FIELDS
+                                             if name != 'password'})
+             for (_, fields), password_hash in zip(valid, hashes)]
+    try:
+        _insert(users)
+    except IntegrityError:
+        # An username was taken meanwhile: insert the users one by one to find out which
+        created = 0
+        for (number, fields), user in zip(valid, users):
+            try:
+                _insert([user])
+                created += 1
+            except IntegrityError:
+                errors.append(RowError(number, fields['username'], 'username already exists'))
+        return ProvisioningResult(created, errors)
+    return ProvisioningResult(len(users), errors)
+
+
+def get_hashing_pool() -> ProcessPoolExecutor:
+    """
+    Process pool of POSTS_PROVISIONING_WORKERS processes shared by the requests of this process, started on first
+    use and kept: starting one per request would cost more than hashing small uploads
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=settings.POSTS_PROVISIONING_WORKERS, initializer=_init_worker)
+        return _pool
+
+
+def reset_hashing_pool() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False)
+        _pool = None
+
+
+def provision_users(rows: Iterable[Row], chunk_size: Optional[int] = None, workers: Optional[int] = None,
+                    pool: Optional[ProcessPoolExecutor] = None) -> ProvisioningResult:
+    """
+    Creates the users of rows (username, password and optionally email, first_name and last_name) with their
+    Profile and Token.
+
+    :param chunk_size: users inserted per transaction, POSTS_PROVISIONING_CHUNK_SIZE by default
+    :param workers: processes of a pool started for this call, POSTS_PROVISIONING_WORKERS by default (None: one per
+                    CPU). With 1 passwords are hashed in this process
+    :param pool: pool hashing the passwords instead, left running (e.g. get_hashing_pool())
+    :return: number of created users and errors of the skipped rows, ordered by row within every chunk
+    """
+    chunk_size = chunk_size or settings.POSTS_PROVISIONING_CHUNK_SIZE
+    workers = workers if workers is not None else settings.POSTS_PROVISIONING_WORKERS
+    created, errors, seen = 0, [], set()
+    owned = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) \
+        if pool is None and workers != 1 else None
+    pool = pool or owned
+    with owned or nullcontext():
+        for chunk in chunked(rows, chunk_size):
+            result = _provision_chunk(chunk, seen, pool)
+            created += result.created
+            errors.extend(sorted(result.errors))
+    return ProvisioningResult(created, errors)
@@ -0,0 +1,105 @@
+"""
+Purge of the soft-deleted posts and accounts (Post.soft_delete, Profile.soft_delete) and garbage collection of the
+media files.
+
+Rows are deleted in transactions of a bounded number of rows, so a purge never locks the database for long no matter
+how many likes or follows a deleted post or account has. Image files are not removed with their posts:
+collect_media_garbage removes the files that no post references anymore, in MEDIA_ROOT and in the packs of the cold
+tier.
+"""
+import os
+import time
+from pathlib import Path
+from typing import Dict, Iterator
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Q, QuerySet
+
+from PostsApp.app_utils.general_utils import chunked
+from PostsApp.app_utils.shard_utils import get_shards, scatter
+from PostsApp.app_utils.tiering_utils import collect_pack_garbage
+from PostsApp.models import FollowSuggestion, Post, PostLike, Profile
+
+PURGE_BATCH_SIZE = 1000
+MEDIA_CHUNK_SIZE = 1000
+
+
+def _delete_in_batches(queryset: QuerySet, batch_size: int) -> int:
+    """Deletes the rows of queryset in transactions of at most batch_size rows, returns the number of rows"""
+    deleted = 0
+    while True:
+        with transaction.atomic(using=queryset.db):
+            pks = list(queryset.values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                return deleted
+            queryset.model._base_manager.using(queryset.db).filter(pk__in=pks).delete()
+        deleted += len(pks)
+
+
+def purge_deleted(batch_size: int = PURGE_BATCH_SIZE) -> Dict[str, int]:
+    """Purges the soft-deleted posts and then the soft-deleted accounts, returns the number of purged rows"""
+    purged = {'likes': 0, 'posts': 0, 'users': 0}
+    for shard in get_shards():
+        purged['likes'] += _delete_in_batches(PostLike.objects.using(shard).filter(post__deleted__isnull=False),
+                                              batch_size)
+        purged['posts'] += _delete_in_batches(Post.all_objects.using(shard).filter(deleted__isnull=False),
+                                              batch_size)
+    follows = Profile.following.through.objects
+    for profile_id, user_id in list(Profile.objects.filter(deleted__isnull=False).values_list('pk', 'user_id')):
+        # The user liked posts of any shard, and its posts created meanwhile are in its shard
+        for shard in get_shards():
+            purged['likes'] += _delete_in_batches(
+                PostLike.objects.using(shard).filter(Q(user_id=user_id) | Q(post__author_id=user_id)), batch_size)
+            # Posts created meanwhile: deleting the User only cascades in 'default'
+            purged['posts'] += _delete_in_batches(Post.all_objects.using(shard).filter(author_id=user_id),
+                                                  batch_size)
+        _delete_in_batches(follows.filter(Q(profile_id=profile_id) | Q(user_id=user_id)), batch_size)
+        _delete_in_batches(FollowSuggestion.objects.filter(Q(user_id=user_id) | Q(suggested_id=user_id)),
+                           batch_size)
+        # Only the Profile and the Token (already deleted) are left to cascade
+        User.objects.filter(pk=user_id).delete()
+        purged['users'] += 1
+    return purged
+
+
+def _walk(directory: str) -> Iterator[os.DirEntry]:
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _walk(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                yield entry
+
+
+def collect_media_garbage(min_age: float, dry_run: bool = False) -> Iterator[str]:
+    """
+    Streams the files of MEDIA_ROOT against the images of the posts (deleted ones included until they are purged),
+    a chunk of files at a time, and removes the files no post references. Then collects the packs of the cold tier
+    (see PostsApp.app_utils.tiering_utils.collect_pack_garbage).
+
+    :param min_age: seconds since the last modification of a file to remove it, so images uploaded while the
+                    collection runs are not removed before their Post is committed
+    :param dry_run: only lists the files to remove
+    :return: names of the removed files, relative to MEDIA_ROOT
+    """
+    cutoff = time.time() - min_age
+    root = Path(settings.MEDIA_ROOT)
+    if root.is_dir():
+        yield from _collect_hot_garbage(root, cutoff, dry_run)
+    yield from collect_pack_garbage(cutoff, dry_run)
+
+
+def _collect_hot_garbage(root: Path, cutoff: float, dry_run: bool) -> Iterator[str]:
+    candidates = (entry for entry in _walk(str(root)) if entry.stat(follow_symlinks=False).st_mtime < cutoff)
+    for chunk in chunked(candidates, MEDIA_CHUNK_SIZE):
+        files = {Path(entry.path).relative_to(root).as_posix(): entry.path for entry in chunk}
+        referenced = set().union(*scatter(
+            lambda shard: list(Post.all_objects.using(shard).filter(image__in=files).values_list('image', flat=True))
+        ).values())
+        for name, path in files.items():
+            if name not in referenced:
+                if not dry_run:
+                    os.remove(path)
+                yield name
@@ -0,0 +1,35 @@
+"""
+swagger_auto_schema of drf_yasg for views that must not import drf_yasg when a worker boots.
+
+The views are annotated with lazy_swagger_auto_schema, which only records the annotation: drf_yasg is imported and
+swagger_auto_schema applied by apply_swagger_annotations(), right before the schema is generated.
+"""
+import threading
+from typing import Any, Callable, Dict, List, Tuple
+
+_annotations: List[Tuple[Callable, Callable[[Any], Dict[str, Any]]]] = []
+_annotations_lock = threading.Lock()
+
+
+def lazy_swagger_auto_schema(schema_kwargs: Callable[[Any], Dict[str, Any]]) -> Callable[[Callable], Callable]:
+    """
+    Decorator of a view method, swagger_auto_schema(**schema_kwargs(openapi)) once drf_yasg is loaded.
+
+    :param schema_kwargs: called with the drf_yasg.openapi module, returns the arguments of swagger_auto_schema
+    """
+    def decorator(view_method: Callable) -> Callable:
+        with _annotations_lock:
+            _annotations.append((view_method, schema_kwargs))
+        return view_method
+    return decorator
+
+
+def apply_swagger_annotations() -> None:
+    """Applies the pending annotations of the imported views"""
+    from drf_yasg import openapi
+    from drf_yasg.utils import swagger_auto_schema
+
+    with _annotations_lock:
+        while _annotations:
+            view_method, schema_kwargs = _annotations.pop()
+            swagger_auto_schema(**schema_kwargs(openapi))(view_method)
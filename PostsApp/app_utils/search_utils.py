@@ -0,0 +1,95 @@
+"""
+Full-text search over Post captions and author usernames, backed by a SQLite FTS5 table.
+
+The table is created by migration 0003 and kept in sync by the Post/User signals in PostsApp.models. Bulk
+operations skip signals, use rebuild_search_index (manage.py rebuild_search_index) after them. Only the posts of the
+'default' database are indexed: the table joins them with auth_user, and the other shards of POSTS_SHARDS are not
+searched.
+"""
+import re
+from typing import List
+
+from django.db import DEFAULT_DB_ALIAS, connection
+
+from PostsApp.models import Post
+
+SEARCH_TABLE = 'PostsApp_postsearch'
+SEARCH_RESULTS_LIMIT = 50
+# Best bm25 matches re-ranked by their likes, the likes of the other matches are never counted
+SEARCH_CANDIDATES = 1000
+# bm25 weights for the (caption, username) columns
+CAPTION_WEIGHT = 2.0
+USERNAME_WEIGHT = 1.0
+
+
+def search_available(using: str = DEFAULT_DB_ALIAS) -> bool:
+    """The search table only exists in SQLite (see migration 0003), and only indexes the 'default' database"""
+    return using == DEFAULT_DB_ALIAS and connection.vendor == 'sqlite'
+
+
+def index_post(post: Post) -> None:
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {SEARCH_TABLE} WHERE rowid = %s', [post.pk])
+        cursor.execute(
+            f'INSERT INTO {SEARCH_TABLE}(rowid, caption, username) '
+            f'SELECT %s, %s, username FROM auth_user WHERE id = %s',
+            [post.pk, post.caption, post.author_id])
+
+
+def unindex_post(post: Post) -> None:
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {SEARCH_TABLE} WHERE rowid = %s', [post.pk])
+
+
+def rename_author(user_id: int, username: str) -> None:
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'UPDATE {SEARCH_TABLE} SET username = %s '
+            f'WHERE rowid IN (SELECT id FROM {Post._meta.db_table} WHERE author_id = %s)',
+            [username, user_id])
+
+
+def build_match_query(text: str) -> str:
+    """Turns free text into an FTS5 query where every word is a prefix term (implicit AND)"""
+    return ' '.join(f'"{token}"*' for token in re.findall(r'\w+', text))
+
+
+def search_posts(text: str, limit: int = SEARCH_RESULTS_LIMIT) -> List[Post]:
+    """
+    Posts matching text, best first. The bm25 rank (negative, lower is better) of the SEARCH_CANDIDATES best matches
+    is boosted by the logarithm of their number of likes, so a common term costs as many like counts at most.
+    """
+    match = build_match_query(text)
+    if not match:
+        return []
+    liked_table = Post.liked.through._meta.db_table
+    post_table = Post._meta.db_table
+    with connection.cursor() as cursor:
+        # Deleted posts stay in the index until they are purged
+        cursor.execute(
+            f'SELECT c.id FROM ('
+            f'SELECT {SEARCH_TABLE}.rowid AS id, bm25({SEARCH_TABLE}, {CAPTION_WEIGHT}, {USERNAME_WEIGHT}) AS rank '
+            f'FROM {SEARCH_TABLE} '
+            f'INNER JOIN {post_table} p ON p.id = {SEARCH_TABLE}.rowid AND p.deleted IS NULL '
+            f'WHERE {SEARCH_TABLE} MATCH %s ORDER BY rank LIMIT %s'
+            f') c '
+            f'ORDER BY c.rank * (1 + LN(1 + (SELECT COUNT(*) FROM {liked_table} WHERE post_id = c.id))) '
+            f'LIMIT %s',
+            [match, max(SEARCH_CANDIDATES, limit), limit])
+        post_ids = [row[0] for row in cursor.fetchall()]
+    posts = Post.objects.in_bulk(post_ids)
+    return [posts[post_id] for post_id in post_ids if post_id in posts]
+
+
+def rebuild_search_index() -> int:
+    """Repopulates the search table from scratch and returns the number of indexed posts"""
+    post_table = Post._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {SEARCH_TABLE}')
+        cursor.execute(
+            f'INSERT INTO {SEARCH_TABLE}(rowid, caption, username) '
+            f'SELECT p.id, p.caption, u.username FROM {post_table} p INNER JOIN auth_user u ON u.id = p.author_id '
+            f'WHERE p.deleted IS NULL')
+        indexed = cursor.rowcount
+        cursor.execute(f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}) VALUES ('optimize')")
+    return indexed
@@ -1,6 +1,15 @@
+from typing import Dict, Set, Tuple
+
+from django.db.models import QuerySet
 from rest_framework import serializers
+from rest_framework.permissions import SAFE_METHODS
 
 from PostsApp.app_utils.general_utils import unix_timestamp
+from PostsApp.app_utils.tiering_utils import image_url
+
+# Query parameters of the sparse fieldsets
+FIELDS_PARAM = 'fields'
+OMIT_PARAM = 'omit'
 
 
 class UnixTimestampField(serializers.Field):
@@ -8,4 +17,54 @@ class UnixTimestampField(serializers.Field):
     required for converting Datetime to Int unix timestamps
     """
     def to_representation(self, value):
-        return unix_timestamp(value)
\ No newline at end of file
+        return unix_timestamp(value)
+
+
+class TieredImageField(serializers.ImageField):
+    """
+    ImageField whose URL follows the image to the cold tier (see PostsApp.app_utils.tiering_utils), absolute like
+    the one of ImageField when the context has the request
+    """
+    def to_representation(self, value):
+        if not value:
+            return None
+        return image_url(value.instance, self.context.get('request'))
+
+
+class SparseFieldsetMixin:
+    """
+    Serializer whose readable fields can be chosen in GET requests with ?fields=a,b (only those) or ?omit=a,b (all
+    but those). prune_queryset() then loads only what the selected fields read.
+    """
+    # Model columns read by the fields whose source is not a model field (e.g. SerializerMethodField)
+    field_columns: Dict[str, Tuple[str, ...]] = {}
+
+    def get_fields(self):
+        fields = super().get_fields()
+        selected = self._selected_fields(fields)
+        return {name: field for name, field in fields.items() if field.write_only or name in selected}
+
+    def _selected_fields(self, fields) -> Set[str]:
+        selected = {name for name, field in fields.items() if not field.write_only}
+        request = self.context.get('request')
+        if request is None or request.method not in SAFE_METHODS:
+            return selected
+        readable = set(selected)
+        for param in (FIELDS_PARAM, OMIT_PARAM):
+            if param not in request.query_params:
+                continue
+            names = {name.strip() for name in request.query_params[param].split(',') if name.strip()}
+            unknown = names - readable
+            if unknown:
+                raise serializers.ValidationError({param: f"Unknown fields: {', '.join(sorted(unknown))}"})
+            selected = selected & names if param == FIELDS_PARAM else selected - names
+        return selected
+
+    def prune_queryset(self, queryset: QuerySet) -> QuerySet:
+        """Defers the columns that no selected field reads"""
+        model_fields = {field.name for field in queryset.model._meta.concrete_fields}
+        columns = set()
+        for name, field in self.fields.items():
+            if not field.write_only:
+                columns.update(self.field_columns.get(name, (field.source.split('.')[0],)))
+        return queryset.only(*(columns & model_fields or {'pk'}))
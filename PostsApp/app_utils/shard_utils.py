@@ -0,0 +1,131 @@
+"""
+Horizontal sharding of posts and their likes by author.
+
+POSTS_SHARDS lists the database aliases holding posts: the posts of an author, and the likes of those posts, live in
+POSTS_SHARDS[author_id % len(POSTS_SHARDS)]. Users, profiles and follows stay in 'default'. Post ids are unique
+across shards: the ids of the shard at index i start at i << SHARD_ID_BITS (reserved by reserve_post_ids once the
+shard is migrated), so the shard of a Post is also known from its id.
+
+PostsApp.routers.PostShardRouter sends the writes of a Post, and of its likes, to its shard. Reads that span several
+authors are scattered to the shards and the sorted results of every shard merged (scatter_gather). With a single
+shard every helper returns the query untouched.
+"""
+import heapq
+import itertools
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, TypeVar, Union
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import QuerySet
+
+T = TypeVar('T')
+
+# Models stored in the shards, by model name
+SHARDED_MODELS = {'post', 'postlike'}
+SHARD_ID_BITS = 40
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def get_shards() -> List[str]:
+    return list(settings.POSTS_SHARDS)
+
+
+def shard_for_author(author_id: int) -> str:
+    shards = get_shards()
+    return shards[author_id % len(shards)]
+
+
+def shard_for_post_id(post_id: int) -> str:
+    return get_shards()[post_id >> SHARD_ID_BITS]
+
+
+def reserve_post_ids(alias: str) -> None:
+    """Makes the ids of the posts created in a shard start at the first id of its range"""
+    from PostsApp.models import Post
+    first_id = get_shards().index(alias) << SHARD_ID_BITS
+    if not first_id:
+        return
+    table = Post._meta.db_table
+    connection = connections[alias]
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute('UPDATE sqlite_sequence SET seq = MAX(seq, %s) WHERE name = %s', [first_id, table])
+            if not cursor.rowcount:
+                cursor.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)', [table, first_id])
+        elif connection.vendor == 'postgresql':
+            cursor.execute(f'SELECT setval(pg_get_serial_sequence(%s, \'id\'), '
+                           f'GREATEST(%s, (SELECT COALESCE(MAX(id), 0) FROM "{table}")))', [table, first_id])
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=len(get_shards()), thread_name_prefix='shards')
+        return _executor
+
+
+def _in_shard(alias: str, query: Callable[[str], T]) -> T:
+    try:
+        return query(alias)
+    finally:
+        connections[alias].close()
+
+
+def scatter(query: Callable[[str], T], shards: Optional[Iterable[str]] = None) -> Dict[str, T]:
+    """Runs query(alias) in every shard (or in the given ones), concurrently when there are several"""
+    shards = get_shards() if shards is None else list(shards)
+    if len(shards) == 1:
+        return {shards[0]: query(shards[0])}
+    futures = {alias: _get_executor().submit(_in_shard, alias, query) for alias in shards}
+    return {alias: future.result() for alias, future in futures.items()}
+
+
+def scatter_gather(queryset: QuerySet, key: Callable, reverse: bool = False, limit: Optional[int] = None,
+                   author_ids: Optional[Iterable[int]] = None) -> Union[QuerySet, List]:
+    """
+    Runs queryset in the shards and merges their results, that queryset must sort by key.
+
+    :param limit: number of results, every shard only returns that many
+    :param author_ids: only the posts of these authors, queried only in the shards owning them
+    :return: queryset itself (filtered and sliced) when there is a single shard, otherwise the merged list
+    """
+    shards = get_shards()
+    if len(shards) == 1:
+        if author_ids is not None:
+            queryset = queryset.filter(author_id__in=author_ids)
+        return queryset[:limit] if limit is not None else queryset
+    querysets = {alias: queryset for alias in shards}
+    if author_ids is not None:
+        by_shard = defaultdict(list)
+        for author_id in author_ids:
+            by_shard[shard_for_author(author_id)].append(author_id)
+        querysets = {alias: queryset.filter(author_id__in=ids) for alias, ids in by_shard.items()}
+    if limit is not None:
+        querysets = {alias: shard_queryset[:limit] for alias, shard_queryset in querysets.items()}
+    results = scatter(lambda alias: list(querysets[alias].using(alias)), querysets)
+    return list(itertools.islice(heapq.merge(*results.values(), key=key, reverse=reverse), limit))
+
+
+def get_post(queryset: QuerySet, **lookup):
+    """Post matching lookup (e.g. post_ref) in whatever shard it is, raises Post.DoesNotExist otherwise"""
+    for posts in scatter(lambda alias: list(queryset.using(alias).filter(**lookup)[:1])).values():
+        if posts:
+            return posts[0]
+    raise queryset.model.DoesNotExist()
+
+
+def posts_in_bulk(queryset: QuerySet, post_ids: Iterable[int]) -> Dict[int, T]:
+    """in_bulk of posts spread over the shards, each shard only queried for the ids in its range"""
+    by_shard = defaultdict(list)
+    for post_id in post_ids:
+        by_shard[shard_for_post_id(post_id)].append(post_id)
+    posts = {}
+    for shard_posts in scatter(lambda alias: queryset.using(alias).in_bulk(by_shard[alias]), by_shard).values():
+        posts.update(shard_posts)
+    return posts
@@ -0,0 +1,78 @@
+"""
+"Who to follow" suggestions computed in batch from the follow graph with sparse matrix products.
+
+With A the adjacency matrix of the graph (A[u, v] = 1 if u follows v):
+  - A @ A counts, for each pair (u, w), the users followed by u that follow w (friends of friends)
+  - A.T @ A counts, for each pair (u, w), the users that follow both u and w (common followers)
+
+Rows are processed in blocks so memory stays bounded by the block size and not by the square of the users.
+"""
+from typing import Iterator, Tuple
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from scipy import sparse
+
+from PostsApp.app_utils.general_utils import chunked
+from PostsApp.models import FollowSuggestion, Profile
+
+FRIENDS_OF_FRIENDS_WEIGHT = 1.0
+COMMON_FOLLOWERS_WEIGHT = 0.5
+BLOCK_SIZE = 4096
+CHUNK_SIZE = 5000
+
+
+def load_follow_graph() -> Tuple[np.ndarray, sparse.csr_matrix]:
+    """
+    Reads the through table of Profile.following into a sparse adjacency matrix.
+
+    :return: user ids of the rows/columns (sorted) and the adjacency matrix
+    """
+    edges = Profile.following.through.objects.values_list('profile__user_id', 'user_id').order_by()
+    pairs = np.fromiter((user_id for edge in edges.iterator() for user_id in edge), dtype=np.int64)
+    followers, followed = pairs[0::2], pairs[1::2]
+    user_ids = np.unique(pairs)
+    rows = np.searchsorted(user_ids, followers)
+    columns = np.searchsorted(user_ids, followed)
+    adjacency = sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, columns)),
+                                  shape=(len(user_ids), len(user_ids)))
+    return user_ids, adjacency
+
+
+def top_candidates(user_ids: np.ndarray, adjacency: sparse.csr_matrix,
+                   limit: int) -> Iterator[Tuple[int, int, float]]:
+    """Yields (user id, suggested user id, score) with the best limit candidates of every user"""
+    followers_matrix = adjacency.T.tocsr()
+    for start in range(0, adjacency.shape[0], BLOCK_SIZE):
+        block = adjacency[start:start + BLOCK_SIZE]
+        scores = (FRIENDS_OF_FRIENDS_WEIGHT * (block @ adjacency) +
+                  COMMON_FOLLOWERS_WEIGHT * (followers_matrix[start:start + BLOCK_SIZE] @ adjacency)).tocsr()
+        for offset in range(scores.shape[0]):
+            row = start + offset
+            candidates = scores.indices[scores.indptr[offset]:scores.indptr[offset + 1]]
+            values = scores.data[scores.indptr[offset]:scores.indptr[offset + 1]]
+            followed = block.indices[block.indptr[offset]:block.indptr[offset + 1]]
+            keep = (candidates != row) & ~np.isin(candidates, followed)
+            candidates, values = candidates[keep], values[keep]
+            if len(candidates) > limit:
+                best = np.argpartition(-values, limit)[:limit]
+                candidates, values = candidates[best], values[best]
+            for candidate, value in zip(candidates, values):
+                yield int(user_ids[row]), int(user_ids[candidate]), float(value)
+
+
+def compute_follow_suggestions() -> int:
+    """Replaces every stored suggestion, returns the number of stored suggestions"""
+    user_ids, adjacency = load_follow_graph()
+    stored = 0
+    with transaction.atomic():
+        FollowSuggestion.objects.all().delete()
+        candidates = top_candidates(user_ids, adjacency, settings.POSTS_FOLLOW_SUGGESTIONS)
+        for chunk in chunked(candidates, CHUNK_SIZE):
+            FollowSuggestion.objects.bulk_create([
+                FollowSuggestion(user_id=user_id, suggested_id=suggested_id, score=score)
+                for user_id, suggested_id, score in chunk
+            ])
+            stored += len(chunk)
+    return stored
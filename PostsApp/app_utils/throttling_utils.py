@@ -0,0 +1,210 @@
+"""
+Token bucket rate limiting of the API, without touching the database.
+
+Every client has a bucket: the user for authenticated requests (one per token) and the IP address for anonymous
+ones. A bucket holds up to `burst` tokens and is refilled at `rate` tokens per second, as configured per client
+type in POSTS_THROTTLE_BUCKETS. A request takes the cost of its view, from the throttle_costs of the view by HTTP
+method (1 by default). If the bucket does not have enough tokens, the request is rejected with 429 and Retry-After.
+Every throttled response has the RateLimit-Limit, RateLimit-Remaining and RateLimit-Reset headers (see
+RateLimitHeadersMiddleware).
+
+Buckets are kept by the store configured in POSTS_THROTTLE_BACKEND, both bounded to POSTS_THROTTLE_SLOTS buckets:
+  - LocalBucketStore: in-process, for a single process
+  - MmapBucketStore: a fixed table of buckets in a memory-mapped file, locked with flock, shared by every process
+    on the host (Unix only)
+"""
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import List, NamedTuple, Optional, Tuple
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+from rest_framework.throttling import BaseThrottle
+
+# Client types of POSTS_THROTTLE_BUCKETS
+USER = 'user'
+ANON = 'anon'
+
+
+class Bucket(NamedTuple):
+    allowed: bool
+    # Tokens left after the request
+    remaining: float
+    # Seconds until the request would be allowed (0 if it was)
+    retry_after: float
+    # Seconds until the bucket is full again
+    reset: float
+
+
+def _take(tokens: float, updated: float, now: float, cost: float, burst: float,
+          rate: float) -> Tuple[Bucket, float]:
+    """Refills a bucket with tokens at time updated up to now and takes cost, returns it and the tokens left"""
+    tokens = min(burst, tokens + max(now - updated, 0.0) * rate)
+    allowed = tokens >= cost
+    if allowed:
+        tokens -= cost
+    retry_after = 0.0 if allowed else (cost - tokens) / rate
+    return Bucket(allowed, tokens, retry_after, (burst - tokens) / rate), tokens
+
+
+class BucketStore(ABC):
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    @abstractmethod
+    def take(self, key: str, cost: float, burst: float, rate: float) -> Bucket:
+        """Takes cost tokens from the bucket of key, if it has enough. A new bucket is full"""
+
+    @abstractmethod
+    def clear(self) -> None:
+        """Drops every bucket"""
+
+
+class LocalBucketStore(BucketStore):
+    """
+    Buckets of the process, at most max_buckets (POSTS_THROTTLE_SLOTS by default): past that the least recently
+    updated is dropped, like a slot reused by MmapBucketStore
+    """
+    def __init__(self, max_buckets: Optional[int] = None):
+        super().__init__()
+        self.max_buckets = max_buckets or settings.POSTS_THROTTLE_SLOTS
+        # Least recently updated first
+        self._buckets: 'OrderedDict[str, List[float]]' = OrderedDict()
+
+    def take(self, key: str, cost: float, burst: float, rate: float) -> Bucket:
+        now = time.time()
+        with self._lock:
+            state = self._buckets.get(key)
+            if state is None:
+                state = self._buckets[key] = [burst, now]
+                if len(self._buckets) > self.max_buckets:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            bucket, state[0] = _take(state[0], state[1], now, cost, burst, rate)
+            state[1] = now
+        return bucket
+
+    def clear(self) -> None:
+        with self._lock:
+            self._buckets.clear()
+
+
+class MmapBucketStore(BucketStore):
+    # Slot of a bucket: 64 bits hash of its key (0: free slot), tokens and time of the last update
+    SLOT = struct.Struct('<Qdd')
+    # Slots looked at for a key (open addressing). Without a free one, the least recently updated is reused: a
+    # bucket not updated for a while is (almost) full, like the new one replacing it
+    PROBES = 8
+
+    def __init__(self, path: Optional[str] = None, slots: Optional[int] = None):
+        super().__init__()
+        import fcntl
+        self._fcntl = fcntl
+        self.path = str(path or settings.POSTS_THROTTLE_MMAP_PATH)
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = (slots or settings.POSTS_THROTTLE_SLOTS) * self.SLOT.size
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        # Processes have to agree on the number of slots, the file decides
+        self.slots = os.fstat(self._fd).st_size // self.SLOT.size
+        self._map = mmap.mmap(self._fd, self.slots * self.SLOT.size)
+
+    def take(self, key: str, cost: float, burst: float, rate: float) -> Bucket:
+        # hash() is salted per process, the slot of a key has to be the same in every process
+        key_hash = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little') or 1
+        first = key_hash % self.slots
+        now = time.time()
+        # flock excludes the other processes, not the other threads sharing the file descriptor
+        with self._lock:
+            self._fcntl.flock(self._fd, self._fcntl.LOCK_EX)
+            try:
+                oldest, oldest_updated = 0, math.inf
+                for probe in range(self.PROBES):
+                    offset = (first + probe) % self.slots * self.SLOT.size
+                    slot_hash, tokens, updated = self.SLOT.unpack_from(self._map, offset)
+                    if slot_hash == key_hash:
+                        break
+                    if updated < oldest_updated:
+                        oldest, oldest_updated = offset, updated
+                else:
+                    offset, tokens, updated = oldest, burst, now
+                bucket, tokens = _take(tokens, updated, now, cost, burst, rate)
+                self.SLOT.pack_into(self._map, offset, key_hash, tokens, now)
+            finally:
+                self._fcntl.flock(self._fd, self._fcntl.LOCK_UN)
+        return bucket
+
+    def clear(self) -> None:
+        with self._lock:
+            self._fcntl.flock(self._fd, self._fcntl.LOCK_EX)
+            try:
+                self._map[:] = bytes(len(self._map))
+            finally:
+                self._fcntl.flock(self._fd, self._fcntl.LOCK_UN)
+
+
+_store: Optional[BucketStore] = None
+_store_lock = threading.Lock()
+
+
+def get_bucket_store() -> BucketStore:
+    global _store
+    # Checked before locking, this runs on every request
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = import_string(settings.POSTS_THROTTLE_BACKEND)()
+    return _store
+
+
+def reset_bucket_store() -> None:
+    global _store
+    with _store_lock:
+        _store = None
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """Takes the cost of the view from the bucket of the client, see the module documentation"""
+    bucket: Optional[Bucket] = None
+
+    def allow_request(self, request, view) -> bool:
+        if request.user.is_authenticated:
+            client_type, ident = USER, request.user.pk
+        else:
+            # X-Forwarded-For is only trusted up to REST_FRAMEWORK['NUM_PROXIES'] proxies, clients can not make up
+            # new buckets with it
+            client_type, ident = ANON, self.get_ident(request)
+        burst, rate = settings.POSTS_THROTTLE_BUCKETS[client_type]
+        # A cost above the burst could never be paid
+        cost = min(getattr(view, 'throttle_costs', {}).get(request.method, 1), burst)
+        self.bucket = get_bucket_store().take(f'{client_type}:{ident}', cost, burst, rate)
+        # For the headers of the response, see RateLimitHeadersMiddleware
+        request._request.rate_limit = (burst, self.bucket)
+        return self.bucket.allowed
+
+    def wait(self) -> Optional[float]:
+        return self.bucket.retry_after if self.bucket else None
+
+
+class RateLimitHeadersMiddleware:
+    """Adds the RateLimit-* headers to the responses of the requests that went through TokenBucketThrottle"""
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        rate_limit = getattr(request, 'rate_limit', None)
+        if rate_limit is not None:
+            burst, bucket = rate_limit
+            response['RateLimit-Limit'] = str(burst)
+            response['RateLimit-Remaining'] = str(int(bucket.remaining))
+            response['RateLimit-Reset'] = str(math.ceil(bucket.reset))
+        return response
@@ -0,0 +1,353 @@
+"""
+Hot/cold tiering of the images of posts.
+
+Images start in the hot tier, MEDIA_ROOT, served as they are. The tier_images command moves to the cold tier the
+images of the posts older than POSTS_TIERING_HOT_DAYS, or not accessed in POSTS_TIERING_IDLE_DAYS: they are packed
+in compressed zip files of POSTS_COLD_STORAGE_DIR (standing in for an object storage) and Post.image_pack names the
+pack of each one.
+
+Cold images are served by PostsApp.views.post_image_view, from a warm cache: a directory of rehydrated images bounded
+to POSTS_WARM_CACHE_BYTES, the least recently used evicted first. image_url() gives the URL of the image in whatever
+tier it is, so clients never see the difference.
+
+Packs are not rewritten when their posts are purged: collect_pack_garbage, run with the media garbage collection,
+drops the images no post references anymore and their warm cache copies.
+
+Accesses are sampled: only POSTS_TIERING_SAMPLE_RATE of the image URLs handed out are counted, in memory, and
+appended to the access log of the process in POSTS_TIERING_ACCESS_DIR every POSTS_TIERING_FLUSH_SIZE posts or
+POSTS_TIERING_FLUSH_INTERVAL seconds. Requests never write to the database: tier_images first applies the access logs
+of every process to Post.image_accessed (apply_accesses).
+"""
+import os
+import random
+import shutil
+import threading
+import time
+import uuid
+import zipfile
+from collections import defaultdict
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import IO, Dict, Iterator, List, Optional, Set, Tuple
+
+from django.conf import settings
+from django.db.models import Q
+from django.http import HttpRequest
+from django.urls import reverse
+from django.utils import timezone
+
+from PostsApp.app_utils.general_utils import chunked
+from PostsApp.app_utils.shard_utils import get_shards, scatter, shard_for_post_id
+from PostsApp.models import Post
+
+# Images per pack of the cold tier
+PACK_SIZE = 500
+# Seconds between two refreshes of the recency of a cached image, a hit does not always cost a write
+TOUCH_INTERVAL = 60
+# Fraction of POSTS_WARM_CACHE_BYTES the warm cache is evicted down to, the misses that follow an eviction do not
+# scan the directory again
+WARM_CACHE_LOW_WATER = 0.9
+# Access logs of the processes in POSTS_TIERING_ACCESS_DIR
+ACCESS_LOG_SUFFIX = '.accesses'
+
+
+class AccessSampler:
+    """Sampled accesses to hot images, appended in batches to the access log of the process"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sampled: Set[int] = set()
+        self._flushed = time.monotonic()
+
+    def record(self, post_id: int) -> None:
+        if random.random() >= settings.POSTS_TIERING_SAMPLE_RATE:
+            return
+        with self._lock:
+            self._sampled.add(post_id)
+            if (len(self._sampled) < settings.POSTS_TIERING_FLUSH_SIZE and
+                    time.monotonic() - self._flushed < settings.POSTS_TIERING_FLUSH_INTERVAL):
+                return
+            sampled, self._sampled, self._flushed = self._sampled, set(), time.monotonic()
+        self._append(sampled)
+
+    def flush(self) -> None:
+        with self._lock:
+            sampled, self._sampled, self._flushed = self._sampled, set(), time.monotonic()
+        self._append(sampled)
+
+    @staticmethod
+    def _append(post_ids: Set[int]) -> None:
+        """Appends a line with the current time and post_ids to the access log of the process"""
+        if not post_ids:
+            return
+        directory = Path(settings.POSTS_TIERING_ACCESS_DIR)
+        directory.mkdir(parents=True, exist_ok=True)
+        with open(directory / f'{os.getpid()}{ACCESS_LOG_SUFFIX}', 'a') as file:
+            file.write(' '.join(map(str, (int(time.time()), *sorted(post_ids)))) + '\n')
+
+
+_sampler: Optional[AccessSampler] = None
+_sampler_lock = threading.Lock()
+
+
+def get_access_sampler() -> AccessSampler:
+    global _sampler
+    with _sampler_lock:
+        if _sampler is None:
+            _sampler = AccessSampler()
+        return _sampler
+
+
+def reset_access_sampler() -> None:
+    global _sampler
+    with _sampler_lock:
+        _sampler = None
+
+
+def apply_accesses() -> int:
+    """Writes the access logs of every process to Post.image_accessed, returns the number of updated posts"""
+    get_access_sampler().flush()
+    directory = Path(settings.POSTS_TIERING_ACCESS_DIR)
+    if not directory.is_dir():
+        return 0
+    accessed: Dict[int, int] = {}
+    claimed = []
+    for path in directory.glob(f'*{ACCESS_LOG_SUFFIX}'):
+        # Renamed first, processes appending from now on start a new log
+        claimed_path = path.with_name(f'.{path.name}.{uuid.uuid4().hex}')
+        try:
+            os.replace(path, claimed_path)
+        except FileNotFoundError:
+            continue
+        claimed.append(claimed_path)
+        with open(claimed_path) as file:
+            for line in file:
+                timestamp, *post_ids = map(int, line.split())
+                for post_id in post_ids:
+                    accessed[post_id] = max(accessed.get(post_id, 0), timestamp)
+    by_time = defaultdict(lambda: defaultdict(list))
+    for post_id, timestamp in accessed.items():
+        by_time[timestamp][shard_for_post_id(post_id)].append(post_id)
+    for timestamp, by_shard in by_time.items():
+        accessed_at = datetime.fromtimestamp(timestamp, tz=timezone.utc)
+        for alias, post_ids in by_shard.items():
+            for chunk in chunked(post_ids, PACK_SIZE):
+                Post.all_objects.using(alias).filter(
+                    Q(image_accessed=None) | Q(image_accessed__lt=accessed_at), pk__in=chunk
+                ).update(image_accessed=accessed_at)
+    for path in claimed:
+        os.remove(path)
+    return len(accessed)
+
+
+def image_url(post: Post, request: Optional[HttpRequest] = None, record: bool = True) -> str:
+    """
+    URL of the image of post, from the warm cache when it is in the cold tier. Absolute if request is given.
+
+    :param record: counts the access to a hot image, False when the URL was already handed out for this post
+    """
+    if post.image_pack:
+        url = reverse('post-image-api-v1', args=[post.post_ref])
+    else:
+        if record:
+            get_access_sampler().record(post.pk)
+        url = post.image.url
+    return request.build_absolute_uri(url) if request is not None else url
+
+
+class WarmCache:
+    """
+    Directory of rehydrated cold images bounded to max_bytes. The modification time of a file is the time of its
+    last use, the least recently used files are evicted first, down to WARM_CACHE_LOW_WATER of max_bytes. Every
+    process shares the directory, the size is tracked per process and recomputed whenever it goes over the limit.
+    """
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._size: Optional[int] = None
+
+    def open(self, name: str) -> Optional[IO[bytes]]:
+        """Cached image, None on a miss"""
+        path = self.directory / name
+        try:
+            file = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        if time.time() - os.fstat(file.fileno()).st_mtime > TOUCH_INTERVAL:
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                # Evicted in the meantime, the open file can still be read
+                pass
+        return file
+
+    def put(self, name: str, source: IO[bytes]) -> IO[bytes]:
+        """Caches the content of source as name and returns it open"""
+        path = self.directory / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Written aside and renamed, readers never see a partial image
+        temporary = path.with_name(f'.{path.name}.{uuid.uuid4().hex}')
+        with open(temporary, 'wb') as file:
+            shutil.copyfileobj(source, file)
+            size = file.tell()
+        os.replace(temporary, path)
+        file = open(path, 'rb')
+        with self._lock:
+            self._size = self._scan_size() if self._size is None else self._size + size
+            if self._size > self.max_bytes:
+                self._evict()
+        return file
+
+    def _files(self) -> List[Tuple[float, int, str]]:
+        """(modification time, size, path) of the cached images"""
+        files, directories = [], [str(self.directory)]
+        while directories:
+            with os.scandir(directories.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False) and not entry.name.startswith('.'):
+                        stat = entry.stat(follow_symlinks=False)
+                        files.append((stat.st_mtime, stat.st_size, entry.path))
+        return files
+
+    def _scan_size(self) -> int:
+        return sum(size for _, size, _ in self._files())
+
+    def _evict(self) -> None:
+        files = sorted(self._files())
+        size = sum(file_size for _, file_size, _ in files)
+        low_water = self.max_bytes * WARM_CACHE_LOW_WATER
+        for _, file_size, path in files:
+            if size <= low_water:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= file_size
+        self._size = size
+
+
+_warm_cache: Optional[WarmCache] = None
+_warm_cache_lock = threading.Lock()
+
+
+def get_warm_cache() -> WarmCache:
+    global _warm_cache
+    with _warm_cache_lock:
+        if _warm_cache is None:
+            _warm_cache = WarmCache(settings.POSTS_WARM_CACHE_DIR, settings.POSTS_WARM_CACHE_BYTES)
+        return _warm_cache
+
+
+def reset_warm_cache() -> None:
+    global _warm_cache
+    with _warm_cache_lock:
+        _warm_cache = None
+
+
+def open_image(post: Post) -> IO[bytes]:
+    """Image of post in whatever tier it is, a cold image is rehydrated into the warm cache"""
+    if not post.image_pack:
+        return post.image.open('rb')
+    cache = get_warm_cache()
+    file = cache.open(post.image.name)
+    if file is None:
+        with zipfile.ZipFile(Path(settings.POSTS_COLD_STORAGE_DIR) / post.image_pack) as pack, \
+                pack.open(post.image.name) as source:
+            file = cache.put(post.image.name, source)
+    return file
+
+
+def _pack(posts: List[Post], alias: str) -> int:
+    """Moves the images of posts to a new pack of the cold tier, returns the number of moved images"""
+    directory = Path(settings.POSTS_COLD_STORAGE_DIR)
+    directory.mkdir(parents=True, exist_ok=True)
+    pack_name = f'{uuid.uuid4().hex}.zip'
+    packed = []
+    with zipfile.ZipFile(directory / f'.{pack_name}', 'w', compression=zipfile.ZIP_DEFLATED) as pack:
+        for post in posts:
+            try:
+                pack.write(post.image.path, arcname=post.image.name)
+            except FileNotFoundError:
+                # e.g. removed by hand, there is nothing to move
+                continue
+            packed.append(post)
+    if not packed:
+        os.remove(directory / f'.{pack_name}')
+        return 0
+    # The pack is complete before any post points to it, and hot files are only removed once they do
+    os.replace(directory / f'.{pack_name}', directory / pack_name)
+    Post.all_objects.using(alias).filter(pk__in=[post.pk for post in packed]).update(image_pack=pack_name)
+    for post in packed:
+        post.image.storage.delete(post.image.name)
+    return len(packed)
+
+
+def collect_pack_garbage(cutoff: float, dry_run: bool = False) -> Iterator[str]:
+    """
+    Rewrites the packs of the cold tier without the images no post references (deleted posts included until they
+    are purged), removing the packs left empty, and removes the warm cache copies of those images.
+
+    :param cutoff: only packs last modified before this time are collected, a new pack is complete before its
+                   posts point to it
+    :param dry_run: only lists the images to remove
+    :return: names of the removed images
+    """
+    directory = Path(settings.POSTS_COLD_STORAGE_DIR)
+    if not directory.is_dir():
+        return
+    for path in sorted(directory.glob('*.zip')):
+        # Dot files are packs being written
+        if path.name.startswith('.') or path.stat().st_mtime >= cutoff:
+            continue
+        referenced = set().union(*scatter(
+            lambda shard: list(Post.all_objects.using(shard).filter(image_pack=path.name)
+                               .values_list('image', flat=True))
+        ).values())
+        with zipfile.ZipFile(path) as pack:
+            names = pack.namelist()
+            unreferenced = [name for name in names if name not in referenced]
+            if not unreferenced or dry_run:
+                yield from unreferenced
+                continue
+            if len(unreferenced) < len(names):
+                # Replaced under the same name, posts keep pointing to it and open readers keep the old file
+                temporary = path.with_name(f'.{path.name}.{uuid.uuid4().hex}')
+                with zipfile.ZipFile(temporary, 'w', compression=zipfile.ZIP_DEFLATED) as rewritten:
+                    for name in names:
+                        if name in referenced:
+                            with pack.open(name) as source, rewritten.open(name, 'w') as target:
+                                shutil.copyfileobj(source, target)
+                os.replace(temporary, path)
+            else:
+                os.remove(path)
+        for name in unreferenced:
+            try:
+                os.remove(Path(settings.POSTS_WARM_CACHE_DIR) / name)
+            except FileNotFoundError:
+                pass
+            yield name
+
+
+def tier_images(now: Optional[datetime] = None, pack_size: int = PACK_SIZE) -> Dict[str, int]:
+    """Moves the images of the old or idle posts of every shard to the cold tier, returns the images and packs"""
+    apply_accesses()
+    now = now or timezone.now()
+    idle = now - timedelta(days=settings.POSTS_TIERING_IDLE_DAYS)
+    cold = (Q(created__lt=now - timedelta(days=settings.POSTS_TIERING_HOT_DAYS)) | Q(image_accessed__lt=idle) |
+            Q(image_accessed=None, created__lt=idle))
+    moved, packs = 0, 0
+    for alias in get_shards():
+        candidates = Post.objects.using(alias).filter(cold, image_pack='').exclude(image='').only('image')
+        last_pk = 0
+        while True:
+            posts = list(candidates.filter(pk__gt=last_pk).order_by('pk')[:pack_size])
+            if not posts:
+                break
+            last_pk = posts[-1].pk
+            packed = _pack(posts, alias)
+            moved += packed
+            packs += bool(packed)
+    return {'images': moved, 'packs': packs}
@@ -0,0 +1,77 @@
+"""
+Hacker-News-style trending ranking: score = likes / (age_hours + 2) ** gravity
+
+Scores are precomputed into TrendingPost by the compute_trending command, that is meant to run periodically:
+a full recompute from time to time and cheap incremental updates in between. Every stored score measures the
+age of the post against the same reference time (the one of the last full recompute), so an incremental update
+only has to rescore the posts created or liked since the previous update and the ordering stays consistent.
+Unlikes are not timestamped, they are reflected on the next full recompute.
+"""
+from datetime import datetime, timedelta
+from typing import Optional
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Q, QuerySet
+from django.utils import timezone
+
+from PostsApp.app_utils.general_utils import chunked
+from PostsApp.models import Post, PostLike, TrendingPost, TrendingState
+
+CHUNK_SIZE = 1000
+TRENDING_FEED_LIMIT = 50
+
+
+def trending_score(likes: int, created: datetime, reference_time: datetime) -> float:
+    age_hours = max((reference_time - created).total_seconds(), 0) / 3600
+    return likes / (age_hours + 2) ** settings.POSTS_TRENDING_GRAVITY
+
+
+def trending_posts(limit: int = TRENDING_FEED_LIMIT) -> QuerySet:
+    """Best scored posts, read in order from the index of TrendingPost.score"""
+    return Post.objects.filter(trending__isnull=False).order_by('-trending__score')[:limit]
+
+
+def recompute_trending(now: Optional[datetime] = None) -> int:
+    """Replaces every stored score, returns the number of scored posts"""
+    now = now or timezone.now()
+    with transaction.atomic():
+        TrendingPost.objects.all().delete()
+        scored = _score_posts(_window(Post.objects.all(), now), now)
+        TrendingState.objects.update_or_create(pk=1, defaults={'reference_time': now, 'updated': now})
+    return scored
+
+
+def update_trending(now: Optional[datetime] = None) -> int:
+    """Rescores the posts created or liked since the last update, returns the number of scored posts"""
+    now = now or timezone.now()
+    state = TrendingState.objects.filter(pk=1).first()
+    if state is None:
+        return recompute_trending(now)
+    new_likes = PostLike.objects.filter(created__gt=state.updated).values('post_id')
+    changed = Post.objects.filter(Q(created__gt=state.updated) | Q(pk__in=new_likes))
+    with transaction.atomic():
+        scored = _score_posts(_window(changed, now), state.reference_time, replace=True)
+        state.updated = now
+        state.save(update_fields=['updated'])
+    return scored
+
+
+def _window(posts: QuerySet, now: datetime) -> QuerySet:
+    if settings.POSTS_TRENDING_WINDOW_DAYS is None:
+        return posts
+    return posts.filter(created__gte=now - timedelta(days=settings.POSTS_TRENDING_WINDOW_DAYS))
+
+
+def _score_posts(posts: QuerySet, reference_time: datetime, replace: bool = False) -> int:
+    rows = posts.annotate(likes=Count('liked')).values_list('pk', 'created', 'likes').order_by()
+    scored = 0
+    for chunk in chunked(rows.iterator(), CHUNK_SIZE):
+        if replace:
+            TrendingPost.objects.filter(pk__in=[pk for pk, _, _ in chunk]).delete()
+        TrendingPost.objects.bulk_create([
+            TrendingPost(post_id=pk, score=trending_score(likes, created, reference_time))
+            for pk, created, likes in chunk
+        ])
+        scored += len(chunk)
+    return scored
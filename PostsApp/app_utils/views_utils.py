@@ -1,7 +1,54 @@
+from django.conf import settings
+from django.db.models import QuerySet
+from rest_framework.pagination import CursorPagination
+from rest_framework.parsers import BaseParser
 from rest_framework.response import Response
 
+from PostsApp.app_utils.provisioning_utils import CSV, NDJSON, read_rows
+
 
 class ErrorResponse(Response):
     """For use in API views only"""
     def __init__(self, status, message=None, **kwargs):
-        super().__init__(status=status, data={} if message is None else {'message': message}, **kwargs)
\ No newline at end of file
+        super().__init__(status=status, data={} if message is None else {'message': message}, **kwargs)
+
+
+class SparseFieldsetAPIMixin:
+    """
+    For list views whose serializer is a SparseFieldsetMixin: the queryset is pruned to the fields selected with
+    ?fields= / ?omit=. Views listing plain lists of objects only trim the response.
+    """
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        if isinstance(queryset, QuerySet):
+            queryset = self.get_serializer().prune_queryset(queryset)
+        return queryset
+
+
+class FollowPagination(CursorPagination):
+    """
+    Keyset pagination of the follows of an user, most recent first: the cursor holds the id of the last follow of
+    the page, so every page is read from the index in the same time however many follows come before it.
+    """
+    ordering = '-id'
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+
+    def get_page_size(self, request):
+        self.page_size = settings.POSTS_FOLLOW_PAGE_SIZE
+        return super().get_page_size(request)
+
+
+class NDJSONParser(BaseParser):
+    """Rows of an NDJSON body, read while they are consumed (see provisioning_utils.read_rows)"""
+    media_type = 'application/x-ndjson'
+    data_format = NDJSON
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        return read_rows(stream, self.data_format)
+
+
+class CSVParser(NDJSONParser):
+    """Rows of a CSV body with a header, read while they are consumed"""
+    media_type = 'text/csv'
+    data_format = CSV
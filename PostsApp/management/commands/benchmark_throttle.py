@@ -0,0 +1,46 @@
+import tempfile
+import time
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from PostsApp.app_utils.throttling_utils import TokenBucketThrottle
+
+STORES = {
+    'local': 'PostsApp.app_utils.throttling_utils.LocalBucketStore',
+    'mmap': 'PostsApp.app_utils.throttling_utils.MmapBucketStore',
+}
+
+
+class Command(BaseCommand):
+    help = 'Measures the mean time of a rate limit check (TokenBucketThrottle.allow_request) with every bucket store'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--checks', type=int, default=10000, help='Checks timed per store')
+        parser.add_argument('--store', choices=sorted(STORES), action='append',
+                            help='Store to measure, can be repeated (default: all)')
+
+    def handle(self, *args, **options):
+        request = Request(APIRequestFactory().get('/api/v1/posts/'))
+        request.user = User(pk=1)
+        view = mock.Mock(throttle_costs={'GET': 10})
+        checks = options['checks']
+        for name in options['store'] or sorted(STORES):
+            # A bucket that never runs out, every check takes the same path. The store is a new one, in a
+            # temporary file for the mmap store
+            with tempfile.TemporaryDirectory() as directory, \
+                    override_settings(POSTS_THROTTLE_BACKEND=STORES[name],
+                                      POSTS_THROTTLE_MMAP_PATH=f'{directory}/buckets',
+                                      POSTS_THROTTLE_BUCKETS={'user': (10 ** 9, 1.0), 'anon': (10 ** 9, 1.0)}), \
+                    mock.patch('PostsApp.app_utils.throttling_utils._store', None):
+                throttle = TokenBucketThrottle()
+                throttle.allow_request(request, view)
+                start = time.perf_counter()
+                for _ in range(checks):
+                    throttle.allow_request(request, view)
+                elapsed = (time.perf_counter() - start) / checks
+            self.stdout.write(f'{name}: {elapsed * 1e6:.1f}µs per check ({checks} checks)')
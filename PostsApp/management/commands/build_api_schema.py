@@ -0,0 +1,19 @@
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from PostsApp.api_schema import generate_schema, write_schema
+
+
+class Command(BaseCommand):
+    help = 'Generates the OpenAPI schema of the API into API_SCHEMA_DIR, to be served prebuilt'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default=None, help='Base URL of the API to include in the schema')
+        parser.add_argument('--output-dir', default=settings.API_SCHEMA_DIR,
+                            help='Directory of the schema artifacts (default: API_SCHEMA_DIR)')
+
+    def handle(self, *args, **options):
+        version = write_schema(generate_schema(options['url']), Path(options['output_dir']))
+        self.stdout.write(self.style.SUCCESS(f"Schema version {version} written to {options['output_dir']}"))
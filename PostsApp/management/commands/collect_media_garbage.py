@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from PostsApp.app_utils.purge_utils import collect_media_garbage
+
+
+class Command(BaseCommand):
+    help = 'Removes the media files and the images of the cold tier packs that are not the image of any post'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-age', type=float, default=60 * 60,
+                            help='Only remove files not modified in this number of seconds (default: 1 hour)')
+        parser.add_argument('--dry-run', action='store_true', help='List the files without removing them')
+
+    def handle(self, *args, **options):
+        removed = 0
+        for name in collect_media_garbage(options['min_age'], options['dry_run']):
+            removed += 1
+            if options['verbosity'] > 1 or options['dry_run']:
+                self.stdout.write(name)
+        verb = 'Would remove' if options['dry_run'] else 'Removed'
+        self.stdout.write(self.style.SUCCESS(f'{verb} {removed} files'))
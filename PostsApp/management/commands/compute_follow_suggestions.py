@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from PostsApp.app_utils.suggestion_utils import compute_follow_suggestions
+
+
+class Command(BaseCommand):
+    help = 'Precomputes the "who to follow" suggestions of every user from the follow graph'
+
+    def handle(self, *args, **options):
+        stored = compute_follow_suggestions()
+        self.stdout.write(self.style.SUCCESS(f'Stored {stored} suggestions'))
@@ -0,0 +1,28 @@
+from PIL import Image
+from django.core.management.base import BaseCommand
+
+from PostsApp.app_utils.image_utils import dhash
+from PostsApp.app_utils.phash_utils import reset_phash_index
+from PostsApp.app_utils.tiering_utils import open_image
+from PostsApp.models import Post
+
+
+class Command(BaseCommand):
+    help = 'Computes the perceptual hash of the posts that do not have one (posts created before hashing existed)'
+
+    def handle(self, *args, **options):
+        hashed, failed = 0, 0
+        posts = Post.objects.filter(phash=None).only('pk', 'image', 'image_pack').order_by()
+        for post in posts.iterator():
+            try:
+                with open_image(post) as file, Image.open(file) as image:
+                    phash = dhash(image)
+            except (OSError, ValueError) as e:
+                self.stderr.write(f'{post.pk}: {e}')
+                failed += 1
+                continue
+            # update() does not send post_save, the rest of the Post is untouched
+            Post.objects.filter(pk=post.pk).update(phash=phash)
+            hashed += 1
+        reset_phash_index()
+        self.stdout.write(self.style.SUCCESS(f'Hashed {hashed} posts, {failed} failed'))
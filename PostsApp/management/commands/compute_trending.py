@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from PostsApp.app_utils.trending_utils import recompute_trending, update_trending
+
+
+class Command(BaseCommand):
+    help = 'Precomputes the trending scores of posts (full recompute, or incremental with --incremental)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--incremental', action='store_true',
+                            help='Only rescore the posts created or liked since the last run')
+
+    def handle(self, *args, **options):
+        scored = update_trending() if options['incremental'] else recompute_trending()
+        self.stdout.write(self.style.SUCCESS(f'Scored {scored} posts'))
@@ -0,0 +1,25 @@
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+
+from PostsApp.app_utils.graph_utils import GRAPH_CHUNK_SIZE, TABLE_NAMES, export_graph
+
+
+class Command(BaseCommand):
+    help = 'Exports users, tokens, profiles, follows, posts and likes to one NDJSON file per table (without images)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help='Directory of the files')
+        parser.add_argument('--tables', nargs='+', choices=TABLE_NAMES, help='Tables to export (default: all)')
+        parser.add_argument('--resume', action='store_true',
+                            help='Continue the files of an interrupted export after their last row')
+        parser.add_argument('--workers', type=int, help='Tables exported at once (default: all)')
+        parser.add_argument('--chunk-size', type=int, default=GRAPH_CHUNK_SIZE,
+                            help='Rows fetched from the database at a time')
+
+    def handle(self, *args, **options):
+        exported = export_graph(Path(options['directory']), options['tables'], options['resume'],
+                                options['workers'], options['chunk_size'])
+        for name in TABLE_NAMES:
+            if name in exported:
+                self.stdout.write(self.style.SUCCESS(f'Exported {exported[name]} {name}'))
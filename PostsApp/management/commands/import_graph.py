@@ -0,0 +1,60 @@
+import threading
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from PostsApp.app_utils.graph_utils import GRAPH_CHUNK_SIZE, TABLE_NAMES, import_graph
+from PostsApp.app_utils.search_utils import rebuild_search_index, search_available
+
+
+def _offset(value: str):
+    table, _, rows = value.partition('=')
+    if table not in TABLE_NAMES or not rows.isdigit():
+        raise ValueError(value)
+    return table, int(rows)
+
+
+class Command(BaseCommand):
+    help = 'Imports the NDJSON files written by export_graph'
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help='Directory of the files')
+        parser.add_argument('--tables', nargs='+', choices=TABLE_NAMES, help='Tables to import (default: all)')
+        parser.add_argument('--offset', type=_offset, action='append', default=[], metavar='TABLE=ROWS',
+                            help='Skip the first rows of the file of a table, e.g. those imported by an interrupted '
+                                 'run (repeatable)')
+        parser.add_argument('--workers', type=int, help='Tables imported at once (default: all)')
+        parser.add_argument('--chunk-size', type=int, default=GRAPH_CHUNK_SIZE, help='Rows inserted per transaction')
+
+    def handle(self, *args, **options):
+        offsets = dict(options['offset'])
+        imported_rows = dict(offsets)
+        dangling_rows = {}
+        lock = threading.Lock()
+
+        def progress(table: str, rows: int):
+            with lock:
+                imported_rows[table] = rows
+                if options['verbosity'] > 1:
+                    self.stdout.write(f'{table}: {rows} rows')
+
+        def dangling(table: str, rows: int):
+            with lock:
+                dangling_rows[table] = rows
+
+        try:
+            imported = import_graph(Path(options['directory']), options['tables'], offsets, options['workers'],
+                                    options['chunk_size'], progress, dangling)
+        except Exception as e:
+            resume = ' '.join(f'--offset {table}={rows}' for table, rows in imported_rows.items())
+            raise CommandError(f'{e}. Rows committed so far: {resume or "none"}') from e
+        for name in TABLE_NAMES:
+            if name in imported:
+                self.stdout.write(self.style.SUCCESS(f'Imported {imported[name]} {name}'))
+            if name in dangling_rows:
+                self.stdout.write(self.style.WARNING(
+                    f'Skipped {dangling_rows[name]} {name} referencing rows missing from the export'))
+        if 'posts' in imported and search_available():
+            with transaction.atomic():
+                rebuild_search_index()
@@ -0,0 +1,28 @@
+import sys
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+
+from PostsApp.app_utils.provisioning_utils import CSV, NDJSON, provision_users, read_rows
+
+
+class Command(BaseCommand):
+    help = ('Creates users in bulk from an NDJSON or CSV (with a header) file with username, password and '
+            'optionally email, first_name and last_name')
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help='File to read, - for the standard input')
+        parser.add_argument('--format', choices=(NDJSON, CSV),
+                            help='Format of the file (default: csv for .csv files, ndjson otherwise)')
+        parser.add_argument('--chunk-size', type=int, help='Users inserted per transaction')
+        parser.add_argument('--workers', type=int, help='Processes hashing passwords (default: one per CPU)')
+
+    def handle(self, *args, **options):
+        path = options['file']
+        data_format = options['format'] or (CSV if Path(path).suffix.lower() == '.csv' else NDJSON)
+        stream = sys.stdin.buffer if path == '-' else open(path, 'rb')
+        with stream:
+            result = provision_users(read_rows(stream, data_format), options['chunk_size'], options['workers'])
+        for error in result.errors:
+            self.stderr.write(f'Row {error.row} ({error.username}): {error.error}')
+        self.stdout.write(self.style.SUCCESS(f'Created {result.created} users, skipped {len(result.errors)} rows'))
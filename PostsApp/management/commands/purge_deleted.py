@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from PostsApp.app_utils.purge_utils import PURGE_BATCH_SIZE, purge_deleted
+
+
+class Command(BaseCommand):
+    help = 'Purges the deleted posts and accounts, in transactions of a bounded number of rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=PURGE_BATCH_SIZE,
+                            help='Maximum number of rows deleted in a transaction')
+
+    def handle(self, *args, **options):
+        purged = purge_deleted(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Purged {purged['posts']} posts, {purged['users']} users and {purged['likes']} likes"))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from PostsApp.app_utils.search_utils import rebuild_search_index, search_available
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the full-text search index of posts'
+
+    def handle(self, *args, **options):
+        if not search_available():
+            raise CommandError('Full-text search needs SQLite')
+        with transaction.atomic():
+            indexed = rebuild_search_index()
+        self.stdout.write(self.style.SUCCESS(f'Indexed {indexed} posts'))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from PostsApp.app_utils.tiering_utils import PACK_SIZE, tier_images
+
+
+class Command(BaseCommand):
+    help = 'Moves the images of old or idle posts from MEDIA_ROOT to the packs of the cold tier'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pack-size', type=int, default=PACK_SIZE, help='Images per pack')
+
+    def handle(self, *args, **options):
+        moved = tier_images(pack_size=options['pack_size'])
+        self.stdout.write(self.style.SUCCESS(f"Moved {moved['images']} images to {moved['packs']} packs"))
@@ -0,0 +1,38 @@
+from django.db import migrations
+
+SEARCH_TABLE = 'PostsApp_postsearch'
+
+CREATE_SQL = [
+    f"""
+    CREATE VIRTUAL TABLE {SEARCH_TABLE} USING fts5(caption, username, tokenize = 'unicode61', prefix = '2 3')
+    """,
+    f"""
+    INSERT INTO {SEARCH_TABLE}(rowid, caption, username)
+    SELECT p.id, p.caption, u.username FROM PostsApp_post p INNER JOIN auth_user u ON u.id = p.author_id
+    """,
+]
+
+DROP_SQL = [
+    f'DROP TABLE IF EXISTS {SEARCH_TABLE}',
+]
+
+
+def _run_sqlite(statements):
+    def run(apps, schema_editor):
+        # FTS5 virtual tables only exist in SQLite
+        if schema_editor.connection.vendor != 'sqlite':
+            return
+        for statement in statements:
+            schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('PostsApp', '0002_post_image_metadata'),
+    ]
+
+    operations = [
+        migrations.RunPython(_run_sqlite(CREATE_SQL), _run_sqlite(DROP_SQL)),
+    ]
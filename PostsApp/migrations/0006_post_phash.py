@@ -0,0 +1,18 @@
+# Generated by Django 3.1.2 on 2026-10-19 13:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('PostsApp', '0005_follow_suggestion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='phash',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.1.2 on 2026-10-19 13:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('PostsApp', '0006_post_phash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='deleted',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='deleted',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -0,0 +1,26 @@
+from django.db import migrations
+
+FOLLOW_TABLE = 'PostsApp_profile_following'
+
+# Covering indexes of the keyset pagination of followers and following (see FollowListAPI): the follows of a page are
+# read in order of id from the index alone, without visiting the table
+CREATE_SQL = [
+    f'CREATE INDEX "{FOLLOW_TABLE}_followers" ON "{FOLLOW_TABLE}" (user_id, id, profile_id)',
+    f'CREATE INDEX "{FOLLOW_TABLE}_following" ON "{FOLLOW_TABLE}" (profile_id, id, user_id)',
+]
+
+DROP_SQL = [
+    f'DROP INDEX IF EXISTS "{FOLLOW_TABLE}_followers"',
+    f'DROP INDEX IF EXISTS "{FOLLOW_TABLE}_following"',
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('PostsApp', '0008_unconstrained_author'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_SQL, DROP_SQL),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.1.2 on 2026-10-19 13:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('PostsApp', '0009_follow_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='image_accessed',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='image_pack',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+    ]
@@ -2,14 +2,16 @@ import uuid
 
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone
 
-from django.db.models.signals import m2m_changed, post_save
+from django.db.models.signals import m2m_changed, post_delete, post_migrate, post_save
 from django.dispatch import receiver
 from rest_framework.authtoken.models import Token
 
 from PostsApp.app_utils.exceptions import FollowException, LikeException
 from PostsApp.app_utils.general_utils import disable_for_loaddata
+from PostsApp.app_utils.shard_utils import get_shards, reserve_post_ids, shard_for_author
 
 
 class Profile(models.Model):
@@ -19,6 +21,8 @@ class Profile(models.Model):
     """
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='profile')
     following = models.ManyToManyField(User, related_name='followers', blank=True)
+    # Set when the account is deleted, its rows are purged later by the purge_deleted command
+    deleted = models.DateTimeField(null=True, blank=True, db_index=True)
 
     @property
     def following_number(self):
@@ -48,13 +52,34 @@ class Profile(models.Model):
 
     def likes(self, post: 'Post') -> bool:
         """Indicates if the owner of the profile likes a post"""
-        return self.user in post.liked.all()
+        # Through the likes, read in the shard of the post: post.liked joins the users, which are in 'default'
+        return post.postlike_set.filter(user_id=self.user_id).exists()
+
+    def soft_delete(self) -> None:
+        """
+        Deletes the account right away: the user can not log in anymore and its posts disappear. Likes, follows
+        and the rows themselves are purged in batches by the purge_deleted command.
+        """
+        now = timezone.now()
+        shard = shard_for_author(self.user_id)
+        # The posts are in the shard of the author, which may be another database
+        with transaction.atomic(), transaction.atomic(using=shard):
+            Profile.objects.filter(pk=self.pk).update(deleted=now)
+            User.objects.filter(pk=self.user_id).update(is_active=False)
+            Token.objects.filter(user_id=self.user_id).delete()
+            Post.objects.using(shard).filter(author_id=self.user_id).update(deleted=now)
+        self.deleted = now
+        self.user.is_active = False
 
     def __str__(self) -> str:
         return self.user.username
 
 
 class PostManager(models.Manager):
+    """Posts that are not deleted. Post.all_objects also returns the deleted ones until they are purged"""
+    def get_queryset(self) -> models.QuerySet:
+        return super().get_queryset().filter(deleted__isnull=True)
+
     def get_by_natural_key(self, post_ref: str) -> 'Post':
         return self.get(post_ref=post_ref)
 
@@ -64,25 +89,89 @@ class Post(models.Model):
     This Model represent a Post. It's considered that a Post only contains one image.
     """
     post_ref = models.CharField(max_length=100, blank=True, unique=True, default=uuid.uuid4, db_index=True)
-    author = models.ForeignKey(User, related_name='posts', on_delete=models.CASCADE, db_index=True)
+    # Posts may be in another database than their author (see PostsApp.app_utils.shard_utils)
+    author = models.ForeignKey(User, related_name='posts', on_delete=models.CASCADE, db_index=True,
+                               db_constraint=False)
     caption = models.CharField(max_length=20)
     created = models.DateTimeField(auto_now=True, db_index=True)
-    liked = models.ManyToManyField(User, blank=True, related_name='likers')
+    liked = models.ManyToManyField(User, blank=True, related_name='likers', through='PostLike')
     image = models.ImageField()
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    format = models.CharField(max_length=10, blank=True)
+    bytes = models.PositiveIntegerField(null=True, blank=True)
+    phash = models.BigIntegerField(null=True, blank=True)
+    # Pack of the cold tier holding the image, empty while it is in MEDIA_ROOT (see PostsApp.app_utils.tiering_utils)
+    image_pack = models.CharField(max_length=100, blank=True)
+    # Last sampled access to the image while it is in MEDIA_ROOT
+    image_accessed = models.DateTimeField(null=True, blank=True)
+    # Set when the Post is deleted, it is purged later by the purge_deleted command
+    deleted = models.DateTimeField(null=True, blank=True, db_index=True)
 
     index_together = ['created', 'liked']
 
     objects = PostManager()
+    all_objects = models.Manager()
 
     @property
     def liked_number(self) -> int:
         """Number of users that like this Post"""
-        return self.liked.count()
+        # Counted in the shard of the Post, see Profile.likes
+        return self.postlike_set.count()
+
+    def soft_delete(self) -> None:
+        """Hides the Post right away, its likes and the row itself are purged by the purge_deleted command"""
+        self.deleted = timezone.now()
+        # Not save(): the search index and the events do not have to follow this change
+        Post.all_objects.using(self._state.db).filter(pk=self.pk).update(deleted=self.deleted)
 
     def __str__(self) -> str:
         return f'{self.author}: {self.post_ref}'
 
 
+class PostLike(models.Model):
+    """
+    Through table of Post.liked. It keeps the table of the former auto-created relation and adds the time of
+    the like, used to update the trending ranking incrementally.
+    """
+    post = models.ForeignKey(Post, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_constraint=False)
+    created = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        db_table = 'PostsApp_post_liked'
+        unique_together = ('post', 'user')
+
+    def __str__(self) -> str:
+        return f'{self.user}: {self.post}'
+
+
+class TrendingPost(models.Model):
+    """Precomputed trending score of a Post (see PostsApp.app_utils.trending_utils)"""
+    post = models.OneToOneField(Post, primary_key=True, related_name='trending', on_delete=models.CASCADE)
+    score = models.FloatField(db_index=True)
+
+
+class TrendingState(models.Model):
+    """
+    Single row with the bookkeeping of the trending job: the reference time of the last full recompute (ages of
+    every stored score are measured against it) and the time of the last update, full or incremental.
+    """
+    reference_time = models.DateTimeField()
+    updated = models.DateTimeField()
+
+
+class FollowSuggestion(models.Model):
+    """Precomputed "who to follow" candidate for an User (see PostsApp.app_utils.suggestion_utils)"""
+    user = models.ForeignKey(User, related_name='follow_suggestions', on_delete=models.CASCADE)
+    suggested = models.ForeignKey(User, related_name='suggested_to', on_delete=models.CASCADE)
+    score = models.FloatField()
+
+    class Meta:
+        unique_together = ('user', 'suggested')
+        index_together = ('user', 'score')
+
+
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
 def create_auth_token(sender, instance=None, created=False, **kwargs):
     """With this signal we ensure that any new user has a REST token"""
@@ -98,19 +187,86 @@ def create_profile(sender, instance=None, created=False, **kwargs):
         Profile.objects.get_or_create(user=instance)
 
 
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def update_search_username(sender, instance=None, created=False, update_fields=None, **kwargs):
+    """Keeps the author username of the search index up to date"""
+    if created or (update_fields is not None and 'username' not in update_fields):
+        return
+    from PostsApp.app_utils.search_utils import rename_author, search_available
+    if search_available():
+        rename_author(instance.pk, instance.username)
+
+
+@receiver(post_save, sender=Post)
+def update_search_index(sender, instance=None, **kwargs):
+    """Adds or refreshes the Post in the search index"""
+    from PostsApp.app_utils.search_utils import index_post, search_available
+    if search_available(kwargs['using']):
+        index_post(instance)
+
+
+@receiver(post_delete, sender=Post)
+def remove_from_search_index(sender, instance=None, **kwargs):
+    """Removes the Post from the search index"""
+    from PostsApp.app_utils.search_utils import search_available, unindex_post
+    if search_available(kwargs['using']):
+        unindex_post(instance)
+
+
+@receiver(post_save, sender=Post)
+@disable_for_loaddata
+def publish_post_created(sender, instance=None, created=False, **kwargs):
+    """Streams new Posts to the followers of the author"""
+    if created:
+        from PostsApp.app_utils.events_utils import POST_CREATED, publish_event
+        data = {'post_ref': str(instance.post_ref), 'author': instance.author_id, 'caption': instance.caption}
+        transaction.on_commit(lambda: publish_event(POST_CREATED, data))
+
+
+@receiver(post_save, sender=Post)
+def update_phash_index(sender, instance=None, created=False, **kwargs):
+    """Adds the image hash of new Posts to the near duplicates index of this process"""
+    if created:
+        from PostsApp.app_utils.phash_utils import index_post_phash
+        index_post_phash(instance)
+
+
+@receiver(post_delete, sender=Post)
+def remove_from_phash_index(sender, instance=None, **kwargs):
+    """Removes the Post from the near duplicates index of this process"""
+    from PostsApp.app_utils.phash_utils import unindex_post_phash
+    unindex_post_phash(instance)
+
+
 @receiver(m2m_changed, sender=Profile.following.through)
 def followers_changed(sender, **kwargs):
     """This signal avoid that an User follows himself.
 
     :raise: FollowException if User try to like himself
     """
-    if kwargs['action'] == 'pre_add':
-        user = kwargs['instance']
+    if kwargs['action'] == 'pre_add' and not kwargs['reverse']:
+        # The instance is the Profile and pk_set the followed Users
+        profile = kwargs['instance']
         pk_set = kwargs['pk_set']
-        if user.pk in pk_set:
+        if profile.user_id in pk_set:
             raise FollowException('User can not follow himself')
 
 
+@receiver(m2m_changed, sender=Profile.following.through)
+def publish_following_changed(sender, instance=None, action=None, reverse=False, pk_set=None, **kwargs):
+    """Lets the open event streams of the affected users reload who they follow"""
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    from PostsApp.app_utils.events_utils import FOLLOWING_CHANGED, publish_event
+    if reverse:
+        # In the reverse side the instance is an User and pk_set the Profiles
+        user_ids = Profile.objects.filter(pk__in=pk_set or ()).values_list('user_id', flat=True)
+    else:
+        user_ids = [instance.user_id]
+    for user_id in user_ids:
+        transaction.on_commit(lambda user_id=user_id: publish_event(FOLLOWING_CHANGED, {'user': user_id}))
+
+
 @receiver(m2m_changed, sender=Post.liked.through)
 def liked_changed(sender, **kwargs):
     """This signal avoid that an User can like his own posts
@@ -122,3 +278,23 @@ def liked_changed(sender, **kwargs):
         pk_set = kwargs['pk_set']
         if post.author_id in pk_set:
             raise LikeException('User can not like his own post')
+
+
+@receiver(m2m_changed, sender=Post.liked.through)
+def publish_likes_changed(sender, instance=None, action=None, reverse=False, pk_set=None, **kwargs):
+    """
+    Streams that the like count of the Post changed (only for changes made from the Post side, e.g.
+    Profile.like_post). The count is read by the streams that deliver the event (PostsApp.sse), not on every like
+    """
+    if action not in ('post_add', 'post_remove', 'post_clear') or reverse:
+        return
+    from PostsApp.app_utils.events_utils import LIKES_CHANGED, publish_event
+    data = {'post_ref': str(instance.post_ref), 'author': instance.author_id}
+    transaction.on_commit(lambda: publish_event(LIKES_CHANGED, data))
+
+
+@receiver(post_migrate)
+def reserve_shard_post_ids(sender, using=None, **kwargs):
+    """Makes the ids of the posts of a newly migrated shard start at the first id of its range"""
+    if sender.name == 'PostsApp' and using in get_shards():
+        reserve_post_ids(using)
@@ -0,0 +1,42 @@
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+from PostsApp.app_utils.shard_utils import SHARDED_MODELS, shard_for_author
+
+
+def _shard(model, instance):
+    if instance is None:
+        return None
+    if model._meta.model_name not in SHARDED_MODELS and instance._meta.model_name in SHARDED_MODELS:
+        # e.g. the author of a Post: everything else stays in 'default'. So do the users of Post.liked, whose reads
+        # join the likes of the shard with the users and can not be routed: read the likes with post.postlike_set,
+        # which goes to the shard of the Post
+        return DEFAULT_DB_ALIAS
+    if model._meta.model_name == 'post' and instance._meta.label == settings.AUTH_USER_MODEL:
+        # Posts of an user (user.posts) or author set on a new Post
+        return shard_for_author(instance.pk)
+    if instance._meta.model_name == 'post':
+        # Likes of a Post (post.postlike_set, post.liked.add), or a new Post
+        return instance._state.db or shard_for_author(instance.author_id)
+    # Rows read from a shard are written back to it by Django itself
+    return None
+
+
+class PostShardRouter:
+    """
+    Sends posts and likes to the shard of their author (see PostsApp.app_utils.shard_utils).
+
+    Only the queries with an instance hint can be routed: the others go to 'default', and queries spanning authors
+    have to use scatter_gather.
+    """
+    def db_for_read(self, model, **hints):
+        return _shard(model, hints.get('instance'))
+
+    def db_for_write(self, model, **hints):
+        return _shard(model, hints.get('instance'))
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Posts and likes reference the users of 'default'
+        if {obj1._meta.model_name, obj2._meta.model_name} & SHARDED_MODELS:
+            return True
+        return None
@@ -1,19 +1,29 @@
 from django.contrib.auth.models import User
+from django.db import models
+from django.db.models import Case, Count, IntegerField, OuterRef, QuerySet, Subquery, When
+from django.db.models.functions import Coalesce
 from rest_framework import serializers
 
-from PostsApp.app_utils.serializers_utils import UnixTimestampField
-from PostsApp.models import Post
+from PostsApp.app_utils.exceptions import ImageIngestException
+from PostsApp.app_utils.serializers_utils import SparseFieldsetMixin, TieredImageField, UnixTimestampField
+from PostsApp.app_utils.tiering_utils import image_url
+from PostsApp.models import Post, Profile
 
 
-class ImageSerializer(serializers.ModelSerializer):
+class ImageSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    serializer_field_mapping = {**serializers.ModelSerializer.serializer_field_mapping,
+                                models.ImageField: TieredImageField}
     image_url = serializers.SerializerMethodField('get_image_url', read_only=True)
+    field_columns = {'image': ('image', 'image_pack', 'post_ref'), 'image_url': ('image', 'image_pack', 'post_ref')}
 
     def get_image_url(self, obj: Post):
-        return obj.image.url
+        # The access is counted once per post, by the image field when it is selected too
+        return image_url(obj, self.context.get('request'), record='image' not in self.fields)
 
     class Meta:
         model = Post
-        fields = ('caption', 'image', 'image_url')
+        fields = ('caption', 'image', 'image_url', 'width', 'height')
+        read_only_fields = ('width', 'height')
 
 
 class PostSerializer(ImageSerializer):
@@ -22,7 +32,9 @@ class PostSerializer(ImageSerializer):
 
     class Meta:
         model = Post
-        fields = ('post_ref', 'created', 'created_timestamp', 'author', 'caption', 'image', 'image_url')
+        fields = ('post_ref', 'created', 'created_timestamp', 'author', 'caption', 'image', 'image_url', 'width',
+                  'height')
+        read_only_fields = ('width', 'height')
         extra_kwargs = {
             'post_ref ': {'read_only': True},
             'author ': {'required': False},
@@ -32,17 +44,60 @@ class PostSerializer(ImageSerializer):
         data['author'] = self.context['author']
         return super(PostSerializer, self).to_internal_value(data)
 
+    def create(self, validated_data):
+        # Saved from the instance, so PostShardRouter stores it in the shard of its author
+        post = Post(**validated_data)
+        post.save(force_insert=True)
+        return post
 
-class UserSerializer(serializers.ModelSerializer):
+    def validate(self, attrs):
+        """Normalizes the uploaded image and stores its metadata so it never has to be reopened"""
+        if 'image' in attrs:
+            # Pillow and NumPy are only loaded by the workers that receive uploads
+            from PostsApp.app_utils.image_utils import ingest_image
+            try:
+                ingested = ingest_image(attrs['image'])
+            except ImageIngestException as e:
+                raise serializers.ValidationError({'image': [str(e)]})
+            attrs.update(image=ingested.file, width=ingested.width, height=ingested.height,
+                         format=ingested.format, bytes=ingested.bytes, phash=ingested.phash)
+        return attrs
+
+
+def _profile_count(follows: QuerySet, group_by: str):
+    """Number of rows of follows per user as a correlated subquery, None for users without a Profile"""
+    count = Subquery(follows.order_by().values(group_by).annotate(count=Count('*')).values('count'),
+                     output_field=IntegerField())
+    return Case(When(profile__isnull=True, then=None), default=Coalesce(count, 0), output_field=IntegerField())
+
+
+class UserSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     followers_number = serializers.SerializerMethodField(read_only=True)
     following_number = serializers.SerializerMethodField(read_only=True)
+    field_columns = {'followers_number': (), 'following_number': ()}
 
     def get_followers_number(self, obj: User):
+        if hasattr(obj, 'followers_count'):
+            return obj.followers_count
         return obj.profile.followers_number if hasattr(obj, 'profile') else None
 
     def get_following_number(self, obj: User):
+        if hasattr(obj, 'following_count'):
+            return obj.following_count
         return obj.profile.following_number if hasattr(obj, 'profile') else None
 
+    def prune_queryset(self, queryset: QuerySet) -> QuerySet:
+        """Counts the follows of every listed user in the same query, only for the selected counts"""
+        queryset = super().prune_queryset(queryset)
+        follows = Profile.following.through.objects
+        if 'followers_number' in self.fields:
+            queryset = queryset.annotate(
+                followers_count=_profile_count(follows.filter(user_id=OuterRef('pk')), 'user_id'))
+        if 'following_number' in self.fields:
+            queryset = queryset.annotate(
+                following_count=_profile_count(follows.filter(profile__user_id=OuterRef('pk')), 'profile_id'))
+        return queryset
+
     class Meta:
         model = User
         fields = ('username', 'followers_number', 'following_number', 'password')
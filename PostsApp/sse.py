@@ -0,0 +1,146 @@
+"""
+Server-Sent Events stream of realtime updates, served straight from the ASGI application (hedgehogLab.asgi)
+instead of a Django view, so an open stream does not hold a worker thread.
+
+GET /api/v1/events/ with the "Authorization: Token <key>" header, or ?token=<key> for browsers' EventSource:
+  - event "post": new post of an author followed by the user
+  - event "likes": the like count of a post of the user or of an author they follow changed
+
+A heartbeat comment is sent after POSTS_EVENTS_HEARTBEAT seconds without events, and a client reconnecting with
+the Last-Event-ID header (or ?last_event_id=) first receives the buffered events it missed.
+"""
+import asyncio
+import json
+from collections import OrderedDict
+from typing import Dict, Optional, Set
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from rest_framework.authtoken.models import Token
+
+from PostsApp.app_utils.events_utils import (FOLLOWING_CHANGED, LIKES_CHANGED, POST_CREATED, Event, Subscriber,
+                                             get_event_backend)
+from PostsApp.app_utils.shard_utils import shard_for_author
+from PostsApp.models import PostLike, Profile
+
+EVENTS_PATH = '/api/v1/events/'
+
+# Like counts of the last "likes" events delivered by this process, by event id: counted once for all its streams
+_like_counts: 'OrderedDict[int, int]' = OrderedDict()
+
+
+def _authenticate(key: Optional[str]) -> Optional[int]:
+    close_old_connections()
+    try:
+        token = Token.objects.select_related('user').get(key=key)
+    except Token.DoesNotExist:
+        return None
+    finally:
+        close_old_connections()
+    return token.user_id if token.user.is_active else None
+
+
+def _following(user_id: int) -> Set[int]:
+    close_old_connections()
+    try:
+        return set(Profile.following.through.objects.filter(profile__user_id=user_id)
+                   .values_list('user_id', flat=True))
+    finally:
+        close_old_connections()
+
+
+def _count_likes(post_ref: str, author_id: int) -> int:
+    close_old_connections()
+    try:
+        return PostLike.objects.using(shard_for_author(author_id)).filter(post__post_ref=post_ref).count()
+    finally:
+        close_old_connections()
+
+
+async def _with_likes(event: Event) -> Event:
+    """The "likes" event with the like count of its post"""
+    likes = _like_counts.get(event.id)
+    if likes is None:
+        likes = await sync_to_async(_count_likes, thread_sensitive=True)(event.data['post_ref'],
+                                                                        event.data['author'])
+        _like_counts[event.id] = likes
+        while len(_like_counts) > settings.POSTS_EVENTS_BUFFER:
+            _like_counts.popitem(last=False)
+    return event._replace(data={**event.data, 'likes': likes})
+
+
+def _format(event: Event) -> bytes:
+    return f'id: {event.id}\nevent: {event.type}\ndata: {json.dumps(event.data)}\n\n'.encode()
+
+
+async def _wait_disconnect(receive) -> None:
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def _respond(send, status: int, headers: Dict[bytes, bytes], body: bytes = b'', more_body: bool = False):
+    await send({'type': 'http.response.start', 'status': status, 'headers': list(headers.items())})
+    await send({'type': 'http.response.body', 'body': body, 'more_body': more_body})
+
+
+async def events_app(scope, receive, send) -> None:
+    headers = dict(scope['headers'])
+    query = {name: values[0] for name, values in parse_qs(scope['query_string'].decode()).items()}
+    authorization = headers.get(b'authorization', b'').decode().split()
+    key = authorization[1] if len(authorization) == 2 and authorization[0] == 'Token' else query.get('token')
+    user_id = await sync_to_async(_authenticate, thread_sensitive=True)(key)
+    if user_id is None:
+        await _respond(send, 401, {b'content-type': b'application/json'},
+                       b'{"detail": "Invalid token."}')
+        return
+
+    last_event_id = headers.get(b'last-event-id', b'').decode() or query.get('last_event_id', '')
+    sent_id = int(last_event_id) if last_event_id.isdigit() else None
+    following = await sync_to_async(_following, thread_sensitive=True)(user_id)
+    backend = get_event_backend()
+    # Subscribe before reading the buffer so no event falls in between, duplicates are skipped by id
+    subscriber = Subscriber(asyncio.get_event_loop(), settings.POSTS_EVENTS_QUEUE_SIZE)
+    backend.subscribe(subscriber)
+    disconnect = asyncio.ensure_future(_wait_disconnect(receive))
+    try:
+        await _respond(send, 200, {b'content-type': b'text/event-stream', b'cache-control': b'no-cache',
+                                   b'x-accel-buffering': b'no'}, more_body=True)
+        pending = await sync_to_async(backend.events_since)(sent_id) if sent_id is not None else []
+        while not disconnect.done():
+            if pending:
+                event = pending.pop(0)
+            else:
+                get = asyncio.ensure_future(subscriber.queue.get())
+                await asyncio.wait({get, disconnect}, timeout=settings.POSTS_EVENTS_HEARTBEAT,
+                                   return_when=asyncio.FIRST_COMPLETED)
+                if not get.done():
+                    get.cancel()
+                    if not disconnect.done():
+                        await send({'type': 'http.response.body', 'body': b': heartbeat\n\n', 'more_body': True})
+                    continue
+                event = get.result()
+                if event is None:
+                    # The subscriber fell behind, the client resumes from the buffer when it reconnects
+                    break
+            if sent_id is not None and event.id <= sent_id:
+                continue
+            if event.type == FOLLOWING_CHANGED:
+                if event.data['user'] == user_id:
+                    following = await sync_to_async(_following, thread_sensitive=True)(user_id)
+                continue
+            if event.type == POST_CREATED and event.data['author'] not in following:
+                continue
+            if event.type == LIKES_CHANGED:
+                # Only the posts the user sees: its own and those of the authors it follows
+                if event.data['author'] != user_id and event.data['author'] not in following:
+                    continue
+                event = await _with_likes(event)
+            await send({'type': 'http.response.body', 'body': _format(event), 'more_body': True})
+            sent_id = event.id
+        if not disconnect.done():
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+    finally:
+        backend.unsubscribe(subscriber)
+        disconnect.cancel()
@@ -4,6 +4,8 @@ from django.test import TransactionTestCase
 
 from django.contrib.auth.models import User
 
+from PostsApp.app_utils.throttling_utils import get_bucket_store
+from PostsApp.app_utils.tiering_utils import reset_access_sampler
 from PostsApp.models import Post
 
 
@@ -11,6 +13,8 @@ class BaseTest(TransactionTestCase):
     fixtures = ["tests.yaml"]
 
     def setUp(self) -> None:
+        get_bucket_store().clear()
+        reset_access_sampler()
         self.user1 = User.objects.get(username='user_1')
         self.user2 = User.objects.get(username='user_2')
         self.user3 = User.objects.get(username='user_3')
@@ -2,3 +2,9 @@ from hedgehogLab.settings import *
 
 MEDIA_ROOT = os.path.join(BASE_DIR, "media_test")
 MEDIA_URL = '/media/'
+
+# Second database for the sharding tests (see PostsApp.tests.tests_api.ShardingTests)
+DATABASES['posts_1'] = {
+    'ENGINE': 'django.db.backends.sqlite3',
+    'NAME': BASE_DIR / 'db_posts_1.sqlite3',
+}
@@ -1,16 +1,36 @@
+import asyncio
 import io
 import os
+import tempfile
 from pathlib import Path
 from typing import Dict, Union
+from unittest import skipUnless
 
+import numpy as np
 from PIL import Image
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.test import TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from rest_framework.authtoken.models import Token
 from rest_framework.test import APIClient
 
-from PostsApp.models import Post
+from PostsApp.api_schema import reset_schema_artifacts
+from PostsApp.app_utils.events_utils import get_event_backend, reset_event_backend
+from PostsApp.app_utils.graph_utils import export_graph, import_graph
+from PostsApp.app_utils.phash_utils import reset_phash_index
+from PostsApp.app_utils.purge_utils import purge_deleted
+from PostsApp.app_utils.search_utils import SEARCH_TABLE
+from PostsApp.app_utils.shard_utils import reserve_post_ids, shard_for_author, shard_for_post_id
+from PostsApp.app_utils.suggestion_utils import compute_follow_suggestions
+from PostsApp.app_utils.tiering_utils import reset_warm_cache, tier_images
+from PostsApp.app_utils.trending_utils import recompute_trending
+from PostsApp.models import Post, PostLike, Profile
+from PostsApp.sse import EVENTS_PATH, events_app
 from PostsApp.tests.base_test import BaseTest
 
 
@@ -50,9 +70,9 @@ class APITests(BaseTest):
                     print(f'Failed to delete {file_path}. Reason: {e}')
 
     @staticmethod
-    def _generate_picture_file():
+    def _generate_picture_file(size=(100, 100)):
         file = io.BytesIO()
-        image = Image.new('RGBA', size=(100, 100), color=(155, 0, 0))
+        image = Image.new('RGBA', size=size, color=(155, 0, 0))
         image.save(file, 'png')
         file.name = 'test.png'
         file.seek(0)
@@ -72,6 +92,53 @@ class APITests(BaseTest):
         for user in resp.data:
             self._test_keys(user, ['username', 'followers_number', 'following_number'])
 
+    def test_bulk_create_users(self):
+        url = reverse('user-bulk-api-v1')
+        admin = User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.auth_client1.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.get(user=admin).key)
+        body = '\n'.join([
+            '{"username": "bulk_1", "password": "secret_1", "email": "bulk_1@example.com"}',
+            '{"username": "user_1", "password": "secret"}',
+            '{"username": "bulk_1", "password": "secret"}',
+            'not json',
+            '{"username": "bulk 2", "password": "secret"}',
+            '{"username": "bulk_2"}',
+            '',
+        ])
+        resp = self.auth_client1.post(url, body, content_type='application/x-ndjson')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data['created'], 1)
+        self.assertEqual([(error['row'], error['username']) for error in resp.data['errors']],
+                         [(2, 'user_1'), (3, 'bulk_1'), (4, ''), (5, 'bulk 2'), (6, 'bulk_2')])
+        user = User.objects.get(username='bulk_1')
+        self.assertTrue(user.check_password('secret_1'))
+        self.assertEqual(user.email, 'bulk_1@example.com')
+        self.assertTrue(Profile.objects.filter(user=user).exists())
+        self.assertTrue(Token.objects.filter(user=user).exists())
+        resp = self.auth_client1.post(url, 'username,password\nbulk_3,secret_3\n', content_type='text/csv')
+        self.assertEqual(resp.data, {'created': 1, 'errors': []})
+        self.assertTrue(User.objects.get(username='bulk_3').check_password('secret_3'))
+
+    def test_bulk_create_users_not_admin(self):
+        resp = self.auth_client1.post(reverse('user-bulk-api-v1'), 'username,password\nbulk_3,secret_3\n',
+                                      content_type='text/csv')
+        self.assertEqual(resp.status_code, 403)
+
+    def test_list_user_suggestions(self):
+        url = reverse('user-suggestions-api-v1')
+        compute_follow_suggestions()
+        data = self._test_get_api_data(self.auth_client3, url, 200, 1)
+        self._test_values(data[0], {'username': 'user_1'})
+        self._test_get_api_data(self.auth_client1, url, 200, 0)
+        # Users followed after the suggestions were computed are not suggested anymore
+        self.user3.profile.follow_user(self.user1)
+        self._test_get_api_data(self.auth_client3, url, 200, 0)
+
+    def test_list_user_suggestions_unauthenticated_user(self):
+        url = reverse('user-suggestions-api-v1')
+        resp = self.unauth_client.get(url)
+        self.assertEqual(resp.status_code, 401)
+
     def test_create_user(self):
         url = reverse('user-api-v1')
         data: Dict[str, str] = {
@@ -101,7 +168,8 @@ class APITests(BaseTest):
         url = reverse('post-api-v1')
         data = self._test_get_api_data(self.auth_client2, url, 200, 3)
         for post in data:
-            self._test_keys(post, ['post_ref', 'created', 'created_timestamp', 'author', 'caption', 'image', 'image_url'])
+            self._test_keys(post, ['post_ref', 'created', 'created_timestamp', 'author', 'caption', 'image',
+                                   'image_url'])
         self.assertEqual(data[0]['caption'], 'caption2')
         self.assertEqual(data[-1]['caption'], 'caption3')
 
@@ -110,6 +178,33 @@ class APITests(BaseTest):
         resp = self.unauth_client.get(url)
         self.assertEqual(resp.status_code, 401)
 
+    def test_list_post_sparse_fields(self):
+        url = reverse('post-api-v1')
+        with CaptureQueriesContext(connection) as queries:
+            data = self._test_get_api_data(self.auth_client2, url + '?fields=post_ref,image_url', 200, 3)
+        for post in data:
+            self.assertEqual(set(post), {'post_ref', 'image_url'})
+        self.assertNotIn('"caption"', queries[-1]['sql'])
+        data = self._test_get_api_data(self.auth_client2, url + '?omit=image,image_url,width,height', 200, 3)
+        self._test_keys(data[0], ['post_ref', 'created', 'author', 'caption'], exclude=['image', 'image_url'])
+
+    def test_list_users_sparse_fields(self):
+        url = reverse('user-api-v1')
+        with self.assertNumQueries(1):
+            data = self._test_get_api_data(self.unauth_client, url + '?omit=followers_number,following_number',
+                                           200, 3)
+        self.assertEqual(set(data[0]), {'username'})
+        # Counts are computed in the same query
+        with self.assertNumQueries(1):
+            data = self._test_get_api_data(self.unauth_client, url, 200, 3)
+        self._test_values(next(user for user in data if user['username'] == 'user_2'),
+                          {'followers_number': 0, 'following_number': 2})
+
+    def test_list_unknown_sparse_fields(self):
+        resp = self.unauth_client.get(reverse('user-api-v1') + '?fields=username,password')
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn('fields', resp.data)
+
     def test_create_post(self):
         url = reverse('post-api-v1')
         picture_file = self._generate_picture_file()
@@ -121,6 +216,175 @@ class APITests(BaseTest):
         self.assertEqual(resp.status_code, 201, resp.data)
         self.assertTrue(Post.objects.filter(caption='caption4').exists())
 
+    def test_create_post_stores_image_metadata(self):
+        url = reverse('post-api-v1')
+        resp = self.auth_client1.post(url, {'caption': 'caption4', 'image': self._generate_picture_file()},
+                                      format='multipart')
+        self.assertEqual(resp.status_code, 201, resp.data)
+        self._test_values(resp.data, {'width': 100, 'height': 100})
+        post = Post.objects.get(caption='caption4')
+        self.assertEqual(post.format, 'PNG')
+        self.assertEqual(post.bytes, post.image.size)
+
+    @override_settings(POSTS_IMAGE_MAX_EDGE=50)
+    def test_create_post_downscales_image(self):
+        url = reverse('post-api-v1')
+        resp = self.auth_client1.post(url, {'caption': 'caption4', 'image': self._generate_picture_file((200, 100))},
+                                      format='multipart')
+        self.assertEqual(resp.status_code, 201, resp.data)
+        post = Post.objects.get(caption='caption4')
+        self.assertEqual((post.width, post.height), (50, 25))
+        self.assertEqual(Image.open(post.image.path).size, (50, 25))
+
+    @override_settings(POSTS_IMAGE_MAX_PIXELS=100 * 99)
+    def test_create_post_too_many_pixels(self):
+        url = reverse('post-api-v1')
+        resp = self.auth_client1.post(url, {'caption': 'caption4', 'image': self._generate_picture_file()},
+                                      format='multipart')
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn('image', resp.data)
+        self.assertFalse(Post.objects.filter(caption='caption4').exists())
+
+    @override_settings(POSTS_IMAGE_MAX_BYTES=10)
+    def test_create_post_too_many_bytes(self):
+        url = reverse('post-api-v1')
+        resp = self.auth_client1.post(url, {'caption': 'caption4', 'image': self._generate_picture_file()},
+                                      format='multipart')
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn('image', resp.data)
+
+    @override_settings(POSTS_TRENDING_WINDOW_DAYS=None)
+    def test_list_trending_posts(self):
+        url = reverse('post-trending-api-v1')
+        self._test_get_api_data(self.auth_client2, url, 200, 0)
+        recompute_trending()
+        data = self._test_get_api_data(self.auth_client2, url, 200, 3)
+        self.assertEqual([post['caption'] for post in data], ['caption2', 'caption1', 'caption3'])
+
+    def test_list_trending_posts_unauthenticated_user(self):
+        url = reverse('post-trending-api-v1')
+        resp = self.unauth_client.get(url)
+        self.assertEqual(resp.status_code, 401)
+
+    def test_search_posts(self):
+        url = reverse('post-search-api-v1')
+        data = self._test_get_api_data(self.auth_client2, url + '?q=caption', 200, 3)
+        # All captions match equally, so the most liked post goes first
+        self.assertEqual(data[0]['caption'], 'caption2')
+        data = self._test_get_api_data(self.auth_client2, url + '?q=capt user_1', 200, 3)
+        data = self._test_get_api_data(self.auth_client2, url + '?q=caption3', 200, 1)
+        self.assertEqual(data[0]['post_ref'], self.post3.post_ref)
+        self._test_get_api_data(self.auth_client2, url + '?q=user_2', 200, 0)
+        self._test_get_api_data(self.auth_client2, url + '?q="', 200, 0)
+
+    def test_search_posts_follows_changes(self):
+        url = reverse('post-search-api-v1')
+        self.post1.caption = 'sunset'
+        self.post1.save()
+        data = self._test_get_api_data(self.auth_client2, url + '?q=suns', 200, 1)
+        self.assertEqual(data[0]['post_ref'], self.post1.post_ref)
+        self.post1.delete()
+        self._test_get_api_data(self.auth_client2, url + '?q=sunset', 200, 0)
+        self.user1.username = 'renamed'
+        self.user1.save()
+        self._test_get_api_data(self.auth_client2, url + '?q=renamed', 200, 2)
+
+    def test_search_posts_unauthenticated_user(self):
+        url = reverse('post-search-api-v1')
+        resp = self.unauth_client.get(url + '?q=caption')
+        self.assertEqual(resp.status_code, 401)
+
+    def test_post_near_duplicates(self):
+        reset_phash_index()
+        url = reverse('post-api-v1')
+        images = [Image.fromarray(np.random.default_rng(seed).integers(0, 256, (6, 6, 3), dtype=np.uint8))
+                  .resize((256, 256), Image.BICUBIC) for seed in (0, 1)]
+        for caption, picture in (('original', images[0]), ('resized', images[0].resize((100, 100))),
+                                 ('other', images[1])):
+            file = io.BytesIO()
+            picture.save(file, 'jpeg')
+            file.name = 'test.jpg'
+            file.seek(0)
+            resp = self.auth_client1.post(url, {'caption': caption, 'image': file}, format='multipart')
+            self.assertEqual(resp.status_code, 201, resp.data)
+
+        original = Post.objects.get(caption='original')
+        url = reverse('post-duplicates-api-v1', args=[original.post_ref])
+        data = self._test_get_api_data(self.auth_client2, url, 200, 1)
+        self.assertEqual(data[0]['caption'], 'resized')
+        self._test_get_api_data(self.auth_client2, url + '?distance=64', 200, 2)
+        resp = self.auth_client2.get(url + '?distance=65')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.auth_client2.get(reverse('post-duplicates-api-v1', args=['unknown']))
+        self.assertEqual(resp.status_code, 404)
+
+    def test_bootstrap(self):
+        url = reverse('bootstrap-api-v1')
+        resp = self.auth_client3.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self._test_keys(resp.data, ['feed', 'ranking', 'profile'])
+        self._test_values(resp.data['profile'], {'username': 'user_3', 'followers_number': 2,
+                                                 'following_number': 0})
+        self.assertEqual(resp.data['feed'], [])
+        listed = self._test_get_api_data(self.auth_client3, reverse('post-api-v1'), 200, 3)
+        # The same posts as /api/v1/posts/, image URLs included
+        self.assertEqual([{key: post[key] for key in listed_post} for post, listed_post in
+                          zip(resp.data['ranking'], listed)], listed)
+        for post in resp.data['ranking']:
+            self._test_values(post, {'liked_by_me': post['post_ref'] == self.post2.post_ref,
+                                     'author_followed_by_me': False})
+        for name in ('feed', 'ranking', 'profile'):
+            self.assertIn(f'{name};dur=', resp['Server-Timing'])
+        self.user3.profile.follow_user(self.user1)
+        resp = self.auth_client3.get(url)
+        for post in resp.data['ranking']:
+            self._test_values(post, {'author_followed_by_me': True})
+
+    def test_bootstrap_feed(self):
+        resp = self.auth_client2.get(reverse('bootstrap-api-v1'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([post['caption'] for post in resp.data['feed']],
+                         [image['caption'] for image in self._test_get_api_data(self.auth_client2,
+                                                                                reverse('image-api-v1'), 200, 3)])
+        for post in resp.data['feed']:
+            self._test_values(post, {'author_followed_by_me': True})
+
+    def test_bootstrap_unauthenticated_user(self):
+        resp = self.unauth_client.get(reverse('bootstrap-api-v1'))
+        self.assertEqual(resp.status_code, 401)
+
+    def test_delete_post(self):
+        url = reverse('post-detail-api-v1', args=[self.post1.post_ref])
+        resp = self.auth_client2.delete(url)
+        self.assertEqual(resp.status_code, 403)
+        resp = self.auth_client1.delete(url)
+        self.assertEqual(resp.status_code, 204)
+        self._test_get_api_data(self.auth_client2, reverse('post-api-v1'), 200, 2)
+        self._test_get_api_data(self.auth_client2, reverse('image-api-v1'), 200, 2)
+        self._test_get_api_data(self.auth_client2, reverse('post-search-api-v1') + '?q=caption1', 200, 0)
+        resp = self.auth_client2.put(reverse('post-like-api-v1'), {'post_ref': self.post1.post_ref}, format='json')
+        self.assertEqual(resp.status_code, 404)
+        resp = self.auth_client1.delete(url)
+        self.assertEqual(resp.status_code, 404)
+
+    def test_delete_post_unauthenticated_user(self):
+        resp = self.unauth_client.delete(reverse('post-detail-api-v1', args=[self.post1.post_ref]))
+        self.assertEqual(resp.status_code, 401)
+
+    def test_delete_account(self):
+        resp = self.auth_client2.delete(reverse('user-detail-api-v1', args=[self.user1.username]))
+        self.assertEqual(resp.status_code, 403)
+        resp = self.auth_client1.delete(reverse('user-detail-api-v1', args=[self.user1.username]))
+        self.assertEqual(resp.status_code, 204)
+        self._test_get_api_data(self.unauth_client, reverse('user-api-v1'), 200, 2)
+        self._test_get_api_data(self.auth_client2, reverse('post-api-v1'), 200, 0)
+        self._test_get_api_data(self.auth_client2, reverse('image-api-v1'), 200, 0)
+        resp = self.auth_client1.get(reverse('post-api-v1'))
+        self.assertEqual(resp.status_code, 401)
+        resp = self.auth_client3.put(reverse('user-follow-api-v1'), {'username': self.user1.username},
+                                     format='json')
+        self.assertEqual(resp.status_code, 404)
+
     def test_follow_user(self):
         url = reverse('user-follow-api-v1')
         self.assertFalse(self.user3.profile.follows(self.user1))
@@ -169,3 +433,377 @@ class APITests(BaseTest):
         self.assertTrue(self.user2.profile.likes(self.post1))
         resp = self.auth_client1.put(url, {'post_ref': self.post1.post_ref})
         self.assertEqual(resp.status_code, 400)
+
+    def test_list_followers(self):
+        url = reverse('user-followers-api-v1', args=['user_3'])
+        resp = self.auth_client2.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([(user['username'], user['followed_by_me']) for user in resp.data['results']],
+                         [('user_2', False), ('user_1', True)])
+        self._test_keys(resp.data['results'][0], ['followers_number', 'following_number'])
+        self.assertIsNone(resp.data['next'])
+        resp = self.auth_client2.get(reverse('user-following-api-v1', args=['user_2']), {'fields': 'username'})
+        self.assertEqual(resp.data['results'], [{'username': 'user_3', 'followed_by_me': True},
+                                                {'username': 'user_1', 'followed_by_me': True}])
+        self.assertEqual(self.auth_client2.get(reverse('user-following-api-v1', args=['user_3'])).data['results'], [])
+        self.assertEqual(self.auth_client2.get(reverse('user-followers-api-v1', args=['nobody'])).status_code, 404)
+        self.assertEqual(self.unauth_client.get(url).status_code, 401)
+
+    def test_list_followers_pages(self):
+        url = reverse('user-followers-api-v1', args=['user_3'])
+        usernames = []
+        with CaptureQueriesContext(connection) as queries:
+            resp = self.auth_client1.get(url, {'page_size': 1})
+        # Token, user, follows of the page, its users and followed_by_me
+        self.assertEqual(len(queries), 5)
+        while True:
+            self.assertEqual(len(resp.data['results']), 1)
+            usernames.append(resp.data['results'][0]['username'])
+            if resp.data['next'] is None:
+                break
+            resp = self.auth_client1.get(resp.data['next'])
+        self.assertEqual(usernames, ['user_2', 'user_1'])
+        self.user2.profile.soft_delete()
+        self.assertEqual([user['username'] for user in self.auth_client1.get(url).data['results']], ['user_1'])
+
+    def test_follows_page_covering_index(self):
+        follows = Profile.following.through.objects
+        for page in (follows.filter(user_id=self.user3.pk, id__lt=10).only('profile_id'),
+                     follows.filter(profile_id=self.user2.profile.pk, id__lt=10).only('user_id')):
+            plan = page.order_by('-id')[:50].explain()
+            self.assertIn('COVERING INDEX', plan)
+            self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_cold_image(self):
+        with tempfile.TemporaryDirectory() as directory, override_settings(
+                MEDIA_ROOT=os.path.join(directory, 'media'), POSTS_COLD_STORAGE_DIR=os.path.join(directory, 'cold'),
+                POSTS_WARM_CACHE_DIR=os.path.join(directory, 'warm')):
+            reset_warm_cache()
+            os.makedirs(settings.MEDIA_ROOT)
+            with open(self.post1.image.path, 'wb') as file:
+                file.write(b'image')
+            # Only the image of post1 exists, the others can not be moved
+            self.assertEqual(tier_images(), {'images': 1, 'packs': 1})
+            data = self._test_get_api_data(self.auth_client2, reverse('image-api-v1'), 200, 3)
+            cold_url = 'http://testserver' + reverse('post-image-api-v1', args=[self.post1.post_ref])
+            hot_urls = ['http://testserver' + post.image.url for post in (self.post2, self.post3)]
+            for field in ('image', 'image_url'):
+                self.assertEqual([image[field] for image in data], [cold_url, *hot_urls])
+            data = self._test_get_api_data(self.auth_client2, reverse('post-api-v1'), 200, 3)
+            # Clients keep reading image: its URL serves the cold image
+            resp = self.unauth_client.get(next(post['image'] for post in data
+                                               if post['post_ref'] == self.post1.post_ref))
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(b''.join(resp.streaming_content), b'image')
+            resp.close()
+            resp = self.unauth_client.get(cold_url)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(b''.join(resp.streaming_content), b'image')
+            self.assertIn('public', resp['Cache-Control'])
+            resp.close()
+            resp = self.unauth_client.get(reverse('post-image-api-v1', args=[self.post2.post_ref]))
+            self.assertRedirects(resp, self.post2.image.url, fetch_redirect_response=False)
+        reset_warm_cache()
+
+    @override_settings(POSTS_THROTTLE_BUCKETS={'user': (12, 0.01), 'anon': (10, 0.01)})
+    def test_rate_limit(self):
+        url = reverse('post-api-v1')
+        resp = self.auth_client1.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self._test_values(resp, {'RateLimit-Limit': '12', 'RateLimit-Remaining': '2'})
+        resp = self.auth_client1.get(url)
+        self.assertEqual(resp.status_code, 429)
+        self.assertEqual(resp['RateLimit-Remaining'], '2')
+        self.assertGreater(int(resp['Retry-After']), 0)
+        # Cheaper requests still fit, other users and anonymous clients have their own buckets
+        resp = self.auth_client1.put(reverse('post-like-api-v1'), {'post_ref': self.post1.post_ref})
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp['RateLimit-Remaining'], '0')
+        self.assertEqual(self.auth_client2.get(url).status_code, 200)
+        resp = self.unauth_client.get(reverse('user-api-v1'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp['RateLimit-Limit'], '10')
+        self.assertEqual(self.unauth_client.get(reverse('user-api-v1')).status_code, 429)
+
+
+@skipUnless('posts_1' in settings.DATABASES, 'Needs the posts_1 database of PostsApp.tests.settings_tests')
+@override_settings(POSTS_SHARDS=['default', 'posts_1'])
+class ShardingTests(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        reserve_post_ids('posts_1')
+        self.users = [User.objects.create_user(f'sharded_{i}', password='password') for i in range(3)]
+        self.reader = self.users[2]
+        for author in self.users[:2]:
+            self.reader.profile.follow_user(author)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.get(user=self.reader).key)
+        self.posts = [self._create_post(author, f'{author.username}_{i}')
+                      for i in range(2) for author in self.users[:2]]
+
+    @staticmethod
+    def _create_post(author: User, caption: str) -> Post:
+        post = Post(author=author, caption=caption, image=f'{caption}.png')
+        post.save()
+        return post
+
+    def test_posts_in_author_shard(self):
+        for post in self.posts:
+            shard = shard_for_author(post.author_id)
+            self.assertEqual(post._state.db, shard)
+            self.assertEqual(shard_for_post_id(post.pk), shard)
+            self.assertEqual(Post.objects.using(shard).get(pk=post.pk).author, post.author)
+        self.assertEqual(Post.objects.using('default').count(), 2)
+        self.assertEqual(Post.objects.using('posts_1').count(), 2)
+
+    def test_like_in_post_shard(self):
+        post = next(post for post in self.posts if post._state.db == 'posts_1')
+        resp = self.client.put(reverse('post-like-api-v1'), {'post_ref': post.post_ref}, format='json')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(PostLike.objects.using('posts_1').filter(post_id=post.pk, user=self.reader).exists())
+        self.assertFalse(PostLike.objects.using('default').exists())
+
+    def test_like_counted_in_post_shard(self):
+        post = next(post for post in self.posts if post._state.db == 'posts_1')
+        self.reader.profile.like_post(post)
+        self.assertEqual(post.liked_number, 1)
+        self.assertTrue(self.reader.profile.likes(post))
+        self.assertFalse(self.users[0].profile.likes(post))
+
+    def test_purge_user_in_shards(self):
+        author = next(user for user in self.users[:2] if shard_for_author(user.pk) == 'posts_1')
+        author.profile.soft_delete()
+        # Created after the account was deleted, so not soft-deleted itself
+        post = self._create_post(author, 'late_post')
+        post.liked.add(self.reader)
+        purged = purge_deleted()
+        self.assertEqual(purged['users'], 1)
+        self.assertFalse(Post.all_objects.using('posts_1').filter(author_id=author.pk).exists())
+        self.assertFalse(PostLike.objects.using('posts_1').filter(post_id=post.pk).exists())
+
+    def test_ranking_gathers_shards(self):
+        liked = [self.posts[1], self.posts[0]]
+        for likes, post in enumerate(liked, start=1):
+            post.liked.add(*[user for user in self.users if user.pk != post.author_id][:likes])
+        data = self.client.get(reverse('post-api-v1')).data
+        self.assertEqual(len(data), 4)
+        self.assertEqual([post['post_ref'] for post in data[:2]], [str(liked[1].post_ref), str(liked[0].post_ref)])
+
+    def test_feed_gathers_shards(self):
+        data = self.client.get(reverse('image-api-v1')).data
+        self.assertEqual([image['caption'] for image in data], [post.caption for post in self.posts])
+        data = self.client.get(reverse('bootstrap-api-v1')).data
+        self.assertEqual([post['post_ref'] for post in data['feed']], [str(post.post_ref) for post in self.posts])
+
+    def test_delete_post_in_shard(self):
+        post = next(post for post in self.posts if post._state.db == 'posts_1')
+        author_client = APIClient()
+        author_client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.get(user=post.author).key)
+        resp = author_client.delete(reverse('post-detail-api-v1', args=[post.post_ref]))
+        self.assertEqual(resp.status_code, 204)
+        self.assertIsNotNone(Post.all_objects.using('posts_1').get(pk=post.pk).deleted)
+        self.assertEqual(purge_deleted()['posts'], 1)
+
+    def test_search_indexes_default_shard(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT rowid FROM {SEARCH_TABLE}')
+            indexed = {row[0] for row in cursor.fetchall()}
+        # The table is not flushed between tests, only the posts of this one are compared
+        self.assertEqual(indexed & {post.pk for post in self.posts},
+                         {post.pk for post in self.posts if post._state.db == 'default'})
+
+    def test_export_import_shards(self):
+        for post in self.posts:
+            post.liked.add(self.reader)
+        with tempfile.TemporaryDirectory() as directory:
+            exported = export_graph(Path(directory), ['posts', 'likes'])
+            self.assertEqual(exported, {'posts': 4, 'likes': 4})
+            for alias in ('default', 'posts_1'):
+                Post.all_objects.using(alias).all().delete()
+            import_graph(Path(directory), ['posts', 'likes'], workers=1)
+        for post in self.posts:
+            shard = shard_for_author(post.author_id)
+            self.assertEqual(Post.objects.using(shard).get(pk=post.pk).created, post.created)
+            self.assertTrue(PostLike.objects.using(shard).filter(post_id=post.pk, user=self.reader).exists())
+
+
+class EventStreamTests(BaseTest):
+    def setUp(self):
+        super().setUp()
+        reset_event_backend()
+        self.token2 = Token.objects.get(user=self.user2)
+        self.token3 = Token.objects.get(user=self.user3)
+
+    @staticmethod
+    def _read_stream(query: str = '', headers: Dict[bytes, bytes] = None, action=None, events: int = 1):
+        """
+        Opens the event stream, runs action (sync, in a thread) once subscribed and disconnects when the given number
+        of events arrived. Returns the status and the body.
+        """
+        async def run():
+            messages = []
+            started = asyncio.Event()
+            disconnected = asyncio.Event()
+
+            async def receive():
+                await disconnected.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                messages.append(message)
+                if message['type'] == 'http.response.start':
+                    started.set()
+                elif b''.join(m['body'] for m in messages[1:]).count(b'\n\n') >= events:
+                    disconnected.set()
+
+            scope = {'type': 'http', 'path': EVENTS_PATH, 'query_string': query.encode(),
+                     'headers': list((headers or {}).items())}
+            stream = asyncio.ensure_future(events_app(scope, receive, send))
+            await started.wait()
+            if action is not None:
+                await sync_to_async(action, thread_sensitive=True)()
+            await asyncio.wait_for(stream, 5)
+            return messages[0]['status'], b''.join(m['body'] for m in messages[1:]).decode()
+        return asyncio.run(run())
+
+    def _create_post(self, author: User, caption: str = 'new post') -> Post:
+        return Post.objects.create(author=author, caption=caption, image='image_1.png')
+
+    def test_unauthenticated_user(self):
+        status, _ = self._read_stream(query='token=wrong')
+        self.assertEqual(status, 401)
+
+    def test_post_of_followed_author(self):
+        headers = {b'authorization': f'Token {self.token2.key}'.encode()}
+        status, body = self._read_stream(headers=headers, action=lambda: self._create_post(self.user1))
+        self.assertEqual(status, 200)
+        self.assertIn('event: post\n', body)
+        self.assertIn('"caption": "new post"', body)
+
+    def test_post_of_not_followed_author(self):
+        posts = []
+
+        def action():
+            posts.append(self._create_post(self.user1))
+            self.user2.profile.like_post(posts[0])
+            # The only event the user gets: a like of its own post
+            self.user2.profile.like_post(self._create_post(self.user3))
+
+        status, body = self._read_stream(query=f'token={self.token3.key}', action=action)
+        self.assertNotIn('event: post\n', body)
+        self.assertNotIn(str(posts[0].post_ref), body)
+        self.assertIn('event: likes\n', body)
+        self.assertIn('"likes": 1', body)
+
+    def test_likes_of_followed_author(self):
+        def action():
+            self.user3.profile.like_post(self._create_post(self.user1))
+
+        status, body = self._read_stream(query=f'token={self.token2.key}', action=action, events=2)
+        self.assertIn('event: likes\n', body)
+        self.assertIn('"likes": 1', body)
+
+    def test_follow_while_connected(self):
+        def action():
+            self.user3.profile.follow_user(self.user1)
+            self._create_post(self.user1)
+
+        status, body = self._read_stream(query=f'token={self.token3.key}', action=action)
+        self.assertIn('event: post\n', body)
+
+    @override_settings(POSTS_EVENTS_HEARTBEAT=0.01)
+    def test_heartbeat(self):
+        status, body = self._read_stream(query=f'token={self.token2.key}')
+        self.assertEqual(body, ': heartbeat\n\n')
+
+    def test_resume_from_last_event_id(self):
+        last_event_id = max([0] + [event.id for event in get_event_backend().events_since(0)])
+        self._create_post(self.user1, 'missed post')
+        headers = {b'last-event-id': str(last_event_id).encode()}
+        status, body = self._read_stream(query=f'token={self.token2.key}', headers=headers)
+        self.assertIn('"caption": "missed post"', body)
+        missed_id = get_event_backend().events_since(last_event_id)[0].id
+        self.assertIn(f'id: {missed_id}\n', body)
+
+
+class APIDocumentationTests(BaseTest):
+    def setUp(self):
+        super().setUp()
+        reset_schema_artifacts()
+        self.client = APIClient()
+
+    def tearDown(self):
+        reset_schema_artifacts()
+
+    def test_prebuilt_schema(self):
+        with tempfile.TemporaryDirectory() as directory, override_settings(API_SCHEMA_DIR=directory):
+            call_command('build_api_schema', output_dir=directory, stdout=io.StringIO())
+            with open(os.path.join(directory, 'VERSION')) as version_file:
+                version = version_file.read()
+            resp = self.client.get(reverse('schema-json', args=['.json']))
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp['ETag'], f'"{version}"')
+            self.assertIn('max-age=', resp['Cache-Control'])
+            self.assertIn('/posts/search/', resp.json()['paths'])
+            resp = self.client.get(reverse('schema-json', args=['.json']), HTTP_IF_NONE_MATCH=f'"{version}"')
+            self.assertEqual(resp.status_code, 304)
+            resp = self.client.get(reverse('schema-json', args=['.yaml']))
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp['Content-Type'], 'application/yaml')
+
+    def test_schema_without_build(self):
+        with override_settings(API_SCHEMA_DIR=os.path.join(tempfile.gettempdir(), 'missing_api_schema')):
+            resp = self.client.get(reverse('schema-json', args=['.json']))
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('/likepost/', resp.json()['paths'])
+            # Annotations of the views
+            self.assertEqual(resp.json()['paths']['/likepost/']['put']['description'], 'Like a Post')
+
+    def test_documentation_ui(self):
+        for name in ('schema-swagger-ui', 'schema-redoc'):
+            resp = self.client.get(reverse(name))
+            self.assertEqual(resp.status_code, 200)
+            self.assertContains(resp, reverse('schema-json', args=['.json']) + '?v=')
+
+
+class AdminTests(BaseTest):
+    def setUp(self):
+        super().setUp()
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.force_login(self.admin)
+
+    def test_changelists(self):
+        for name in ('admin:auth_user_changelist', 'admin:PostsApp_post_changelist',
+                     'admin:PostsApp_postlike_changelist'):
+            resp = self.client.get(reverse(name))
+            self.assertEqual(resp.status_code, 200)
+        resp = self.client.get(reverse('admin:PostsApp_post_changelist'), {'q': self.user1.username})
+        self.assertContains(resp, str(self.post1.post_ref))
+
+    def test_change_post_author_removes_like(self):
+        self.post1.liked.add(self.user2)
+        resp = self.client.post(reverse('admin:PostsApp_post_change', args=[self.post1.pk]), {
+            'author': self.user2.pk, 'caption': self.post1.caption,
+        }, follow=True)
+        self.assertEqual(resp.status_code, 200)
+        self.assertContains(resp, "Author of the post can not be in")
+        self.assertFalse(self.post1.liked.filter(pk=self.user2.pk).exists())
+
+    def test_author_can_not_like_own_post_in_admin(self):
+        resp = self.client.post(reverse('admin:PostsApp_postlike_add'), {
+            'post': self.post1.pk, 'user': self.post1.author_id,
+        })
+        self.assertEqual(resp.status_code, 200)
+        self.assertContains(resp, "Author of the post can not be in")
+
+    def test_delete_user_in_admin(self):
+        url = reverse('admin:auth_user_delete', args=[self.user1.pk])
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        resp = self.client.post(url, {'post': 'yes'})
+        self.assertEqual(resp.status_code, 302)
+        self.user1.refresh_from_db()
+        self.assertFalse(self.user1.is_active)
+        self.assertIsNotNone(self.user1.profile.deleted)
+        self.assertFalse(Post.objects.filter(author=self.user1).exists())
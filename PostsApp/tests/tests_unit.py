@@ -1,4 +1,42 @@
-from PostsApp.models import FollowException, LikeException
+import asyncio
+import csv
+import io
+import json
+import os
+import tempfile
+import zipfile
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+from PIL import Image
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.files.base import ContentFile
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test import SimpleTestCase, override_settings
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from PostsApp.app_utils.admin_utils import EstimatedCountPaginator, estimated_count
+from PostsApp.app_utils.events_utils import Event, LocalEventBackend, SQLiteEventBackend, Subscriber
+from PostsApp.app_utils.graph_utils import export_graph, import_graph
+from PostsApp.app_utils.image_utils import EXIF_ORIENTATION_TAG, dhash, ingest_image
+from PostsApp.app_utils.phash_utils import PhashIndex, hamming_distances
+from PostsApp.app_utils.provisioning_utils import CSV, NDJSON, RowError, provision_users, read_rows
+from PostsApp.app_utils.purge_utils import collect_media_garbage, purge_deleted
+from PostsApp.app_utils.search_utils import SEARCH_TABLE, search_posts
+from PostsApp.app_utils.suggestion_utils import compute_follow_suggestions
+from PostsApp.app_utils.throttling_utils import LocalBucketStore, MmapBucketStore, TokenBucketThrottle
+from PostsApp.app_utils.tiering_utils import (WarmCache, apply_accesses, get_access_sampler, open_image,
+                                              reset_warm_cache, tier_images)
+from PostsApp.app_utils.trending_utils import recompute_trending, trending_posts, update_trending
+from PostsApp.models import FollowException, FollowSuggestion, LikeException, Post, PostLike, Profile
+from PostsApp.serializers import PostSerializer
 from PostsApp.tests.base_test import BaseTest
 
 
@@ -23,6 +61,13 @@ class UserTests(BaseTest):
         with self.assertRaises(FollowException):
             self.user1.profile.follow_user(self.user1)
 
+    def test_follow_user_with_id_of_profile(self):
+        user = User.objects.create_user('user_4', password='password')
+        user.profile.delete()
+        profile = Profile.objects.create(pk=self.user3.pk, user=user)
+        profile.follow_user(self.user3)
+        self.assertIn(self.user3, profile.following.all())
+
     def test_follow_followed_user(self):
         self.assertIn(self.user3, self.user1.profile.following.all())
         self.user1.profile.follow_user(self.user3)
@@ -78,3 +123,528 @@ class PostTests(BaseTest):
         self.assertEqual(self.post3.liked_number, 0)
 
 
+@override_settings(POSTS_TRENDING_WINDOW_DAYS=None)
+class TrendingTests(BaseTest):
+    def test_recompute_trending(self):
+        self.assertEqual(recompute_trending(), 3)
+        self.assertEqual(list(trending_posts()), [self.post2, self.post1, self.post3])
+
+    def test_update_trending(self):
+        recompute_trending()
+        self.user2.profile.like_post(self.post3)
+        self.user3.profile.like_post(self.post3)
+        self.assertEqual(list(trending_posts())[0], self.post2)
+        self.assertEqual(update_trending(), 1)
+        self.assertEqual(list(trending_posts()), [self.post3, self.post2, self.post1])
+
+    @override_settings(POSTS_TRENDING_WINDOW_DAYS=1)
+    def test_trending_window(self):
+        self.assertEqual(recompute_trending(), 0)
+        self.assertEqual(list(trending_posts()), [])
+
+    def test_like_timestamp(self):
+        self.user2.profile.like_post(self.post3)
+        like = PostLike.objects.get(post=self.post3, user=self.user2)
+        self.assertGreater(like.created, self.post3.created)
+
+
+class FollowSuggestionTests(BaseTest):
+    def _suggestions(self):
+        return set(FollowSuggestion.objects.values_list('user__username', 'suggested__username', 'score'))
+
+    def test_common_followers(self):
+        # user_2 follows user_1 and user_3
+        self.assertEqual(compute_follow_suggestions(), 1)
+        self.assertEqual(self._suggestions(), {('user_3', 'user_1', 0.5)})
+
+    def test_friends_of_friends(self):
+        self.user3.profile.follow_user(self.user2)
+        compute_follow_suggestions()
+        # user_3 -> user_2 -> user_1 plus the common follower user_2
+        self.assertEqual(self._suggestions(), {('user_3', 'user_1', 1.5), ('user_1', 'user_2', 1.0)})
+
+    @override_settings(POSTS_FOLLOW_SUGGESTIONS=0)
+    def test_suggestions_limit(self):
+        self.assertEqual(compute_follow_suggestions(), 0)
+
+
+class PurgeTests(BaseTest):
+    def test_purge_deleted_post(self):
+        self.post2.soft_delete()
+        self.assertFalse(Post.objects.filter(pk=self.post2.pk).exists())
+        self.assertEqual(purge_deleted(batch_size=1), {'likes': 2, 'posts': 1, 'users': 0})
+        self.assertFalse(Post.all_objects.filter(pk=self.post2.pk).exists())
+        self.assertFalse(PostLike.objects.filter(post_id=self.post2.pk).exists())
+        self.assertEqual(purge_deleted(), {'likes': 0, 'posts': 0, 'users': 0})
+
+    def test_purge_deleted_account(self):
+        self.user2.profile.soft_delete()
+        self.user2.refresh_from_db()
+        self.assertFalse(self.user2.is_active)
+        self.assertEqual(purge_deleted(batch_size=1), {'likes': 2, 'posts': 0, 'users': 1})
+        self.assertFalse(User.objects.filter(pk=self.user2.pk).exists())
+        self.assertEqual(self.user1.profile.followers_number, 0)
+        self.user1.profile.soft_delete()
+        self.assertEqual(purge_deleted(), {'likes': 1, 'posts': 3, 'users': 1})
+        self.assertEqual(Post.all_objects.count(), 0)
+
+    def test_collect_media_garbage(self):
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            os.makedirs(os.path.join(media_root, 'nested'))
+            for name in (self.post1.image.name, 'orphan.png', 'nested/orphan.png'):
+                with open(os.path.join(media_root, name), 'wb') as file:
+                    file.write(b'image')
+            self.assertEqual(sorted(collect_media_garbage(min_age=0, dry_run=True)),
+                             ['nested/orphan.png', 'orphan.png'])
+            self.assertEqual(len(list(collect_media_garbage(min_age=60))), 0)
+            self.assertEqual(len(list(collect_media_garbage(min_age=0))), 2)
+            self.assertTrue(os.path.exists(os.path.join(media_root, self.post1.image.name)))
+            self.assertFalse(os.path.exists(os.path.join(media_root, 'orphan.png')))
+
+
+class ProvisioningTests(BaseTest):
+    def test_provision_users(self):
+        rows = [(number, {'username': f'bulk_{number}', 'password': f'secret_{number}'}) for number in range(1, 6)]
+        rows.append((6, {'username': 'user_2', 'password': 'secret'}))
+        result = provision_users(rows, chunk_size=2, workers=2)
+        self.assertEqual(result.created, 5)
+        self.assertEqual(result.errors, [RowError(6, 'user_2', 'username already exists')])
+        for number in range(1, 6):
+            user = User.objects.get(username=f'bulk_{number}')
+            self.assertTrue(user.check_password(f'secret_{number}'))
+            self.assertEqual(user.profile.following_number, 0)
+
+    def test_unreadable_rows(self):
+        ndjson = b'{"username": "bulk_1", "password": "secret_\xff"}\n{"username": "bulk_2", "password": "secret"}\n'
+        result = provision_users(read_rows(io.BytesIO(ndjson), NDJSON), workers=1)
+        self.assertEqual(result, (1, [RowError(1, '', 'row is not valid UTF-8')]))
+        csv_body = b'username,password\nbulk_3,' + b'x' * (csv.field_size_limit() + 1) + b'\nbulk_4,\xffsecret\n' \
+            b'bulk_5,secret\n'
+        result = provision_users(read_rows(io.BytesIO(csv_body), CSV), workers=1)
+        self.assertEqual(result.created, 1)
+        self.assertEqual([(error.row, error.error.split(':')[0]) for error in result.errors],
+                         [(1, 'row is not valid CSV'), (2, 'row is not valid UTF-8')])
+        self.assertEqual(User.objects.filter(username__in=['bulk_2', 'bulk_5']).count(), 2)
+
+    def test_provision_users_command(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv') as file:
+            file.write('username,password,first_name\nbulk_1,secret_1,Bulk\nuser_3,secret\n')
+            file.flush()
+            out, err = io.StringIO(), io.StringIO()
+            call_command('provision_users', file.name, workers=1, stdout=out, stderr=err)
+        self.assertIn('Created 1 users, skipped 1 rows', out.getvalue())
+        self.assertIn('Row 2 (user_3): username already exists', err.getvalue())
+        self.assertEqual(User.objects.get(username='bulk_1').first_name, 'Bulk')
+
+
+class GraphTests(BaseTest):
+    def _snapshot(self):
+        return {
+            'users': sorted(User.objects.values_list('username', 'password', 'is_active')),
+            'profiles': sorted(Profile.objects.values_list('pk', 'user_id', 'deleted')),
+            'follows': sorted(Profile.following.through.objects.values_list('pk', 'profile_id', 'user_id')),
+            'posts': sorted(Post.all_objects.values_list('pk', 'post_ref', 'author_id', 'created', 'image', 'deleted')),
+            'likes': sorted(PostLike.objects.values_list('post_id', 'user_id', 'created')),
+        }
+
+    def test_export_import_graph(self):
+        self.post3.soft_delete()
+        expected = self._snapshot()
+        with tempfile.TemporaryDirectory() as directory:
+            out = io.StringIO()
+            call_command('export_graph', directory, stdout=out)
+            self.assertIn('Exported 3 users', out.getvalue())
+            self.assertIn('Exported 3 posts', out.getvalue())
+            User.objects.all().delete()
+            self.assertEqual(Post.all_objects.count(), 0)
+            # The search index is emptied by the deletes, and rebuilt by the import
+            call_command('import_graph', directory, workers=1, chunk_size=2, stdout=out)
+        self.assertIn('Imported 3 likes', out.getvalue())
+        self.assertEqual(self._snapshot(), expected)
+        self.assertEqual(Token.objects.count(), 3)
+        self.assertEqual(search_posts(self.post1.caption), [self.post1])
+
+    def test_export_resume(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'posts.ndjson')
+            export_graph(Path(directory), ['posts', 'likes'])
+            with open(path, 'rb') as file:
+                complete = file.read()
+            # Interrupted in the middle of the second row
+            with open(path, 'wb') as file:
+                file.write(complete[:complete.index(b'\n') + 10])
+            self.assertEqual(export_graph(Path(directory), ['posts'], resume=True), {'posts': 2})
+            with open(path, 'rb') as file:
+                self.assertEqual(file.read(), complete)
+            self.assertEqual(export_graph(Path(directory), ['likes'], resume=True), {'likes': 0})
+
+    def test_import_skips_dangling_rows(self):
+        post = PostLike.objects.first().post
+        likes = PostLike.objects.filter(post=post).count()
+        with tempfile.TemporaryDirectory() as directory:
+            export_graph(Path(directory), ['posts', 'likes'])
+            Post.all_objects.all().delete()
+            # As if the post was purged after the posts were exported, but before the likes were
+            path = os.path.join(directory, 'posts.ndjson')
+            with open(path, 'rb') as file:
+                lines = [line for line in file if json.loads(line)['id'] != post.pk]
+            with open(path, 'wb') as file:
+                file.writelines(lines)
+            out = io.StringIO()
+            call_command('import_graph', directory, tables=['posts', 'likes'], chunk_size=2, stdout=out)
+        self.assertIn(f'Skipped {likes} likes referencing rows missing from the export', out.getvalue())
+        self.assertEqual(PostLike.objects.count(), 3 - likes)
+        self.assertFalse(Post.all_objects.filter(pk=post.pk).exists())
+
+    def test_import_offset(self):
+        follows = Profile.following.through.objects
+        expected = self._snapshot()['follows']
+        with tempfile.TemporaryDirectory() as directory:
+            export_graph(Path(directory), ['follows'])
+            follow_ids = sorted(follows.values_list('pk', flat=True))
+            follows.filter(pk__in=[follow_ids[0], follow_ids[2]]).delete()
+            # The first row is imported, the second one already exists
+            with self.assertRaisesMessage(CommandError, 'Rows committed so far: --offset follows=1'):
+                call_command('import_graph', directory, tables=['follows'], chunk_size=1)
+            self.assertEqual(import_graph(Path(directory), ['follows'], offsets={'follows': 2}), {'follows': 1})
+        self.assertEqual(self._snapshot()['follows'], expected)
+
+
+class TieringTests(BaseTest):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.settings_override = override_settings(
+            MEDIA_ROOT=os.path.join(self.directory.name, 'media'),
+            POSTS_COLD_STORAGE_DIR=os.path.join(self.directory.name, 'cold'),
+            POSTS_WARM_CACHE_DIR=os.path.join(self.directory.name, 'warm'),
+            POSTS_TIERING_ACCESS_DIR=os.path.join(self.directory.name, 'accesses'))
+        self.settings_override.enable()
+        reset_warm_cache()
+        os.makedirs(settings.MEDIA_ROOT)
+        for post in (self.post1, self.post2, self.post3):
+            with open(post.image.path, 'wb') as file:
+                file.write(post.caption.encode() * 100)
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.directory.cleanup()
+        reset_warm_cache()
+
+    def test_tier_images(self):
+        now = timezone.now()
+        # Recent and accessed, recent but idle, old but accessed
+        Post.objects.filter(pk=self.post1.pk).update(created=now, image_accessed=now)
+        Post.objects.filter(pk=self.post2.pk).update(created=now - timedelta(days=30), image_accessed=None)
+        Post.objects.filter(pk=self.post3.pk).update(image_accessed=now)
+        out = io.StringIO()
+        call_command('tier_images', pack_size=1, stdout=out)
+        self.assertIn('Moved 2 images to 2 packs', out.getvalue())
+        self.post2.refresh_from_db()
+        self.assertTrue(os.path.exists(self.post1.image.path))
+        self.assertFalse(os.path.exists(self.post2.image.path))
+        self.assertTrue(os.path.exists(os.path.join(settings.POSTS_COLD_STORAGE_DIR, self.post2.image_pack)))
+        self.assertEqual(tier_images(), {'images': 0, 'packs': 0})
+        with open_image(self.post2) as file:
+            self.assertEqual(file.read(), self.post2.caption.encode() * 100)
+        self.assertTrue(os.path.exists(os.path.join(settings.POSTS_WARM_CACHE_DIR, self.post2.image.name)))
+        with open_image(self.post2) as file:
+            self.assertEqual(file.read(), self.post2.caption.encode() * 100)
+
+    def test_collect_pack_garbage(self):
+        old = timezone.now() - timedelta(days=settings.POSTS_TIERING_HOT_DAYS + 1)
+        Post.objects.filter(pk=self.post1.pk).update(created=timezone.now(), image_accessed=timezone.now())
+        Post.objects.filter(pk__in=[self.post2.pk, self.post3.pk]).update(created=old)
+        self.assertEqual(tier_images(), {'images': 2, 'packs': 1})
+        self.post2.refresh_from_db()
+        self.post3.refresh_from_db()
+        open_image(self.post2).close()
+        pack = os.path.join(settings.POSTS_COLD_STORAGE_DIR, self.post2.image_pack)
+        Post.all_objects.filter(pk=self.post2.pk).delete()
+        self.assertEqual(list(collect_media_garbage(min_age=0, dry_run=True)), [self.post2.image.name])
+        self.assertEqual(list(collect_media_garbage(min_age=0)), [self.post2.image.name])
+        self.assertFalse(os.path.exists(os.path.join(settings.POSTS_WARM_CACHE_DIR, self.post2.image.name)))
+        with zipfile.ZipFile(pack) as file:
+            self.assertEqual(file.namelist(), [self.post3.image.name])
+        with open_image(self.post3) as file:
+            self.assertEqual(file.read(), self.post3.caption.encode() * 100)
+        Post.all_objects.filter(pk=self.post3.pk).delete()
+        self.assertEqual(list(collect_media_garbage(min_age=0)), [self.post3.image.name])
+        self.assertFalse(os.path.exists(pack))
+
+    @override_settings(POSTS_TIERING_SAMPLE_RATE=1)
+    def test_serialized_access_counted_once(self):
+        request = Request(APIRequestFactory().get('/api/v1/posts/'))
+        with mock.patch.object(get_access_sampler(), 'record') as record:
+            data = PostSerializer(self.post1, context={'request': request}).data
+        self.assertEqual(data['image'], data['image_url'])
+        record.assert_called_once_with(self.post1.pk)
+
+    def test_warm_cache_evicts_least_recently_used(self):
+        cache = WarmCache(settings.POSTS_WARM_CACHE_DIR, max_bytes=12)
+        for age, name in enumerate(('a.png', 'b.png', 'c.png'), start=1):
+            cache.put(name, io.BytesIO(b'1234')).close()
+            os.utime(os.path.join(settings.POSTS_WARM_CACHE_DIR, name), (0, age * 1000))
+        self.assertIsNone(cache.open('d.png'))
+        # A hit makes a.png the most recently used
+        with cache.open('a.png') as file:
+            self.assertEqual(file.read(), b'1234')
+        # 16 bytes, evicted down to 90% of 12: b.png and c.png go
+        cache.put('d.png', io.BytesIO(b'1234')).close()
+        self.assertEqual(sorted(os.listdir(settings.POSTS_WARM_CACHE_DIR)), ['a.png', 'd.png'])
+        # Back within the limit, the next miss does not scan the directory
+        with mock.patch.object(cache, '_files') as files:
+            cache.put('e.png', io.BytesIO(b'1234')).close()
+        files.assert_not_called()
+
+    @override_settings(POSTS_TIERING_SAMPLE_RATE=1, POSTS_TIERING_FLUSH_SIZE=2)
+    def test_sampled_accesses(self):
+        sampler = get_access_sampler()
+        # Batches go to the access log of the process, never to the database
+        with self.assertNumQueries(0):
+            sampler.record(self.post1.pk)
+            sampler.record(self.post2.pk)
+            with override_settings(POSTS_TIERING_SAMPLE_RATE=0):
+                sampler.record(self.post3.pk)
+        self.assertEqual(len(os.listdir(settings.POSTS_TIERING_ACCESS_DIR)), 1)
+        self.assertFalse(Post.objects.exclude(image_accessed=None).exists())
+        sampler.record(self.post1.pk)
+        self.assertEqual(apply_accesses(), 2)
+        self.assertEqual(set(Post.objects.exclude(image_accessed=None).values_list('pk', flat=True)),
+                         {self.post1.pk, self.post2.pk})
+        self.assertEqual(os.listdir(settings.POSTS_TIERING_ACCESS_DIR), [])
+        self.assertEqual(apply_accesses(), 0)
+
+
+class EstimatedCountTests(BaseTest):
+    def test_estimated_count(self):
+        # Not analyzed yet: exact, even with the last rows deleted
+        Post.all_objects.filter(pk=self.post3.pk).delete()
+        self.assertEqual(estimated_count(Post.all_objects.all()), Post.objects.count())
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        self.assertEqual(estimated_count(Post.all_objects.all()), Post.objects.count())
+
+    def test_paginator(self):
+        with mock.patch('PostsApp.app_utils.admin_utils.estimated_count', return_value=10 ** 7):
+            self.assertEqual(EstimatedCountPaginator(Post.all_objects.order_by('pk'), 100).count, 10 ** 7)
+            filtered = Post.objects.filter(author=self.user1).order_by('pk')
+            self.assertEqual(EstimatedCountPaginator(filtered, 100).count, filtered.count())
+        self.assertEqual(EstimatedCountPaginator(Post.all_objects.order_by('pk'), 100).count, Post.objects.count())
+
+
+class SearchIndexTests(BaseTest):
+    def test_search_posts(self):
+        self.assertEqual(search_posts('caption1'), [self.post1])
+        self.assertEqual(search_posts('user_1 cap')[0], self.post2)
+        self.assertEqual(search_posts(''), [])
+
+    def test_likes_rerank_best_matches(self):
+        # post2 is the most liked, and its longer caption the worst bm25 match
+        self.post2.caption = 'caption2 and more'
+        self.post2.save()
+        self.assertEqual(search_posts('caption')[0], self.post2)
+        with mock.patch('PostsApp.app_utils.search_utils.SEARCH_CANDIDATES', 2):
+            self.assertNotIn(self.post2, search_posts('caption', limit=2))
+
+    def test_index_only_in_sqlite(self):
+        with mock.patch.object(connection, 'vendor', 'postgresql'):
+            self.post1.caption = 'renamed'
+            self.post1.save()
+        self.assertEqual(search_posts('renamed'), [])
+
+    def test_rebuild_search_index(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {SEARCH_TABLE}')
+        self.assertEqual(search_posts('caption1'), [])
+        call_command('rebuild_search_index', stdout=io.StringIO())
+        self.assertEqual(search_posts('caption1'), [self.post1])
+
+
+class ImageIngestTests(SimpleTestCase):
+    @staticmethod
+    def _jpeg_file(size, orientation=None) -> ContentFile:
+        output = io.BytesIO()
+        image = Image.new('RGB', size=size, color=(0, 155, 0))
+        exif = Image.Exif()
+        if orientation is not None:
+            exif[EXIF_ORIENTATION_TAG] = orientation
+        image.save(output, 'jpeg', exif=exif.tobytes())
+        return ContentFile(output.getvalue(), name='test.jpg')
+
+    def test_small_upright_image_is_untouched(self):
+        file = self._jpeg_file((40, 20))
+        ingested = ingest_image(file)
+        self.assertIs(ingested.file, file)
+        self.assertEqual((ingested.width, ingested.height, ingested.format), (40, 20, 'JPEG'))
+        self.assertEqual(ingested.bytes, file.size)
+
+    def test_exif_orientation_applied(self):
+        ingested = ingest_image(self._jpeg_file((40, 20), orientation=6))
+        self.assertEqual((ingested.width, ingested.height), (20, 40))
+        image = Image.open(ingested.file)
+        self.assertEqual(image.size, (20, 40))
+        self.assertNotIn(EXIF_ORIENTATION_TAG, image.getexif())
+
+    @override_settings(POSTS_IMAGE_MAX_EDGE=100)
+    def test_large_jpeg_downscaled(self):
+        ingested = ingest_image(self._jpeg_file((1000, 500)))
+        self.assertEqual((ingested.width, ingested.height), (100, 50))
+        self.assertEqual(Image.open(ingested.file).size, (100, 50))
+
+    def test_large_palette_png_downscaled(self):
+        output = io.BytesIO()
+        Image.new('RGB', size=(5000, 2500), color=(0, 155, 0)).quantize(16).save(output, 'png')
+        ingested = ingest_image(ContentFile(output.getvalue(), name='test.png'))
+        self.assertEqual((ingested.width, ingested.height, ingested.format), (2048, 1024, 'PNG'))
+        self.assertEqual(Image.open(ingested.file).size, (2048, 1024))
+
+    def test_ingest_hashes_image(self):
+        ingested = ingest_image(self._jpeg_file((40, 20)))
+        self.assertEqual(ingested.phash, dhash(Image.open(ingested.file)))
+
+
+class PhashTests(SimpleTestCase):
+    @staticmethod
+    def _image(seed: int) -> Image.Image:
+        """Smooth random image: upscaled random pixels"""
+        pixels = np.random.default_rng(seed).integers(0, 256, (6, 6, 3), dtype=np.uint8)
+        return Image.fromarray(pixels).resize((256, 256), Image.BICUBIC)
+
+    def test_dhash_resized_image(self):
+        image = self._image(0)
+        distances = hamming_distances(np.array([dhash(image)], dtype=np.int64).view(np.uint64),
+                                      dhash(image.resize((60, 40))))
+        self.assertLessEqual(distances[0], 4)
+
+    def test_dhash_different_image(self):
+        distances = hamming_distances(np.array([dhash(self._image(0))], dtype=np.int64).view(np.uint64),
+                                      dhash(self._image(1)))
+        self.assertGreater(distances[0], 20)
+
+    def test_hamming_distances(self):
+        hashes = np.array([0, 1, 3, -1], dtype=np.int64).view(np.uint64)
+        self.assertEqual(list(hamming_distances(hashes, 0)), [0, 1, 2, 64])
+        self.assertEqual(list(hamming_distances(hashes, -1)), [64, 63, 62, 0])
+
+    def test_index_search(self):
+        index = PhashIndex(np.array([1, 2, 3]), np.array([0b0, 0b111, -1]))
+        index.add(4, 0b1)
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index.search(0, 3), [(1, 0), (4, 1), (2, 3)])
+        self.assertEqual(index.search(0, 3, exclude=1), [(4, 1), (2, 3)])
+        index.discard(4)
+        self.assertEqual(index.search(0, 64), [(1, 0), (2, 3), (3, 64)])
+
+
+class EventBackendTests(SimpleTestCase):
+    @staticmethod
+    def _receive(backend, publish, queue_size: int = 10):
+        """Events delivered to a subscriber of backend while publish runs"""
+        async def run():
+            subscriber = Subscriber(asyncio.get_event_loop(), queue_size)
+            backend.subscribe(subscriber)
+            publish()
+            await asyncio.sleep(0)
+            backend.unsubscribe(subscriber)
+            return [subscriber.queue.get_nowait() for _ in range(subscriber.queue.qsize())]
+        return asyncio.run(run())
+
+    @override_settings(POSTS_EVENTS_BUFFER=2)
+    def test_local_backend(self):
+        backend = LocalEventBackend()
+        events = self._receive(backend, lambda: [backend.publish('likes', {'likes': n}) for n in range(3)])
+        first_id = events[0].id
+        self.assertEqual(events, [Event(first_id, 'likes', {'likes': 0}), Event(first_id + 1, 'likes', {'likes': 1}),
+                                  Event(first_id + 2, 'likes', {'likes': 2})])
+        self.assertEqual([event.id for event in backend.events_since(0)], [first_id + 1, first_id + 2])
+        self.assertEqual(backend.events_since(first_id + 2), [])
+
+    def test_local_backend_ids_after_restart(self):
+        backend = LocalEventBackend()
+        backend.publish('likes', {'likes': 1})
+        last_id = backend.events_since(0)[-1].id
+        # A new process: a client resuming from the last id of the previous one gets the new events
+        restarted = LocalEventBackend()
+        restarted.publish('likes', {'likes': 2})
+        self.assertEqual([event.data for event in restarted.events_since(last_id)], [{'likes': 2}])
+
+    def test_slow_subscriber_dropped(self):
+        backend = LocalEventBackend()
+        events = self._receive(backend, lambda: [backend.publish('likes', {}) for _ in range(3)], queue_size=2)
+        self.assertEqual(events, [None])
+
+    @override_settings(POSTS_EVENTS_BUFFER=2)
+    def test_sqlite_backend_between_processes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            publisher = SQLiteEventBackend(f'{directory}/events.sqlite3')
+            streamer = SQLiteEventBackend(f'{directory}/events.sqlite3')
+            publisher.publish('post', {'author': 1})
+
+            def publish():
+                publisher.publish('likes', {'likes': 1})
+                streamer.poll_once()
+
+            self.assertEqual(self._receive(streamer, publish), [Event(2, 'likes', {'likes': 1})])
+            publisher.publish('likes', {'likes': 2})
+            self.assertEqual([event.id for event in streamer.events_since(0)], [2, 3])
+
+
+class ThrottlingTests(SimpleTestCase):
+    def _test_store(self, store):
+        with mock.patch('time.time', return_value=1000.0):
+            self.assertEqual(store.take('user:1', 3, 4, 1.0), (True, 1.0, 0.0, 3.0))
+            bucket = store.take('user:1', 3, 4, 1.0)
+            self.assertFalse(bucket.allowed)
+            self.assertEqual(bucket.retry_after, 2.0)
+            self.assertTrue(store.take('user:2', 3, 4, 1.0).allowed)
+        with mock.patch('time.time', return_value=1002.0):
+            self.assertEqual(store.take('user:1', 3, 4, 1.0), (True, 0.0, 0.0, 4.0))
+        with mock.patch('time.time', return_value=1100.0):
+            self.assertEqual(store.take('user:1', 1, 4, 1.0).remaining, 3.0)
+            store.clear()
+            self.assertEqual(store.take('user:2', 1, 4, 1.0).remaining, 3.0)
+
+    def test_local_store(self):
+        self._test_store(LocalBucketStore())
+
+    def test_mmap_store_between_processes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self._test_store(MmapBucketStore(f'{directory}/buckets', slots=64))
+            first = MmapBucketStore(f'{directory}/buckets', slots=64)
+            second = MmapBucketStore(f'{directory}/buckets', slots=32)
+            self.assertEqual(second.slots, 64)
+            first.take('anon:127.0.0.1', 4, 4, 0.001)
+            self.assertFalse(second.take('anon:127.0.0.1', 1, 4, 0.001).allowed)
+
+    def test_mmap_store_full(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = MmapBucketStore(f'{directory}/buckets', slots=4)
+            for user_id in range(10):
+                self.assertTrue(store.take(f'user:{user_id}', 1, 1, 0.001).allowed)
+            self.assertFalse(store.take('user:9', 1, 1, 0.001).allowed)
+
+    def test_local_store_bounded(self):
+        store = LocalBucketStore(max_buckets=2)
+        store.take('anon:1', 1, 1, 0.001)
+        store.take('anon:2', 1, 1, 0.001)
+        # anon:1 becomes the most recently updated, anon:2 is dropped for anon:3
+        self.assertFalse(store.take('anon:1', 1, 1, 0.001).allowed)
+        store.take('anon:3', 1, 1, 0.001)
+        self.assertTrue(store.take('anon:2', 1, 1, 0.001).allowed)
+        self.assertEqual(len(store._buckets), 2)
+
+    @override_settings(POSTS_THROTTLE_BUCKETS={'user': (1, 0.001), 'anon': (1, 0.001)})
+    def test_forwarded_address_ignored(self):
+        view = mock.Mock(throttle_costs={})
+        with mock.patch('PostsApp.app_utils.throttling_utils._store', LocalBucketStore()):
+            for forwarded_for, allowed in (('10.0.0.1', True), ('10.0.0.2', False)):
+                request = Request(APIRequestFactory().get('/api/v1/posts/', HTTP_X_FORWARDED_FOR=forwarded_for))
+                request.user = AnonymousUser()
+                self.assertEqual(TokenBucketThrottle().allow_request(request, view), allowed)
+
+    def test_benchmark_command(self):
+        out = io.StringIO()
+        call_command('benchmark_throttle', checks=10, stdout=out)
+        self.assertIn('local: ', out.getvalue())
+        self.assertIn('mmap: ', out.getvalue())
@@ -1,17 +1,31 @@
+from operator import attrgetter
+from typing import Iterable, List, Optional, Set, Union
+
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.db.models import Count
-from django.shortcuts import get_object_or_404
-from drf_yasg import openapi
-from drf_yasg.utils import swagger_auto_schema
+from django.db.models import Count, Exists, F, OuterRef, QuerySet
+from django.http import FileResponse, Http404
+from django.shortcuts import get_object_or_404, redirect
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import require_safe
 
 from rest_framework import mixins, generics, permissions, status
 from rest_framework.authentication import TokenAuthentication
+from rest_framework.exceptions import ValidationError
 from rest_framework.parsers import JSONParser, MultiPartParser, FormParser
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from PostsApp.app_utils.views_utils import ErrorResponse
-from PostsApp.models import Post, LikeException, FollowException
+from PostsApp.app_utils.bootstrap_utils import run_sections, server_timing
+from PostsApp.app_utils.provisioning_utils import get_hashing_pool, provision_users
+from PostsApp.app_utils.schema_utils import lazy_swagger_auto_schema
+from PostsApp.app_utils.search_utils import search_posts
+from PostsApp.app_utils.shard_utils import get_post, scatter_gather
+from PostsApp.app_utils.tiering_utils import open_image
+from PostsApp.app_utils.trending_utils import trending_posts
+from PostsApp.app_utils.views_utils import (CSVParser, ErrorResponse, FollowPagination, NDJSONParser,
+                                            SparseFieldsetAPIMixin)
+from PostsApp.models import Post, PostLike, Profile, LikeException, FollowException
 from PostsApp.serializers import ImageSerializer, PostSerializer, UserSerializer
 
 
@@ -23,12 +37,21 @@ from PostsApp.serializers import ImageSerializer, PostSerializer, UserSerializer
 #   5. List of all posts (ordered by likes).
 #   6. List of all users (including information on the number of following and followers).
 
-class PostListAPI(mixins.ListModelMixin, generics.GenericAPIView):
+def _get_post_or_404(post_ref: str) -> Post:
+    try:
+        return get_post(Post.objects.all(), post_ref=post_ref)
+    except Post.DoesNotExist:
+        raise Http404
+
+
+class PostListAPI(SparseFieldsetAPIMixin, mixins.ListModelMixin, generics.GenericAPIView):
     parser_classes = (FormParser, MultiPartParser)
     authentication_classes = (TokenAuthentication,)
     permission_classes = (permissions.IsAuthenticated,)
     queryset = Post.objects.all().annotate(number_likes=Count('liked')).order_by('-number_likes')
     serializer_class = PostSerializer
+    # Tokens taken from the rate limiting bucket of the client (see throttling_utils), unpaginated lists cost more
+    throttle_costs = {'GET': 10, 'POST': 5}
 
     def get(self, request, *args, **kwargs):
         """
@@ -36,6 +59,9 @@ class PostListAPI(mixins.ListModelMixin, generics.GenericAPIView):
         """
         return self.list(request, *args, **kwargs)
 
+    def filter_queryset(self, queryset):
+        return scatter_gather(super().filter_queryset(queryset), key=attrgetter('number_likes'), reverse=True)
+
     def post(self, request, *args, **kwargs):
         """
         Creates a new post with an image.
@@ -49,12 +75,90 @@ class PostListAPI(mixins.ListModelMixin, generics.GenericAPIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-post_ref_schema = openapi.Schema(
-    type=openapi.TYPE_OBJECT,
-    properties={
-        'post_ref': openapi.Schema(type=openapi.TYPE_STRING, description='Post reference id'),
-    }
-)
+def search_query_param(openapi):
+    return openapi.Parameter('q', openapi.IN_QUERY, type=openapi.TYPE_STRING,
+                             description='Words (or word prefixes) to find in captions and usernames')
+
+
+class PostSearchAPI(SparseFieldsetAPIMixin, generics.ListAPIView):
+    permission_classes = (permissions.IsAuthenticated,)
+    serializer_class = PostSerializer
+    throttle_costs = {'GET': 2}
+
+    @lazy_swagger_auto_schema(lambda openapi: {'manual_parameters': [search_query_param(openapi)]})
+    def get(self, request, *args, **kwargs):
+        """
+        Full-text search of posts by caption and author username (best matches first, boosted by likes)
+        """
+        return super().get(request, *args, **kwargs)
+
+    def get_queryset(self):
+        return search_posts(self.request.query_params.get('q', ''))
+
+
+class PostTrendingAPI(SparseFieldsetAPIMixin, generics.ListAPIView):
+    permission_classes = (permissions.IsAuthenticated,)
+    serializer_class = PostSerializer
+
+    def get_queryset(self):
+        """
+        Trending posts (likes decayed by the age of the post, precomputed by the compute_trending command)
+        """
+        return trending_posts()
+
+
+def distance_param(openapi):
+    return openapi.Parameter('distance', openapi.IN_QUERY, type=openapi.TYPE_INTEGER,
+                             description='Maximum number of different bits (0-64) between image hashes')
+
+
+class PostDuplicatesAPI(SparseFieldsetAPIMixin, generics.ListAPIView):
+    permission_classes = (permissions.IsAuthenticated,)
+    serializer_class = PostSerializer
+
+    @lazy_swagger_auto_schema(lambda openapi: {'manual_parameters': [distance_param(openapi)]})
+    def get(self, request, *args, **kwargs):
+        """
+        Posts whose image is a near duplicate (resized, re-encoded...) of the image of a post, closest first
+        """
+        return super().get(request, *args, **kwargs)
+
+    def get_queryset(self):
+        # NumPy is only loaded by the workers that serve this endpoint
+        from PostsApp.app_utils.phash_utils import near_duplicates
+        post: Post = _get_post_or_404(self.kwargs['post_ref'])
+        distance = self.request.query_params.get('distance')
+        if distance is None:
+            return near_duplicates(post)
+        if not distance.isdigit() or int(distance) > 64:
+            raise ValidationError({'distance': 'Must be an integer between 0 and 64'})
+        return near_duplicates(post, int(distance))
+
+
+class PostDetailAPI(APIView):
+    """
+    This API allows to a logged User to delete one of his Posts
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def delete(self, request, post_ref: str, *args, **kwargs):
+        """
+        Deletes a Post of the logged User. It disappears right away, its likes are purged later
+        """
+        post: Post = _get_post_or_404(post_ref)
+        if post.author_id != request.user.pk:
+            return ErrorResponse(status.HTTP_403_FORBIDDEN, "Post belongs to another user")
+        post.soft_delete()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+def post_ref_schema(openapi):
+    return openapi.Schema(
+        type=openapi.TYPE_OBJECT,
+        properties={
+            'post_ref': openapi.Schema(type=openapi.TYPE_STRING, description='Post reference id'),
+        }
+    )
 
 
 class PostLikeAPI(APIView):
@@ -62,25 +166,28 @@ class PostLikeAPI(APIView):
     This API allows to a logged User to like/unlike a Post
     """
     permission_classes = (permissions.IsAuthenticated,)
+    throttle_costs = {'PUT': 2, 'DELETE': 2}
 
-    @swagger_auto_schema(request_body=post_ref_schema, operation_description='Like a Post',
-                         responses={200: 'Post liked', 400: 'Post belongs to user', 404: 'Post does not exists'})
+    @lazy_swagger_auto_schema(lambda openapi: {
+        'request_body': post_ref_schema(openapi), 'operation_description': 'Like a Post',
+        'responses': {200: 'Post liked', 400: 'Post belongs to user', 404: 'Post does not exists'}})
     def put(self, request, *args, **kwargs):
         try:
             post_ref: str = request.data["post_ref"]
-            post: Post = get_object_or_404(Post, post_ref=post_ref)
+            post: Post = _get_post_or_404(post_ref)
             request.user.profile.like_post(post)
         except LikeException:
             return ErrorResponse(status.HTTP_400_BAD_REQUEST, "Post belongs to user")
 
         return Response(status.HTTP_200_OK)
 
-    @swagger_auto_schema(request_body=post_ref_schema, operation_description='Unlike a Post',
-                         responses={200: 'Post liked', 404: 'Post does not exists'})
+    @lazy_swagger_auto_schema(lambda openapi: {
+        'request_body': post_ref_schema(openapi), 'operation_description': 'Unlike a Post',
+        'responses': {200: 'Post liked', 404: 'Post does not exists'}})
     def delete(self, request, *args, **kwargs):
         try:
             post_ref: str = request.data["post_ref"]
-            post: Post = get_object_or_404(Post, post_ref=post_ref)
+            post: Post = _get_post_or_404(post_ref)
             request.user.profile.unlike_post(post)
         except LikeException:
             return ErrorResponse(status.HTTP_400_BAD_REQUEST, "Post belongs to user")
@@ -88,7 +195,15 @@ class PostLikeAPI(APIView):
         return Response(status.HTTP_200_OK)
 
 
-class ImageListAPI(generics.ListAPIView):
+def _feed(user: User, posts: QuerySet, limit: Optional[int] = None,
+          following: Optional[Iterable[int]] = None) -> Union[QuerySet, List[Post]]:
+    """Posts of the users followed by user, gathered from the shards of the authors"""
+    if following is None:
+        following = Profile.following.through.objects.filter(profile__user=user).values_list('user_id', flat=True)
+    return scatter_gather(posts.order_by('created'), key=attrgetter('created'), limit=limit, author_ids=following)
+
+
+class ImageListAPI(SparseFieldsetAPIMixin, generics.ListAPIView):
     permission_classes = (permissions.IsAuthenticated,)
     serializer_class = ImageSerializer
 
@@ -96,17 +211,20 @@ class ImageListAPI(generics.ListAPIView):
         """
         List of images for the current user (most recent first, limited to users following).
         """
-        user: User = self.request.user
-        following_users = user.profile.following.all()
-        return Post.objects.filter(author__in=following_users).order_by('created')
+        return Post.objects.all()
+
+    def filter_queryset(self, queryset):
+        return _feed(self.request.user, super().filter_queryset(queryset))
 
 
-class UserListAPI(mixins.ListModelMixin,
+class UserListAPI(SparseFieldsetAPIMixin,
+                  mixins.ListModelMixin,
                   mixins.CreateModelMixin,
                   generics.GenericAPIView):
     parser_classes = (JSONParser, FormParser,)
-    queryset = User.objects.filter(profile__isnull=False)
+    queryset = User.objects.filter(profile__isnull=False, is_active=True)
     serializer_class = UserSerializer
+    throttle_costs = {'GET': 10, 'POST': 5}
 
     def get(self, request, *args, **kwargs):
         """
@@ -121,12 +239,129 @@ class UserListAPI(mixins.ListModelMixin,
         return self.create(request, *args, **kwargs)
 
 
-username_schema = openapi.Schema(
-    type=openapi.TYPE_OBJECT,
-    properties={
-        'username': openapi.Schema(type=openapi.TYPE_STRING, description='User to like username'),
-    }
-)
+class UserBulkAPI(APIView):
+    """
+    This API allows to an admin User to create many users at once
+    """
+    parser_classes = (NDJSONParser, CSVParser)
+    permission_classes = (permissions.IsAdminUser,)
+    throttle_costs = {'POST': 50}
+
+    def post(self, request, *args, **kwargs):
+        """
+        Creates the users of an NDJSON (application/x-ndjson) or CSV (text/csv, with a header) body, one per row with
+        username, password and optionally email, first_name and last_name. Invalid rows (e.g. repeated usernames)
+        are skipped and reported.
+        """
+        if isinstance(request.data, dict):
+            return ErrorResponse(status.HTTP_400_BAD_REQUEST, "Empty body")
+        # Hashed by the pool shared by the requests of this process, not started per request
+        result = provision_users(request.data, pool=get_hashing_pool())
+        return Response({'created': result.created, 'errors': [error._asdict() for error in result.errors]})
+
+
+class UserSuggestionsAPI(SparseFieldsetAPIMixin, generics.ListAPIView):
+    permission_classes = (permissions.IsAuthenticated,)
+    serializer_class = UserSerializer
+
+    def get_queryset(self):
+        """
+        Users suggested to follow (friends of friends and common followers, precomputed by the
+        compute_follow_suggestions command), best first
+        """
+        user: User = self.request.user
+        return (User.objects.filter(suggested_to__user=user, is_active=True)
+                .exclude(followers=user.profile)
+                .order_by('-suggested_to__score'))
+
+
+class UserDetailAPI(APIView):
+    """
+    This API allows to a logged User to delete his account
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def delete(self, request, username: str, *args, **kwargs):
+        """
+        Deletes the account of the logged User. It can not be used anymore and its posts disappear right away, the
+        rest of its data is purged later
+        """
+        user: User = get_object_or_404(User, username=username, is_active=True)
+        if user.pk != request.user.pk:
+            return ErrorResponse(status.HTTP_403_FORBIDDEN, "Users can only delete their own account")
+        request.user.profile.soft_delete()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class FollowListAPI(generics.ListAPIView):
+    """
+    Page of the users in the follows of an user (see UserFollowersAPI and UserFollowingAPI), most recent follows
+    first. Follows are paginated by id over a covering index, then the users of the page are loaded at once.
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+    serializer_class = UserSerializer
+    pagination_class = FollowPagination
+    # Column of the follows filtered by the user, with its value read from the user with user_attr
+    user_column: str
+    user_attr: str
+    # Column of the follows with the listed users, and the lookup of User it matches
+    listed_column: str
+    listed_lookup: str
+
+    def get_queryset(self):
+        user: User = get_object_or_404(User.objects.select_related('profile'), username=self.kwargs['username'],
+                                       is_active=True, profile__isnull=False)
+        return (Profile.following.through.objects.filter(**{self.user_column: attrgetter(self.user_attr)(user)})
+                .only(self.listed_column))
+
+    def list(self, request, *args, **kwargs):
+        follows = self.paginate_queryset(self.get_queryset())
+        listed_ids = [getattr(follow, self.listed_column) for follow in follows]
+        serializer = self.get_serializer()
+        users = serializer.prune_queryset(User.objects.filter(**{f'{self.listed_lookup}__in': listed_ids},
+                                                              is_active=True))
+        users = {user.listed_id: user for user in users.annotate(listed_id=F(self.listed_lookup))}
+        # Deleted accounts are left out until their follows are purged
+        page = [users[listed_id] for listed_id in listed_ids if listed_id in users]
+        followed = set(Profile.following.through.objects.filter(profile__user=request.user,
+                                                                user_id__in=[user.pk for user in page])
+                       .values_list('user_id', flat=True))
+        return self.get_paginated_response([
+            dict(serializer.to_representation(user), followed_by_me=user.pk in followed) for user in page
+        ])
+
+
+class UserFollowersAPI(FollowListAPI):
+    user_column, user_attr = 'user_id', 'pk'
+    listed_column, listed_lookup = 'profile_id', 'profile'
+
+    def get(self, request, *args, **kwargs):
+        """
+        Users that follow an user, most recent first, with followed_by_me for the logged User. Paginated with the
+        cursor of the next and previous links
+        """
+        return super().get(request, *args, **kwargs)
+
+
+class UserFollowingAPI(FollowListAPI):
+    user_column, user_attr = 'profile_id', 'profile.pk'
+    listed_column, listed_lookup = 'user_id', 'pk'
+
+    def get(self, request, *args, **kwargs):
+        """
+        Users followed by an user, most recent first, with followed_by_me for the logged User. Paginated with the
+        cursor of the next and previous links
+        """
+        return super().get(request, *args, **kwargs)
+
+
+def username_schema(openapi):
+    return openapi.Schema(
+        type=openapi.TYPE_OBJECT,
+        properties={
+            'username': openapi.Schema(type=openapi.TYPE_STRING, description='User to like username'),
+        }
+    )
 
 
 class UserFollowAPI(APIView):
@@ -134,26 +369,83 @@ class UserFollowAPI(APIView):
     Follow/unfollow user
     """
     permission_classes = (permissions.IsAuthenticated,)
+    throttle_costs = {'PUT': 2, 'DELETE': 2}
 
-    @swagger_auto_schema(request_body=username_schema, operation_description='Follow an User',
-                         responses={200: 'User followed', 400: 'User can not follow himself',
-                                    404: 'User does not exists'})
+    @lazy_swagger_auto_schema(lambda openapi: {
+        'request_body': username_schema(openapi), 'operation_description': 'Follow an User',
+        'responses': {200: 'User followed', 400: 'User can not follow himself', 404: 'User does not exists'}})
     def put(self, request, *args, **kwargs):
         try:
             user_name: str = request.data["username"]
-            user: User = get_object_or_404(User, username=user_name)
+            user: User = get_object_or_404(User, username=user_name, is_active=True)
             request.user.profile.follow_user(user)
         except FollowException:
             return ErrorResponse(status.HTTP_400_BAD_REQUEST, "User can not follow himself")
 
         return Response(status.HTTP_200_OK)
 
-    @swagger_auto_schema(request_body=username_schema, operation_description='Unfollow an User',
-                         responses={200: 'User followed',
-                                    404: 'User does not exists'})
+    @lazy_swagger_auto_schema(lambda openapi: {
+        'request_body': username_schema(openapi), 'operation_description': 'Unfollow an User',
+        'responses': {200: 'User followed', 404: 'User does not exists'}})
     def delete(self, request, *args, **kwargs):
         user_name: str = request.data["username"]
         user: User = get_object_or_404(User, username=user_name)
         request.user.profile.unfollow_user(user)
 
         return Response(status.HTTP_200_OK)
+
+
+class BootstrapAPI(APIView):
+    """
+    Everything a client loads on launch in a single request
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+    throttle_costs = {'GET': 5}
+
+    def get(self, request, *args, **kwargs):
+        """
+        First page of the images feed and of the posts ranking (with the like and follow state of the current user
+        for every post) and the profile counts of the current user. Sections are queried concurrently and their
+        durations returned in the Server-Timing header.
+        """
+        # The authenticated user and the users it follows are shared by every section
+        user: User = request.user
+        following = set(Profile.following.through.objects.filter(profile__user=user)
+                        .values_list('user_id', flat=True))
+        # Likes are in the shard of their post, so they are checked in the same query
+        liked_by_me = Exists(PostLike.objects.filter(post=OuterRef('pk'), user_id=user.pk))
+        page_size = settings.POSTS_BOOTSTRAP_PAGE_SIZE
+        feed = Post.objects.annotate(liked_by_me=liked_by_me)
+        ranking = PostListAPI.queryset.annotate(liked_by_me=liked_by_me)
+        profile_serializer = UserSerializer()
+        profile = profile_serializer.prune_queryset(User.objects.filter(pk=user.pk))
+        sections, timings = run_sections({
+            'feed': lambda: self._posts_data(_feed(user, feed, page_size, following), following),
+            'ranking': lambda: self._posts_data(
+                scatter_gather(ranking, key=attrgetter('number_likes'), reverse=True, limit=page_size), following),
+            'profile': lambda: profile_serializer.to_representation(profile.get()),
+        })
+        response = Response(sections)
+        response['Server-Timing'] = server_timing(timings)
+        return response
+
+    def _posts_data(self, posts: Iterable[Post], following: Set[int]) -> list:
+        # With the request, so the posts are the same as those of the endpoints bootstrap replaces (absolute URLs)
+        context = {'request': self.request}
+        return [dict(PostSerializer(post, context=context).data, liked_by_me=post.liked_by_me,
+                     author_followed_by_me=post.author_id in following) for post in posts]
+
+
+@require_safe
+def post_image_view(request, post_ref: str):
+    """
+    Image of a Post in the cold tier, served from the warm cache (see PostsApp.app_utils.tiering_utils). Requests for
+    images still in MEDIA_ROOT are redirected to their URL
+    """
+    post: Post = _get_post_or_404(post_ref)
+    if not post.image_pack:
+        return redirect(post.image.url)
+    response = FileResponse(open_image(post))
+    # The image of a Post never changes
+    patch_cache_control(response, public=True, max_age=settings.POSTS_IMAGE_CACHE_TIMEOUT)
+    return response
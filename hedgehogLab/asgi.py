@@ -13,4 +13,14 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'hedgehogLab.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported once Django is set up by get_asgi_application
+from PostsApp.sse import EVENTS_PATH, events_app  # noqa: E402
+
+
+async def application(scope, receive, send):
+    """Serves the Server-Sent Events stream, everything else goes to Django"""
+    if scope['type'] == 'http' and scope['path'] == EVENTS_PATH:
+        return await events_app(scope, receive, send)
+    return await django_application(scope, receive, send)
@@ -49,6 +49,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'PostsApp.app_utils.throttling_utils.RateLimitHeadersMiddleware',
 ]
 
 ROOT_URLCONF = 'hedgehogLab.urls'
@@ -79,6 +80,12 @@ REST_FRAMEWORK = {
         'rest_framework.renderers.JSONRenderer',
         'rest_framework.renderers.TemplateHTMLRenderer'
     ],
+    'DEFAULT_THROTTLE_CLASSES': [
+        'PostsApp.app_utils.throttling_utils.TokenBucketThrottle',
+    ],
+    # Reverse proxies in front of the app, whose X-Forwarded-For the throttling trusts for the client address. 0 when
+    # clients connect directly: their X-Forwarded-For is ignored
+    'NUM_PROXIES': 0,
 }
 
 WSGI_APPLICATION = 'hedgehogLab.wsgi.application'
@@ -130,3 +137,71 @@ STATIC_ROOT = os.path.join(BASE_DIR, "static")
 STATIC_URL = "/static/"
 MEDIA_ROOT = os.path.join(BASE_DIR, "media")
 MEDIA_URL = "/media/"
+
+# Image ingest limits (see PostsApp.app_utils.image_utils)
+POSTS_IMAGE_MAX_BYTES = 10 * 1024 * 1024
+POSTS_IMAGE_MAX_PIXELS = 40_000_000
+POSTS_IMAGE_MAX_EDGE = 2048
+
+# Trending ranking (see PostsApp.app_utils.trending_utils)
+POSTS_TRENDING_GRAVITY = 1.8
+POSTS_TRENDING_WINDOW_DAYS = 30
+
+# Number of "who to follow" suggestions stored per user (see PostsApp.app_utils.suggestion_utils)
+POSTS_FOLLOW_SUGGESTIONS = 20
+
+# Near duplicate images (see PostsApp.app_utils.phash_utils)
+POSTS_PHASH_MAX_DISTANCE = 10
+POSTS_PHASH_INDEX_TTL = 300
+
+# Realtime events streamed by the ASGI application (see PostsApp.app_utils.events_utils and PostsApp.sse).
+# Use 'PostsApp.app_utils.events_utils.SQLiteEventBackend' when several processes run
+POSTS_EVENTS_BACKEND = 'PostsApp.app_utils.events_utils.LocalEventBackend'
+POSTS_EVENTS_SQLITE_PATH = BASE_DIR / 'events.sqlite3'
+POSTS_EVENTS_BUFFER = 1000
+POSTS_EVENTS_QUEUE_SIZE = 100
+POSTS_EVENTS_HEARTBEAT = 15
+
+# Prebuilt OpenAPI schema (python manage.py build_api_schema, see PostsApp.api_schema)
+API_SCHEMA_DIR = BASE_DIR / 'api_schema'
+API_SCHEMA_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Composite bootstrap endpoint (see PostsApp.app_utils.bootstrap_utils)
+POSTS_BOOTSTRAP_PAGE_SIZE = 20
+POSTS_BOOTSTRAP_WORKERS = 4
+
+# Databases holding the posts and their likes, sharded by author (see PostsApp.app_utils.shard_utils). Every alias
+# has to be in DATABASES and migrated (python manage.py migrate --database=<alias>), e.g. ['default', 'posts_1']
+POSTS_SHARDS = ['default']
+DATABASE_ROUTERS = ['PostsApp.routers.PostShardRouter']
+
+# Bulk provisioning of users (see PostsApp.app_utils.provisioning_utils). Processes hashing passwords, for the
+# provision_users command and for the pool every web process keeps for the API. None: one per CPU
+POSTS_PROVISIONING_CHUNK_SIZE = 1000
+POSTS_PROVISIONING_WORKERS = None
+
+# Rate limiting of the API (see PostsApp.app_utils.throttling_utils): (burst, tokens refilled per second) of the bucket
+# of every user and of every IP address of anonymous clients. Use 'PostsApp.app_utils.throttling_utils.MmapBucketStore'
+# when several processes run
+POSTS_THROTTLE_BUCKETS = {'user': (100, 5.0), 'anon': (30, 0.5)}
+POSTS_THROTTLE_BACKEND = 'PostsApp.app_utils.throttling_utils.LocalBucketStore'
+POSTS_THROTTLE_MMAP_PATH = BASE_DIR / 'throttle.buckets'
+# Buckets kept by either store, the least recently updated ones are reused past that
+POSTS_THROTTLE_SLOTS = 65536
+
+# Default number of users per page of the followers and following lists (see PostsApp.views.FollowListAPI)
+POSTS_FOLLOW_PAGE_SIZE = 50
+
+# Hot/cold tiering of post images (see PostsApp.app_utils.tiering_utils): the tier_images command packs the images of
+# posts older than HOT_DAYS, or not accessed in IDLE_DAYS, into the cold tier. Cold images are served from a warm cache
+POSTS_TIERING_HOT_DAYS = 90
+POSTS_TIERING_IDLE_DAYS = 14
+POSTS_TIERING_SAMPLE_RATE = 1 / 16
+POSTS_TIERING_FLUSH_SIZE = 100
+POSTS_TIERING_FLUSH_INTERVAL = 60
+# Access logs of the web processes, applied to the posts by tier_images
+POSTS_TIERING_ACCESS_DIR = BASE_DIR / 'media_accesses'
+POSTS_COLD_STORAGE_DIR = BASE_DIR / 'media_cold'
+POSTS_WARM_CACHE_DIR = BASE_DIR / 'media_warm'
+POSTS_WARM_CACHE_BYTES = 1024 ** 3
+POSTS_IMAGE_CACHE_TIMEOUT = 60 * 60 * 24 * 30
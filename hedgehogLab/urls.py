@@ -16,30 +16,31 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, re_path
 
-from rest_framework import permissions
-from drf_yasg.views import get_schema_view
-from drf_yasg import openapi
-
+import PostsApp.api_schema as api_schema
 import PostsApp.views as views
 
-schema_view = get_schema_view(
-   openapi.Info(
-      title="Hedgehog Lab Test API",
-      default_version='v1',
-      description="API documentation",
-   ),
-   public=True,
-   permission_classes=(permissions.AllowAny,),
-)
-
 urlpatterns = [
     path('admin/', admin.site.urls),
-    re_path(r'^doc/swagger(?P<format>\.json|\.yaml)$', schema_view.without_ui(cache_timeout=0), name='schema-json'),
-    re_path(r'^doc/swagger/$', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
-    re_path(r'^doc/redoc/$', schema_view.with_ui('redoc', cache_timeout=0), name='schema-redoc'),
+    re_path(r'^doc/swagger(?P<format>\.json|\.yaml)$', api_schema.schema_view, name='schema-json'),
+    re_path(r'^doc/swagger/$', api_schema.swagger_ui_view, name='schema-swagger-ui'),
+    re_path(r'^doc/redoc/$', api_schema.redoc_view, name='schema-redoc'),
     re_path(r'^api/v1/users/$', views.UserListAPI.as_view(), name='user-api-v1'),
+    re_path(r'^api/v1/users/bulk/$', views.UserBulkAPI.as_view(), name='user-bulk-api-v1'),
+    re_path(r'^api/v1/users/suggestions/$', views.UserSuggestionsAPI.as_view(), name='user-suggestions-api-v1'),
+    re_path(r'^api/v1/users/(?P<username>[\w.@+-]+)/$', views.UserDetailAPI.as_view(), name='user-detail-api-v1'),
+    re_path(r'^api/v1/users/(?P<username>[\w.@+-]+)/followers/$', views.UserFollowersAPI.as_view(),
+            name='user-followers-api-v1'),
+    re_path(r'^api/v1/users/(?P<username>[\w.@+-]+)/following/$', views.UserFollowingAPI.as_view(),
+            name='user-following-api-v1'),
     re_path(r'^api/v1/posts/$', views.PostListAPI.as_view(), name='post-api-v1'),
+    re_path(r'^api/v1/posts/search/$', views.PostSearchAPI.as_view(), name='post-search-api-v1'),
+    re_path(r'^api/v1/posts/trending/$', views.PostTrendingAPI.as_view(), name='post-trending-api-v1'),
+    re_path(r'^api/v1/posts/(?P<post_ref>[\w-]+)/$', views.PostDetailAPI.as_view(), name='post-detail-api-v1'),
+    re_path(r'^api/v1/posts/(?P<post_ref>[\w-]+)/duplicates/$', views.PostDuplicatesAPI.as_view(),
+            name='post-duplicates-api-v1'),
+    re_path(r'^api/v1/posts/(?P<post_ref>[\w-]+)/image/$', views.post_image_view, name='post-image-api-v1'),
     re_path(r'^api/v1/images/$', views.ImageListAPI.as_view(), name='image-api-v1'),
     re_path(r'^api/v1/likepost/$', views.PostLikeAPI.as_view(), name='post-like-api-v1'),
+    re_path(r'^api/v1/bootstrap/$', views.BootstrapAPI.as_view(), name='bootstrap-api-v1'),
     re_path(r'^api/v1/followuser/$', views.UserFollowAPI.as_view(), name='user-follow-api-v1'),
 ]